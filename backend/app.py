@@ -1,13 +1,37 @@
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, g, has_app_context, has_request_context, Response, send_file, stream_with_context, url_for
 from flask_sqlalchemy import SQLAlchemy
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm.exc import StaleDataError
+from sqlalchemy import create_engine, inspect, text, select, update, insert, delete, func, event, case, bindparam
+from sqlalchemy.orm import contains_eager, declared_attr, object_session, selectinload, with_loader_criteria
+from sqlalchemy.engine import Engine
 from flask_cors import CORS
 import os
 import re # Para regex de email e telefone
-from datetime import datetime, timedelta, timezone
-from werkzeug.security import generate_password_hash, check_password_hash
+from datetime import date, datetime, timedelta, timezone
+from werkzeug.http import is_resource_modified
+from werkzeug.security import generate_password_hash, check_password_hash, safe_join
 import jwt
-from functools import wraps
+import click
+from functools import lru_cache, wraps
+import atexit
+import difflib
+import gzip
+import hashlib
+import html
+import itertools
+import json
+import math
+import mimetypes
+import queue
+import secrets
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+import unicodedata
+import zlib
 
 app = Flask(__name__)
 
@@ -19,33 +43,290 @@ app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL', 'sqlite:/
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['JWT_SECRET_KEY'] = os.environ.get('JWT_SECRET_KEY', 'your-super-secret-key-change-me') # Mude isso em produção!
 
+# Instrumentação de requisições (desligada por padrão)
+app.config['REQUEST_PROFILING'] = os.environ.get('REQUEST_PROFILING', '0') == '1'
+app.config['SLOW_REQUEST_MS'] = float(os.environ.get('SLOW_REQUEST_MS', '500'))
+
+# Controle de admissão por classe de rota: "classe=concorrência:fila[:espera em segundos]" (vazio desativa)
+app.config['ADMISSION_LIMITS'] = os.environ.get('ADMISSION_LIMITS', '') # Ex.: critica=8:32:10,padrao=16:64:2,pesada=2:4:1
+
+# Limpeza em segundo plano dos registros excluídos logicamente (0 desativa a thread; use 'flask limpar-excluidos')
+app.config['CLEANUP_INTERVAL_SECONDS'] = int(os.environ.get('CLEANUP_INTERVAL_SECONDS', '300'))
+app.config['CLEANUP_BATCH_SIZE'] = int(os.environ.get('CLEANUP_BATCH_SIZE', '500'))
+
+# Cache de respostas das rotas GET mais acessadas (0 desativa); Redis opcional para compartilhar entre workers
+app.config['RESPONSE_CACHE_TTL_SECONDS'] = float(os.environ.get('RESPONSE_CACHE_TTL_SECONDS', '5'))
+app.config['RESPONSE_CACHE_REDIS_URL'] = os.environ.get('RESPONSE_CACHE_REDIS_URL')
+
+# Arquivamento de agendamentos/pagamentos processados mais antigos que N dias (0 desativa; use 'flask arquivar')
+app.config['ARCHIVE_AFTER_DAYS'] = int(os.environ.get('ARCHIVE_AFTER_DAYS', '0'))
+
+# Build do frontend (frontend/dist) servido pelo próprio backend; sem ele, o frontend roda no seu container
+app.config['FRONTEND_DIST_DIR'] = os.environ.get('FRONTEND_DIST_DIR')
+
+# Janela do feed .ics da agenda de cada dentista (/api/agenda/<token>.ics)
+app.config['ICS_FEED_DAYS_BEFORE'] = int(os.environ.get('ICS_FEED_DAYS_BEFORE', '30'))
+app.config['ICS_FEED_DAYS_AFTER'] = int(os.environ.get('ICS_FEED_DAYS_AFTER', '180'))
+
+# Backups online do SQLite ('flask backup' ou POST /api/backups), comprimidos e com rotação
+app.config['BACKUP_DIR'] = os.environ.get('BACKUP_DIR', os.path.join(os.path.dirname(__file__), 'backups'))
+app.config['BACKUP_RETENTION'] = int(os.environ.get('BACKUP_RETENTION', '7'))
+app.config['BACKUP_PAGES_PER_STEP'] = int(os.environ.get('BACKUP_PAGES_PER_STEP', '256'))
+app.config['BACKUP_MAX_RESTARTS'] = int(os.environ.get('BACKUP_MAX_RESTARTS', '5'))
+
+# Auditoria: registros acumulados em memória e gravados em lote por uma thread (perda limitada ao intervalo)
+app.config['AUDIT_FLUSH_INTERVAL_SECONDS'] = float(os.environ.get('AUDIT_FLUSH_INTERVAL_SECONDS', '1'))
+app.config['AUDIT_BATCH_SIZE'] = int(os.environ.get('AUDIT_BATCH_SIZE', '500'))
+app.config['AUDIT_MAX_BUFFER'] = int(os.environ.get('AUDIT_MAX_BUFFER', '50000'))
+app.config['AUDIT_LOG_FILE'] = os.environ.get('AUDIT_LOG_FILE') # Cópia opcional em JSON Lines, somente anexação
+
+# Validade das respostas gravadas para o cabeçalho Idempotency-Key
+app.config['IDEMPOTENCY_TTL_HOURS'] = float(os.environ.get('IDEMPOTENCY_TTL_HOURS', '24'))
+
+# Compressão em repouso (zlib) das anotações do histórico e dos anexos compressíveis (0 desativa)
+app.config['COMPRESS_MIN_BYTES'] = int(os.environ.get('COMPRESS_MIN_BYTES', '1024'))
+
+UPLOAD_DIR = os.path.join(os.path.dirname(__file__), 'uploads')
+
 
 db = SQLAlchemy(app)
 
 
+# --- Instrumentação de Requisições e SQL ---
+# Quando REQUEST_PROFILING=1, cada requisição registra rota, status, latência, número de
+# comandos SQL, tempo gasto em SQL e tamanho da resposta. Requisições acima de
+# SLOW_REQUEST_MS são logadas com seus comandos SQL. Os agregados ficam em /api/_metrics.
+BUCKETS_LATENCIA = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class MetricasRequisicoes:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._por_rota = {}
+
+    def registrar(self, rota, metodo, status, duracao, qtd_sql, tempo_sql, tamanho):
+        with self._lock:
+            m = self._por_rota.setdefault((rota, metodo), {
+                'status': {}, 'buckets': [0] * len(BUCKETS_LATENCIA), 'count': 0,
+                'duracao': 0.0, 'sql_qtd': 0, 'sql_tempo': 0.0, 'bytes': 0
+            })
+            m['status'][status] = m['status'].get(status, 0) + 1
+            for i, limite in enumerate(BUCKETS_LATENCIA):
+                if duracao <= limite:
+                    m['buckets'][i] += 1
+            m['count'] += 1
+            m['duracao'] += duracao
+            m['sql_qtd'] += qtd_sql
+            m['sql_tempo'] += tempo_sql
+            m['bytes'] += tamanho
+
+    def formato_prometheus(self):
+        with self._lock:
+            por_rota = [(f'route="{rota}",method="{metodo}"', m) for (rota, metodo), m in sorted(self._por_rota.items())]
+            linhas = ['# TYPE http_requests_total counter']
+            for rotulos, m in por_rota:
+                for status, qtd in sorted(m['status'].items()):
+                    linhas.append(f'http_requests_total{{{rotulos},status="{status}"}} {qtd}')
+            linhas.append('# TYPE http_request_duration_seconds histogram')
+            for rotulos, m in por_rota:
+                for limite, qtd in zip(BUCKETS_LATENCIA, m['buckets']):
+                    linhas.append(f'http_request_duration_seconds_bucket{{{rotulos},le="{limite}"}} {qtd}')
+                linhas.append(f'http_request_duration_seconds_bucket{{{rotulos},le="+Inf"}} {m["count"]}')
+                linhas.append(f'http_request_duration_seconds_sum{{{rotulos}}} {m["duracao"]:.6f}')
+                linhas.append(f'http_request_duration_seconds_count{{{rotulos}}} {m["count"]}')
+            for nome, chave in (('http_sql_statements_total', 'sql_qtd'),
+                                ('http_sql_duration_seconds_total', 'sql_tempo'),
+                                ('http_response_bytes_total', 'bytes')):
+                linhas.append(f'# TYPE {nome} counter')
+                for rotulos, m in por_rota:
+                    linhas.append(f'{nome}{{{rotulos}}} {m[chave]}')
+        return '\n'.join(linhas) + '\n'
+
+metricas_requisicoes = MetricasRequisicoes()
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _inicio_comando_sql(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context() and 'sql_comandos' in g:
+        conn.info.setdefault('inicio_comando', []).append(time.perf_counter())
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _fim_comando_sql(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context() and 'sql_comandos' in g and conn.info.get('inicio_comando'):
+        duracao = time.perf_counter() - conn.info['inicio_comando'].pop()
+        g.sql_comandos.append((statement, duracao))
+
+@app.before_request
+def _iniciar_medicao():
+    if app.config['REQUEST_PROFILING']:
+        g.inicio_requisicao = time.perf_counter()
+        g.sql_comandos = []
+
+@app.after_request
+def _registrar_medicao(response):
+    if 'inicio_requisicao' not in g:
+        return response
+    duracao = time.perf_counter() - g.inicio_requisicao
+    rota = request.url_rule.rule if request.url_rule else 'desconhecida'
+    tempo_sql = sum(d for _, d in g.sql_comandos)
+    tamanho = 0 if response.is_streamed else (response.calculate_content_length() or 0)
+    metricas_requisicoes.registrar(rota, request.method, response.status_code, duracao, len(g.sql_comandos), tempo_sql, tamanho)
+
+    registro = {
+        'rota': rota, 'metodo': request.method, 'status': response.status_code,
+        'latencia_ms': round(duracao * 1000, 2), 'sql_qtd': len(g.sql_comandos),
+        'sql_ms': round(tempo_sql * 1000, 2), 'bytes': tamanho
+    }
+    if registro['latencia_ms'] >= app.config['SLOW_REQUEST_MS']:
+        registro['sql'] = [{'comando': c, 'ms': round(d * 1000, 2)} for c, d in g.sql_comandos]
+        app.logger.warning(f"Requisição lenta: {json.dumps(registro, ensure_ascii=False)}")
+    else:
+        app.logger.info(json.dumps(registro, ensure_ascii=False))
+    return response
+
+
+# --- Controle de Admissão ---
+# Cada classe de rota tem a própria faixa: até N requisições em execução e uma fila limitada.
+# Acima disso a requisição é recusada na hora com 503 e Retry-After (fila cheia ou espera
+# esgotada), antes de autenticar ou tocar no banco. As escritas da recepção (agendamentos e
+# pagamentos) ficam na faixa 'critica', cuja capacidade nenhuma outra classe consome; listagens
+# completas, uploads, busca e backups ficam na 'pesada'. As demais rotas, inclusive o login (os
+# acessos da manhã chegam juntos), usam a 'padrao'; o stream SSE, as métricas e o frontend
+# estático não passam pelo controle. Desativado sem ADMISSION_LIMITS.
+CLASSES_ADMISSAO = {
+    'create_appointment': 'critica', 'update_appointment_route': 'critica', 'delete_appointment': 'critica',
+    'processar_agendamentos_em_lote': 'critica', 'registrar_pagamento': 'critica', 'aprovar_pagamento': 'critica',
+    'rejeitar_pagamento': 'critica', 'processar_pagamentos_em_lote': 'critica',
+    'get_pacientes': 'pesada', 'create_historico': 'pesada', 'buscar_historico': 'pesada',
+    'uploaded_file': 'pesada', 'get_pacientes_duplicados': 'pesada', 'mesclar_pacientes_route': 'pesada',
+    'criar_backup_route': 'pesada', 'verificar_backup_route': 'pesada',
+    'stream_appointments': None, 'metrics': None, 'frontend': None, 'frontend_index': None,
+}
+
+class FaixaAdmissao:
+    def __init__(self, nome, limite, tamanho_fila, espera):
+        self.nome = nome
+        self.limite = limite
+        self.tamanho_fila = tamanho_fila
+        self.espera = espera
+        self._condicao = threading.Condition()
+        self.em_execucao = 0
+        self.na_fila = 0
+        self.admitidas = 0
+        self.tempo_fila = 0.0
+        self.rejeitadas = {'fila_cheia': 0, 'espera_esgotada': 0}
+
+    def entrar(self):
+        """Admite a requisição (retorna None) ou retorna o motivo da recusa."""
+        with self._condicao:
+            if self.em_execucao >= self.limite:
+                if self.na_fila >= self.tamanho_fila:
+                    self.rejeitadas['fila_cheia'] += 1
+                    return 'fila_cheia'
+                self.na_fila += 1
+                inicio = time.perf_counter()
+                try:
+                    admitida = self._condicao.wait_for(lambda: self.em_execucao < self.limite, timeout=self.espera)
+                finally:
+                    self.na_fila -= 1
+                self.tempo_fila += time.perf_counter() - inicio
+                if not admitida:
+                    self.rejeitadas['espera_esgotada'] += 1
+                    return 'espera_esgotada'
+            self.em_execucao += 1
+            self.admitidas += 1
+            return None
+
+    def sair(self):
+        with self._condicao:
+            self.em_execucao -= 1
+            self._condicao.notify()
+
+class ControleAdmissao:
+    def __init__(self, configuracao):
+        self.faixas = {}
+        for item in filter(None, (parte.strip() for parte in configuracao.split(','))):
+            nome, valores = item.split('=')
+            limite, tamanho_fila, *espera = valores.split(':')
+            self.faixas[nome.strip()] = FaixaAdmissao(nome.strip(), int(limite), int(tamanho_fila),
+                                                      float(espera[0]) if espera else 2.0)
+
+    def formato_prometheus(self):
+        linhas = []
+        for nome, tipo, valor in (('admission_limit', 'gauge', lambda f: f.limite),
+                                  ('admission_in_flight', 'gauge', lambda f: f.em_execucao),
+                                  ('admission_queue_depth', 'gauge', lambda f: f.na_fila),
+                                  ('admission_admitted_total', 'counter', lambda f: f.admitidas),
+                                  ('admission_queue_wait_seconds_total', 'counter', lambda f: round(f.tempo_fila, 6))):
+            linhas.append(f'# TYPE {nome} {tipo}')
+            linhas.extend(f'{nome}{{lane="{f.nome}"}} {valor(f)}' for f in self.faixas.values())
+        linhas.append('# TYPE admission_rejected_total counter')
+        for f in self.faixas.values():
+            linhas.extend(f'admission_rejected_total{{lane="{f.nome}",reason="{motivo}"}} {qtd}' for motivo, qtd in f.rejeitadas.items())
+        return '\n'.join(linhas) + '\n'
+
+controle_admissao = ControleAdmissao(app.config['ADMISSION_LIMITS'])
+
+@app.before_request
+def _admitir_requisicao():
+    if request.method == 'OPTIONS':
+        return None
+    faixa = controle_admissao.faixas.get(CLASSES_ADMISSAO.get(request.endpoint, 'padrao'))
+    if faixa is None:
+        return None
+    motivo = faixa.entrar()
+    if motivo:
+        return jsonify({"success": False, "message": "Servidor ocupado no momento. Tente novamente em instantes.",
+                        "motivo": motivo}), 503, {'Retry-After': '1'}
+    g.faixa_admissao = faixa
+
+@app.teardown_request
+def _liberar_admissao(erro):
+    faixa = g.pop('faixa_admissao', None)
+    if faixa is not None:
+        faixa.sair()
+
+@app.route('/api/_metrics', methods=['GET'])
+def metrics():
+    # Sem autenticação: só existe com o opt-in REQUEST_PROFILING, inclusive a parte da admissão
+    if not app.config['REQUEST_PROFILING']:
+        return jsonify({'message': 'Instrumentação desativada (REQUEST_PROFILING=1).'}), 404
+    secoes = [metricas_requisicoes.formato_prometheus()]
+    if controle_admissao.faixas:
+        secoes.append(controle_admissao.formato_prometheus())
+    return ''.join(secoes), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+
 # --- Decorators de Autenticação ---
+def _usuario_do_token(token, proposito=None):
+    """Retorna (usuario, None) para um token válido ou (None, resposta_de_erro). Tokens de uso
+    restrito (ex.: o ticket do stream SSE) só valem para o `proposito` indicado no claim."""
+    if not token:
+        return None, (jsonify({'message': 'Token é obrigatório!'}), 401)
+
+    try:
+        data = jwt.decode(token, app.config['JWT_SECRET_KEY'], algorithms=["HS256"])
+        if data.get('proposito') != proposito:
+            return None, (jsonify({'message': 'Token inválido!'}), 401)
+        current_user = Usuario.query.get(data['user_id'])
+        if not current_user:
+            return None, (jsonify({'message': 'Usuário do token não encontrado!'}), 401)
+        if data.get('clinica_id', CLINICA_PADRAO_ID) != current_user.clinica_id: # Tokens anteriores às clínicas: clínica padrão
+            return None, (jsonify({'message': 'Token inválido!'}), 401)
+    except jwt.ExpiredSignatureError:
+        return None, (jsonify({'message': 'Token expirou!'}), 401)
+    except jwt.InvalidTokenError:
+        return None, (jsonify({'message': 'Token inválido!'}), 401)
+    except Exception as e:
+        return None, (jsonify({'message': f'Erro ao decodificar token: {str(e)}'}), 401)
+    return current_user, None
+
 def token_required(f):
     @wraps(f)
     def decorated(*args, **kwargs):
-        token = None
-        if 'x-access-token' in request.headers:
-            token = request.headers['x-access-token']
-
-        if not token:
-            return jsonify({'message': 'Token é obrigatório!'}), 401
-
-        try:
-            data = jwt.decode(token, app.config['JWT_SECRET_KEY'], algorithms=["HS256"])
-            current_user = Usuario.query.get(data['user_id'])
-            if not current_user:
-                return jsonify({'message': 'Usuário do token não encontrado!'}), 401
-        except jwt.ExpiredSignatureError:
-            return jsonify({'message': 'Token expirou!'}), 401
-        except jwt.InvalidTokenError:
-            return jsonify({'message': 'Token inválido!'}), 401
-        except Exception as e:
-            return jsonify({'message': f'Erro ao decodificar token: {str(e)}'}), 401
-
+        current_user, erro = _usuario_do_token(request.headers.get('x-access-token'))
+        if erro:
+            return erro
+        g.usuario_auditoria = (current_user.id, current_user.nome) # Autor das alterações (ver Auditoria)
+        g.clinica_id = current_user.clinica_id # Filtra as consultas da requisição (ver Isolamento por Clínica)
         return f(current_user, *args, **kwargs)
     return decorated
 
@@ -58,37 +339,343 @@ def admin_required(f):
         return f(current_user, *args, **kwargs)
     return decorated
 
+def admin_clinica_padrao_required(f):
+    """Operações sobre o banco inteiro (ex.: backups), que contém os dados de todas as clínicas."""
+    @wraps(f)
+    @admin_required
+    def decorated(current_user, *args, **kwargs):
+        if current_user.clinica_id != CLINICA_PADRAO_ID:
+            return jsonify({'message': 'Acesso restrito a administradores da clínica padrão!'}), 403
+        return f(current_user, *args, **kwargs)
+    return decorated
+
 
 # --- Funções de Validação ---
+# Esquemas declarativos: cada rota descreve seus campos uma vez (ver "Esquemas de Validação"
+# após os models) e o payload inteiro é validado e convertido em uma única passada, com
+# todos os erros devolvidos juntos em {"errors": {campo: mensagem}}. Os conversores recebem
+# o valor bruto do JSON e retornam o valor convertido ou lançam ValueError com a mensagem.
+RE_NAO_DIGITOS = re.compile(r'[^0-9]')
+RE_EMAIL = re.compile(r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$')
+RE_DATA = re.compile(r'^(\d{4})-(\d{2})-(\d{2})$')
+RE_HORA = re.compile(r'^(\d{1,2}):(\d{2})$')
+
+def digitos_verificadores_cpf(base: str) -> str:
+    """Calcula os dois dígitos verificadores para os 9 primeiros dígitos de um CPF."""
+    numeros = [int(d) for d in base]
+    for tamanho in (9, 10):
+        soma = sum(n * peso for n, peso in zip(numeros, range(tamanho + 1, 1, -1)))
+        numeros.append(soma * 10 % 11 % 10)
+    return f"{numeros[9]}{numeros[10]}"
+
 def is_valid_cpf(cpf: str) -> bool:
     if not cpf: return True # Permite CPF nulo/vazio se o campo for opcional
-    # Remove caracteres não numéricos
-    cpf_num = re.sub(r'[^0-9]', '', cpf)
+    cpf_num = RE_NAO_DIGITOS.sub('', cpf)
     if len(cpf_num) != 11 or len(set(cpf_num)) == 1:
         return False
-    # Validação básica de dígito verificador (simplificada para exemplo)
-    # Uma validação completa de DV seria mais complexa
-    # Aqui, apenas verificamos o formato e se não são todos números iguais.
-    # Para uma validação real, usar uma biblioteca como "validate_docbr".
-    return True
+    return cpf_num[9:] == digitos_verificadores_cpf(cpf_num[:9])
 
 def is_valid_email(email: str) -> bool:
     if not email: return True # Permite email nulo/vazio se nao_possui_email=True ou opcional
-    # Regex simples para validação de email
-    email_regex = r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$'
-    return re.match(email_regex, email) is not None
+    return RE_EMAIL.match(email) is not None
 
 def is_valid_phone(phone: str) -> bool:
     if not phone: return True # Permite telefone nulo/vazio se opcional
-    # Remove caracteres não numéricos
-    phone_num = re.sub(r'[^0-9]', '', phone)
-    # Verifica se tem entre 10 e 11 dígitos (comum para fixo e celular no Brasil)
-    return 10 <= len(phone_num) <= 11
+    # Entre 10 e 11 dígitos (comum para fixo e celular no Brasil)
+    return 10 <= len(RE_NAO_DIGITOS.sub('', phone)) <= 11
+
+
+class ErrosValidacao(ValueError):
+    """Erros de um valor composto (objeto ou lista), indexados pelo caminho relativo."""
+    def __init__(self, erros):
+        super().__init__("Erro de validação")
+        self.erros = erros
+
+def texto(tamanho_max=None):
+    def converter(valor):
+        if isinstance(valor, (int, float)) and not isinstance(valor, bool):
+            valor = str(valor)
+        elif not isinstance(valor, str):
+            raise ValueError("Deve ser um texto.")
+        if tamanho_max and len(valor) > tamanho_max:
+            raise ValueError(f"Deve ter no máximo {tamanho_max} caracteres.")
+        return valor
+    return converter
+
+def inteiro(minimo=None, maximo=None):
+    def converter(valor):
+        if isinstance(valor, bool):
+            raise ValueError("Deve ser um número inteiro.")
+        if isinstance(valor, str) and valor.strip().lstrip('-').isdigit():
+            valor = int(valor)
+        if not isinstance(valor, int):
+            raise ValueError("Deve ser um número inteiro.")
+        if (minimo is not None and valor < minimo) or (maximo is not None and valor > maximo):
+            raise ValueError(f"Deve estar entre {minimo} e {maximo}." if maximo is not None else f"Deve ser no mínimo {minimo}.")
+        return valor
+    return converter
+
+def decimal(minimo=None):
+    def converter(valor):
+        if isinstance(valor, bool):
+            raise ValueError("Deve ser um número.")
+        if isinstance(valor, str):
+            valor = valor.strip()
+            if ',' in valor and '.' not in valor: # Aceita vírgula decimal ("150,50")
+                valor = valor.replace(',', '.')
+        try:
+            numero = float(valor)
+        except (TypeError, ValueError):
+            raise ValueError("Deve ser um número.")
+        if not math.isfinite(numero):
+            raise ValueError("Deve ser um número.")
+        if minimo is not None and numero < minimo:
+            raise ValueError(f"Deve ser no mínimo {minimo}.")
+        return numero
+    return converter
+
+def booleano(valor):
+    if isinstance(valor, bool):
+        return valor
+    if valor in (0, 1, '0', '1', 'true', 'false'):
+        return valor in (1, '1', 'true')
+    raise ValueError("Deve ser verdadeiro ou falso.")
+
+def data_aaaa_mm_dd(valor):
+    m = RE_DATA.match(valor) if isinstance(valor, str) else None
+    try:
+        return date(int(m[1]), int(m[2]), int(m[3]))
+    except (TypeError, ValueError):
+        raise ValueError("Formato de data inválido. Use YYYY-MM-DD.")
+
+def hora(valor):
+    """Hora no formato HH:MM, normalizada com dois dígitos (armazenada como texto)."""
+    m = RE_HORA.match(valor) if isinstance(valor, str) else None
+    if not m or int(m[1]) > 23 or int(m[2]) > 59:
+        raise ValueError("Formato de hora inválido. Use HH:MM.")
+    return f"{int(m[1]):02d}:{m[2]}"
+
+def escolha(*opcoes):
+    def converter(valor):
+        if valor not in opcoes:
+            raise ValueError(f"Valor inválido. Use {' ou '.join(repr(o) for o in opcoes)}.")
+        return valor
+    return converter
+
+def _validador_texto(funcao, tamanho_max):
+    converter_texto = texto(tamanho_max)
+    def converter(valor):
+        valor = converter_texto(valor)
+        if not funcao(valor):
+            raise ValueError("inválido")
+        return valor
+    return converter
+
+cpf_valido = _validador_texto(is_valid_cpf, 14)
+email_valido = _validador_texto(is_valid_email, 100)
+telefone_valido = _validador_texto(is_valid_phone, 20)
+
+def lista(conversor_item, minimo=0, maximo=None):
+    def converter(valor):
+        if not isinstance(valor, list):
+            raise ValueError("Deve ser uma lista.")
+        if len(valor) < minimo or (maximo is not None and len(valor) > maximo):
+            raise ValueError(f"Deve ter entre {minimo} e {maximo} itens." if maximo is not None else f"Deve ter no mínimo {minimo} item(ns).")
+        itens, erros = [], {}
+        for i, item in enumerate(valor):
+            try:
+                itens.append(conversor_item(item))
+            except ErrosValidacao as e:
+                erros.update((f"[{i}].{campo}", msg) for campo, msg in e.erros.items())
+            except ValueError as e:
+                erros[f"[{i}]"] = str(e)
+        if erros:
+            raise ErrosValidacao(erros)
+        return itens
+    return converter
+
+
+class Campo:
+    """Regra de um campo. `obrigatorio` pode ser a mensagem de erro; `mensagem` substitui a do conversor."""
+    def __init__(self, conversor=texto(), obrigatorio=False, padrao=None, mensagem=None):
+        self.conversor = conversor
+        self.obrigatorio = "Campo obrigatório." if obrigatorio is True else obrigatorio
+        self.padrao = padrao
+        self.mensagem = mensagem
+
+
+class Esquema:
+    """Conjunto de campos compilado na importação para validar payloads inteiros.
+
+    validar() retorna (valores, erros). Valores vazios (None ou texto em branco) viram o
+    padrão do campo; com parcial=True, campos ausentes são ignorados (PUT/PATCH).
+    `regras` recebe os valores já convertidos e devolve erros entre campos.
+    """
+    def __init__(self, campos, regras=()):
+        self.campos = campos
+        self._compilado = tuple(
+            (nome, c.conversor, c.obrigatorio, c.padrao, c.mensagem) for nome, c in campos.items()
+        )
+        self._regras = tuple(regras)
+
+    def validar(self, dados, parcial=False, rejeitar_desconhecidos=False):
+        if not isinstance(dados, dict):
+            return {}, {"payload": "O corpo da requisição deve ser um objeto JSON."}
+        valores, erros = {}, {}
+        for nome, conversor, obrigatorio, padrao, mensagem in self._compilado:
+            if nome in dados:
+                valor = dados[nome]
+            elif parcial:
+                continue
+            else:
+                valor = None
+            if valor is None or (isinstance(valor, str) and not valor.strip()):
+                if obrigatorio:
+                    erros[nome] = obrigatorio
+                else:
+                    valores[nome] = padrao
+                continue
+            try:
+                valores[nome] = conversor(valor)
+            except ErrosValidacao as e:
+                erros.update((f"{nome}{caminho if caminho[0] == '[' else '.' + caminho}", msg) for caminho, msg in e.erros.items())
+            except ValueError as e:
+                erros[nome] = mensagem or str(e)
+        if rejeitar_desconhecidos:
+            erros.update((nome, "Campo desconhecido ou não editável.") for nome in dados if nome not in self.campos)
+        if not erros and not parcial:
+            for regra in self._regras:
+                erros.update(regra(valores))
+        return valores, erros
+
+    def __call__(self, valor):
+        """Permite usar o esquema como conversor de objetos aninhados (ex.: lista(Esquema(...)))."""
+        valores, erros = self.validar(valor)
+        if erros:
+            raise ErrosValidacao(erros)
+        return valores
+
+
+def resposta_erro_validacao(erros):
+    mensagens = list(erros.values())
+    resumo = " ".join(mensagens[:5]) + (f" (e mais {len(mensagens) - 5} erro(s))" if len(mensagens) > 5 else "")
+    return jsonify({"success": False, "message": f"Erro de validação: {resumo}", "errors": erros}), 400
+
+
+def formatar_nome_completo(nome, sobrenome):
+    return f"{nome} {sobrenome}" if sobrenome else (nome or '')
+
+
+# --- Compressão em Repouso ---
+# Anotações do histórico a partir de COMPRESS_MIN_BYTES são gravadas comprimidas (zlib) no
+# SQLite: a coluna continua TEXT, mas o SQLite guarda o valor como BLOB, e o tipo abaixo o
+# descomprime na leitura. Registros antigos (texto) continuam legíveis sem migração. No MySQL o
+# valor fica em texto puro, pois o índice FULLTEXT precisa dele (lá, use ROW_FORMAT=COMPRESSED).
+# Anexos de tipos que comprimem bem são guardados em uploads/ como <nome>.gz e descomprimidos
+# em streaming ao serem servidos; o conteúdo volta idêntico, byte a byte.
+SUFIXO_ANEXO_COMPRIMIDO = '.gz'
+EXTENSOES_ANEXO_COMPRIMIVEIS = {'.dcm', '.bmp', '.tif', '.tiff', '.stl', '.obj', '.ply', '.txt', '.csv', '.xml', '.json', '.svg'}
+
+def _vale_comprimir(tamanho_original, tamanho_comprimido):
+    return tamanho_comprimido < tamanho_original * 0.9 # Ao menos 10% menor
+
+class TextoComprimido(db.TypeDecorator):
+    impl = db.Text
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        limite = app.config['COMPRESS_MIN_BYTES']
+        if value is None or dialect.name != 'sqlite' or limite <= 0 or len(value) < limite // 4:
+            return value
+        dados = value.encode('utf-8')
+        if len(dados) < limite:
+            return value
+        comprimido = zlib.compress(dados, 6)
+        return comprimido if _vale_comprimir(len(dados), len(comprimido)) else value
+
+    def process_result_value(self, value, dialect):
+        return zlib.decompress(value).decode('utf-8') if isinstance(value, bytes) else value
+
+def comprimir_anexo(caminho):
+    """Substitui o arquivo por <caminho>.gz se o tipo for compressível e a compressão valer a pena."""
+    tamanho = os.path.getsize(caminho)
+    limite = app.config['COMPRESS_MIN_BYTES']
+    if (limite <= 0 or tamanho < limite
+            or os.path.splitext(caminho)[1].lower() not in EXTENSOES_ANEXO_COMPRIMIVEIS):
+        return False
+    temporario = caminho + SUFIXO_ANEXO_COMPRIMIDO + '.tmp'
+    try:
+        with open(caminho, 'rb') as original, gzip.open(temporario, 'wb', compresslevel=6) as destino:
+            shutil.copyfileobj(original, destino, 1024 * 1024)
+        if not _vale_comprimir(tamanho, os.path.getsize(temporario)):
+            os.remove(temporario)
+            return False
+        os.replace(temporario, caminho + SUFIXO_ANEXO_COMPRIMIDO)
+    except BaseException:
+        if os.path.exists(temporario):
+            os.remove(temporario)
+        raise
+    os.remove(caminho)
+    return True
+
+def _servir_anexo_comprimido(caminho, nome):
+    """Resposta em streaming com o conteúdo original de <caminho> (gzip), sem descomprimir em disco."""
+    estatistica = os.stat(caminho)
+    with open(caminho, 'rb') as arquivo:
+        arquivo.seek(-4, os.SEEK_END)
+        tamanho_original = int.from_bytes(arquivo.read(4), 'little') # ISIZE do gzip (anexos < 4 GiB)
+
+    def blocos():
+        with gzip.open(caminho, 'rb') as arquivo:
+            while True:
+                bloco = arquivo.read(64 * 1024)
+                if not bloco:
+                    break
+                yield bloco
+
+    resposta = Response(blocos(), mimetype=mimetypes.guess_type(nome)[0] or 'application/octet-stream')
+    resposta.content_length = tamanho_original
+    resposta.set_etag(f"{nome}-{int(estatistica.st_mtime)}-{estatistica.st_size}")
+    resposta.last_modified = datetime.fromtimestamp(estatistica.st_mtime, timezone.utc)
+    return resposta.make_conditional(request)
 
 
 # Models
-class Usuario(db.Model):
+class ExclusaoLogicaMixin:
+    # Registros com deleted_at preenchido ficam ocultos em todas as consultas (ver _filtrar_excluidos)
+    # até que a limpeza em segundo plano os remova definitivamente.
+    deleted_at = db.Column(db.DateTime, nullable=True, index=True)
+
+# --- Clínicas ---
+# Cada clínica atendida pelo backend é um inquilino: usuários, pacientes, agendamentos,
+# pagamentos, orçamentos e históricos pertencem a uma clínica (clinica_id, que lidera os
+# índices compostos dessas tabelas). O token JWT carrega a clínica do usuário e as consultas
+# do ORM feitas durante a requisição recebem o filtro automaticamente (ver _filtrar_clinica),
+# de modo que cada clínica percorre apenas a própria fatia dos índices, qualquer que seja o
+# volume das outras. Bancos anteriores às clínicas têm tudo migrado para CLINICA_PADRAO_ID.
+CLINICA_PADRAO_ID = 1
+NOME_CLINICA_PADRAO = "Dr. Lucca Spinelli"
+
+class Clinica(db.Model):
+    __tablename__ = 'clinicas'
+    id = db.Column(db.Integer, primary_key=True)
+    nome = db.Column(db.String(100), nullable=False, unique=True)
+    criado_em = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc))
+
+    def to_dict(self):
+        return {'id': self.id, 'nome': self.nome}
+
+class PertenceAClinicaMixin:
+    @declared_attr
+    def clinica_id(cls):
+        # Preenchido a partir do token no flush (ver _atribuir_clinica); o padrão cobre scripts e CLI
+        return db.Column(db.Integer, db.ForeignKey('clinicas.id'), nullable=False, default=CLINICA_PADRAO_ID)
+
+class Usuario(PertenceAClinicaMixin, db.Model):
     __tablename__ = 'usuarios'
+    __table_args__ = (
+        db.Index('ix_usuarios_clinica_perfil', 'clinica_id', 'perfil'), # Lista de dentistas da clínica
+    )
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(80), unique=True, nullable=False) # Novo campo
     nome = db.Column(db.String(100), nullable=False)
@@ -117,11 +704,16 @@ class Usuario(db.Model):
             'nome': self.nome, # 'nome' é usado como nome completo para exibição
             'email': self.email,
             'perfil': self.perfil,
-            'status': self.status # Adicionado status
+            'status': self.status, # Adicionado status
+            'clinica_id': self.clinica_id
         }
 
-class Paciente(db.Model): # Renomeado de Patient para Paciente
+class Paciente(ExclusaoLogicaMixin, PertenceAClinicaMixin, db.Model): # Renomeado de Patient para Paciente
     __tablename__ = 'pacientes' # Nome da tabela explicitamente definido
+    __table_args__ = (
+        db.Index('ix_pacientes_clinica_nome', 'clinica_id', 'nome_completo'), # Lista e busca por nome na clínica
+        db.UniqueConstraint('clinica_id', 'cpf', name='uq_pacientes_clinica_cpf'), # O mesmo paciente pode estar em duas clínicas
+    )
     id = db.Column(db.Integer, primary_key=True)
     
     # Dados Cadastrais
@@ -129,7 +721,7 @@ class Paciente(db.Model): # Renomeado de Patient para Paciente
     sobrenome = db.Column(db.String(100), nullable=True)
     data_nascimento = db.Column(db.Date, nullable=True)
     sexo = db.Column(db.String(10), nullable=True)
-    cpf = db.Column(db.String(14), nullable=True, unique=True)
+    cpf = db.Column(db.String(14), nullable=True)
     rg = db.Column(db.String(20), nullable=True)
     estado_civil = db.Column(db.String(20), nullable=True)
     escolaridade = db.Column(db.String(50), nullable=True)
@@ -180,11 +772,19 @@ class Paciente(db.Model): # Renomeado de Patient para Paciente
 
     is_fully_registered = db.Column(db.Boolean, default=False, nullable=False)
 
+    # Cache de "nome sobrenome" mantido pelos eventos do ORM (ver _sincronizar_nome_completo)
+    nome_completo = db.Column(db.String(201), nullable=True)
+
+    # Controle de concorrência otimista: incrementado a cada UPDATE; usado como ETag
+    versao = db.Column(db.Integer, nullable=False, default=1)
+    __mapper_args__ = {'version_id_col': versao}
+
     def to_dict(self):
         return {
             'id': self.id,
             'nome': self.nome,
             'sobrenome': self.sobrenome,
+            'nome_completo': self.nome_completo,
             'data_nascimento': self.data_nascimento.isoformat() if self.data_nascimento else None,
             'sexo': self.sexo,
             'cpf': self.cpf,
@@ -225,11 +825,17 @@ class Paciente(db.Model): # Renomeado de Patient para Paciente
             'rg_representante': self.rg_representante,
             'telefone_representante': self.telefone_representante,
             'nascimento_representante': self.nascimento_representante,
-            'is_fully_registered': self.is_fully_registered
+            'is_fully_registered': self.is_fully_registered,
+            'versao': self.versao
         }
 
-class Pagamento(db.Model):
+class Pagamento(PertenceAClinicaMixin, db.Model):
     __tablename__ = 'pagamentos'
+    __table_args__ = (
+        db.Index('ix_pagamentos_status_data', 'clinica_id', 'status', 'data_pagamento'), # Fila de aprovação
+        db.Index('ix_pagamentos_paciente', 'paciente_id'),
+        db.Index('ix_pagamentos_dentista', 'dentista_id'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     paciente_id = db.Column(db.Integer, db.ForeignKey('pacientes.id'), nullable=False)
     dentista_id = db.Column(db.Integer, db.ForeignKey('usuarios.id'), nullable=False) # Quem registrou/realizou o procedimento
@@ -239,30 +845,36 @@ class Pagamento(db.Model):
     aprovado_por_id = db.Column(db.Integer, db.ForeignKey('usuarios.id'), nullable=True) # Admin que aprovou/rejeitou
     data_acao_aprovacao = db.Column(db.DateTime, nullable=True)
 
+    # Nomes copiados de Paciente/Usuario para listar sem joins; mantidos pelos eventos do ORM
+    paciente_nome = db.Column(db.String(201), nullable=True)
+    dentista_nome = db.Column(db.String(100), nullable=True)
+    aprovado_por_nome = db.Column(db.String(100), nullable=True)
+
     paciente = db.relationship('Paciente', backref=db.backref('pagamentos', lazy=True))
     # dentista = db.relationship('Usuario', foreign_keys=[dentista_id], backref=db.backref('pagamentos_realizados', lazy=True))
     # aprovado_por = db.relationship('Usuario', foreign_keys=[aprovado_por_id], backref=db.backref('pagamentos_processados', lazy=True))
 
 
     def to_dict(self):
-        dentista_responsavel = Usuario.query.get(self.dentista_id)
-        admin_acao = Usuario.query.get(self.aprovado_por_id) if self.aprovado_por_id else None
         return {
             'id': self.id,
             'paciente_id': self.paciente_id,
-            'paciente_nome': f"{self.paciente.nome} {self.paciente.sobrenome or ''}" if self.paciente else "Paciente não encontrado",
+            'paciente_nome': self.paciente_nome or "Paciente não encontrado",
             'dentista_id': self.dentista_id,
-            'dentista_nome': dentista_responsavel.nome if dentista_responsavel else "Dentista não encontrado",
+            'dentista_nome': self.dentista_nome or "Dentista não encontrado",
             'valor': self.valor,
             'data_pagamento': self.data_pagamento.isoformat(),
             'status': self.status,
             'aprovado_por_id': self.aprovado_por_id,
-            'aprovado_por_nome': admin_acao.nome if admin_acao else None,
+            'aprovado_por_nome': self.aprovado_por_nome,
             'data_acao_aprovacao': self.data_acao_aprovacao.isoformat() if self.data_acao_aprovacao else None
         }
 
-class Budget(db.Model):
+class Budget(PertenceAClinicaMixin, db.Model):
     __tablename__ = 'budgets'
+    __table_args__ = (
+        db.Index('ix_budgets_patient', 'patient_id'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     patient_id = db.Column(db.Integer, db.ForeignKey('pacientes.id'), nullable=False) # Alterado para 'pacientes.id'
     patient = db.relationship('Paciente', backref=db.backref('budgets', lazy=True)) # Alterado para 'Paciente'
@@ -276,7 +888,7 @@ class Budget(db.Model):
         return {
             'id': self.id,
             'patient_id': self.patient_id,
-            'patient_name': f"{self.patient.nome} {self.patient.sobrenome or ''}" if self.patient else "Paciente não encontrado",
+            'patient_name': self.patient.nome_completo if self.patient else "Paciente não encontrado",
             'clinic_name': self.clinic_name,
             'observations': self.observations,
             'total_value': self.total_value,
@@ -287,6 +899,9 @@ class Budget(db.Model):
 
 class BudgetProcedure(db.Model):
     __tablename__ = 'budget_procedures'
+    __table_args__ = (
+        db.Index('ix_budget_procedures_budget', 'budget_id'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     budget_id = db.Column(db.Integer, db.ForeignKey('budgets.id'), nullable=False) # Alterado para 'budgets.id'
     budget = db.relationship('Budget', backref=db.backref('procedures', lazy=True))
@@ -307,8 +922,14 @@ class BudgetProcedure(db.Model):
             'value': self.value
         }
 
-class Appointment(db.Model):
+class Appointment(PertenceAClinicaMixin, db.Model):
     __tablename__ = 'appointments'
+    __table_args__ = (
+        db.Index('ix_appointments_dentista_data', 'clinica_id', 'dentista_id', 'appointment_date'), # Agenda e verificação de conflitos
+        db.Index('ix_appointments_data', 'clinica_id', 'appointment_date'), # Agenda do dia (admin vê todos os dentistas)
+        db.Index('ix_appointments_patient', 'patient_id'),
+        db.Index('ix_appointments_dentista', 'dentista_id'), # Chave estrangeira (o MySQL exige um índice iniciado por ela)
+    )
     id = db.Column(db.Integer, primary_key=True)
     patient_id = db.Column(db.Integer, db.ForeignKey('pacientes.id'), nullable=False) # Alterado para 'pacientes.id'
     dentista_id = db.Column(db.Integer, db.ForeignKey('usuarios.id'), nullable=False) # Novo campo
@@ -320,36 +941,35 @@ class Appointment(db.Model):
     duration_minutes = db.Column(db.Integer, nullable=False, default=30)
     created_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc))
 
-    def to_dict(self):
-        paciente_nome_completo = "Paciente não encontrado"
-        if self.patient:
-            paciente_nome_completo = self.patient.nome
-            if self.patient.sobrenome:
-                paciente_nome_completo += ' ' + self.patient.sobrenome
-        
-        dentista_obj = Usuario.query.get(self.dentista_id)
-        dentista_nome = dentista_obj.nome if dentista_obj else "Dentista não informado"
+    # Dados de Paciente/Usuario copiados para listar sem joins; mantidos pelos eventos do ORM
+    patient_name = db.Column(db.String(201), nullable=True)
+    patient_is_fully_registered = db.Column(db.Boolean, nullable=True)
+    dentista_nome = db.Column(db.String(100), nullable=True)
 
+    def to_dict(self):
         return {
             'id': self.id,
             'patient_id': self.patient_id,
-            'patient_name': paciente_nome_completo,
+            'patient_name': self.patient_name or "Paciente não encontrado",
             'dentista_id': self.dentista_id,
-            'dentista_nome': dentista_nome,
+            'dentista_nome': self.dentista_nome or "Dentista não informado",
             'appointment_date': self.appointment_date.isoformat(),
             'appointment_time': self.appointment_time,
             'observacao': self.observacao, 
             'duration_minutes': self.duration_minutes,
             'created_at': self.created_at.isoformat(),
-            'patient_is_fully_registered': self.patient.is_fully_registered if self.patient else False 
+            'patient_is_fully_registered': bool(self.patient_is_fully_registered)
         }
 
-class HistoricoPaciente(db.Model):
+class HistoricoPaciente(ExclusaoLogicaMixin, PertenceAClinicaMixin, db.Model):
     __tablename__ = 'historico_pacientes'
+    __table_args__ = (
+        db.Index('ix_historico_pacientes_patient_data', 'patient_id', 'created_at'), # Linha do tempo do paciente
+    )
     id = db.Column(db.Integer, primary_key=True)
     patient_id = db.Column(db.Integer, db.ForeignKey('pacientes.id'), nullable=False) # Alterado para 'pacientes.id'
     patient = db.relationship('Paciente', backref=db.backref('historicos', lazy=True)) # Alterado para 'Paciente'
-    historico = db.Column(db.Text, nullable=True)
+    historico = db.Column(TextoComprimido, nullable=True) # Comprimido a partir de COMPRESS_MIN_BYTES (SQLite)
     arquivo_nome = db.Column(db.String(255), nullable=True)
     arquivo_tipo = db.Column(db.String(100), nullable=True)
     arquivo_tamanho = db.Column(db.Integer, nullable=True)
@@ -366,6 +986,1828 @@ class HistoricoPaciente(db.Model):
             'created_at': self.created_at.isoformat() if self.created_at else None
         }
 
+# --- Sincronização dos nomes desnormalizados ---
+@event.listens_for(Paciente, 'before_insert')
+@event.listens_for(Paciente, 'before_update')
+def _sincronizar_nome_completo(mapper, connection, target):
+    target.nome_completo = formatar_nome_completo(target.nome, target.sobrenome)
+
+TABELAS_COM_NOMES_COPIADOS = {'appointments', 'pagamentos', 'appointments_arquivo', 'pagamentos_arquivo'}
+
+@event.listens_for(Paciente, 'after_update')
+def _propagar_dados_paciente(mapper, connection, target):
+    estado = inspect(target)
+    if not any(estado.attrs[campo].history.has_changes() for campo in ('nome', 'sobrenome', 'is_fully_registered')):
+        return
+    # Um único UPDATE por tabela, independente de quantos agendamentos/pagamentos o paciente tenha
+    connection.execute(update(Appointment).where(Appointment.patient_id == target.id).values(
+        patient_name=target.nome_completo, patient_is_fully_registered=target.is_fully_registered
+    ))
+    connection.execute(update(Pagamento).where(Pagamento.paciente_id == target.id).values(paciente_nome=target.nome_completo))
+    connection.execute(update(AppointmentArquivado).where(AppointmentArquivado.patient_id == target.id).values(
+        patient_name=target.nome_completo, patient_is_fully_registered=target.is_fully_registered
+    ))
+    connection.execute(update(PagamentoArquivado).where(PagamentoArquivado.paciente_id == target.id).values(paciente_nome=target.nome_completo))
+    marcar_agendas_do_paciente(connection, target.id) # O nome do paciente aparece no feed .ics
+    # UPDATEs pela conexão não passam pelo rastreamento de tabelas do cache de respostas
+    _marcar_tabelas_alteradas(object_session(target), TABELAS_COM_NOMES_COPIADOS)
+
+@event.listens_for(Usuario, 'after_update')
+def _propagar_nome_usuario(mapper, connection, target):
+    if not inspect(target).attrs.nome.history.has_changes():
+        return
+    # Os registros de um usuário são todos da clínica dele; o filtro mantém o UPDATE no índice da clínica
+    connection.execute(update(Appointment).where(Appointment.clinica_id == target.clinica_id, Appointment.dentista_id == target.id)
+                       .values(dentista_nome=target.nome))
+    connection.execute(update(Pagamento).where(Pagamento.dentista_id == target.id).values(dentista_nome=target.nome))
+    connection.execute(update(Pagamento).where(Pagamento.aprovado_por_id == target.id).values(aprovado_por_nome=target.nome))
+    connection.execute(update(AppointmentArquivado).where(AppointmentArquivado.clinica_id == target.clinica_id,
+                                                          AppointmentArquivado.dentista_id == target.id).values(dentista_nome=target.nome))
+    connection.execute(update(PagamentoArquivado).where(PagamentoArquivado.dentista_id == target.id).values(dentista_nome=target.nome))
+    connection.execute(update(PagamentoArquivado).where(PagamentoArquivado.aprovado_por_id == target.id).values(aprovado_por_nome=target.nome))
+    marcar_agendas_alteradas(connection, FeedAgenda.dentista_id == target.id)
+    _marcar_tabelas_alteradas(object_session(target), TABELAS_COM_NOMES_COPIADOS)
+
+def _nome_usuario(connection, usuario_id):
+    if not usuario_id:
+        return None
+    return connection.execute(select(Usuario.nome).where(Usuario.id == usuario_id)).scalar()
+
+@event.listens_for(Appointment, 'before_insert')
+@event.listens_for(Appointment, 'before_update')
+def _copiar_nomes_agendamento(mapper, connection, target):
+    estado = inspect(target)
+    if estado.attrs.patient_id.history.has_changes() or target.patient_name is None:
+        paciente = connection.execute(
+            select(Paciente.nome_completo, Paciente.is_fully_registered).where(Paciente.id == target.patient_id)
+        ).first()
+        if paciente:
+            target.patient_name, target.patient_is_fully_registered = paciente
+    if estado.attrs.dentista_id.history.has_changes() or target.dentista_nome is None:
+        target.dentista_nome = _nome_usuario(connection, target.dentista_id)
+
+@event.listens_for(Pagamento, 'before_insert')
+@event.listens_for(Pagamento, 'before_update')
+def _copiar_nomes_pagamento(mapper, connection, target):
+    estado = inspect(target)
+    if estado.attrs.paciente_id.history.has_changes() or target.paciente_nome is None:
+        target.paciente_nome = connection.execute(
+            select(Paciente.nome_completo).where(Paciente.id == target.paciente_id)
+        ).scalar()
+    if estado.attrs.dentista_id.history.has_changes() or target.dentista_nome is None:
+        target.dentista_nome = _nome_usuario(connection, target.dentista_id)
+    if estado.attrs.aprovado_por_id.history.has_changes():
+        target.aprovado_por_nome = _nome_usuario(connection, target.aprovado_por_id)
+
+
+# --- Busca Textual no Histórico ---
+# SQLite: tabela FTS5 historico_fts (rowid = historico_pacientes.id), mantida pelos eventos abaixo.
+# MySQL: índice FULLTEXT ft_historico_pacientes_historico, mantido pelo próprio InnoDB.
+# Outros bancos: busca por LIKE, sem ranking.
+MARCA_INICIO, MARCA_FIM = '\x02', '\x03' # Delimitadores do trecho destacado, trocados por <mark> após o escape HTML
+
+def _termos_busca(consulta):
+    return re.findall(r'\w+', consulta or '', re.UNICODE)
+
+def _fts_disponivel(connection):
+    if connection.dialect.name != 'sqlite':
+        return False
+    return connection.execute(text("SELECT 1 FROM sqlite_master WHERE name = 'historico_fts'")).first() is not None
+
+def _trecho_destacado(texto, termos, raio=60):
+    """Recorta o texto em volta do primeiro termo encontrado e marca todas as ocorrências dos termos."""
+    texto = texto or ''
+    padrao = re.compile('|'.join(re.escape(t) for t in termos), re.IGNORECASE) if termos else None
+    achado = padrao.search(texto) if padrao else None
+    inicio = max(0, achado.start() - raio) if achado else 0
+    fim = min(len(texto), (achado.end() if achado else 0) + raio)
+    trecho = ('…' if inicio > 0 else '') + texto[inicio:fim] + ('…' if fim < len(texto) else '')
+    if padrao:
+        trecho = padrao.sub(lambda m: f"{MARCA_INICIO}{m.group(0)}{MARCA_FIM}", trecho)
+    return trecho
+
+def _trecho_html(trecho):
+    return html.escape(trecho).replace(MARCA_INICIO, '<mark>').replace(MARCA_FIM, '</mark>')
+
+@event.listens_for(HistoricoPaciente, 'after_insert')
+def _indexar_historico(mapper, connection, target):
+    if target.historico and _fts_disponivel(connection):
+        connection.execute(text("INSERT INTO historico_fts(rowid, historico) VALUES (:id, :historico)"),
+                           {'id': target.id, 'historico': target.historico})
+
+@event.listens_for(HistoricoPaciente, 'after_update')
+def _reindexar_historico(mapper, connection, target):
+    if inspect(target).attrs.historico.history.has_changes() and _fts_disponivel(connection):
+        connection.execute(text("DELETE FROM historico_fts WHERE rowid = :id"), {'id': target.id})
+        _indexar_historico(mapper, connection, target)
+
+@event.listens_for(HistoricoPaciente, 'after_delete')
+def _remover_historico_indice(mapper, connection, target):
+    if _fts_disponivel(connection):
+        connection.execute(text("DELETE FROM historico_fts WHERE rowid = :id"), {'id': target.id})
+
+def criar_indice_busca_historico(conn):
+    if conn.dialect.name == 'sqlite':
+        conn.execute(text(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS historico_fts USING fts5(historico, tokenize = 'unicode61 remove_diacritics 2')"
+        ))
+    elif conn.dialect.name == 'mysql':
+        indices = {i['name'] for i in inspect(conn).get_indexes('historico_pacientes')}
+        if 'ft_historico_pacientes_historico' not in indices:
+            conn.execute(text("ALTER TABLE historico_pacientes ADD FULLTEXT INDEX ft_historico_pacientes_historico (historico)"))
+
+def reconstruir_indice_busca_historico(conn):
+    """Recria o índice de busca a partir de historico_pacientes. Retorna o número de registros indexados."""
+    if conn.dialect.name == 'sqlite':
+        criar_indice_busca_historico(conn)
+        conn.execute(text("DELETE FROM historico_fts"))
+        total = conn.execute(text(
+            "INSERT INTO historico_fts(rowid, historico) SELECT id, historico FROM historico_pacientes WHERE typeof(historico) = 'text'"
+        )).rowcount
+        # Anotações comprimidas (BLOB) passam pelo tipo da coluna para serem indexadas em texto
+        tabela = HistoricoPaciente.__table__
+        comprimidas = conn.execute(select(tabela.c.id, tabela.c.historico).where(func.typeof(tabela.c.historico) == 'blob'))
+        for lote in comprimidas.partitions(500):
+            conn.execute(text("INSERT INTO historico_fts(rowid, historico) VALUES (:id, :historico)"),
+                         [{'id': id_, 'historico': historico} for id_, historico in lote])
+            total += len(lote)
+        return total
+    if conn.dialect.name == 'mysql':
+        indices = {i['name'] for i in inspect(conn).get_indexes('historico_pacientes')}
+        if 'ft_historico_pacientes_historico' in indices:
+            conn.execute(text("ALTER TABLE historico_pacientes DROP INDEX ft_historico_pacientes_historico"))
+        criar_indice_busca_historico(conn)
+    return conn.execute(select(func.count(HistoricoPaciente.id)).where(HistoricoPaciente.historico.isnot(None))).scalar()
+
+
+# --- Isolamento por Clínica ---
+# token_required guarda em g.clinica_id a clínica do token; a partir daí todo SELECT, UPDATE e
+# DELETE do ORM na sessão só enxerga as linhas dessa clínica, e os objetos novos são gravados
+# nela. Fora de requisições autenticadas (CLI, limpeza em segundo plano, login) não há filtro.
+# SQL textual e comandos na conexão (busca no histórico, eventos de sincronização) filtram por
+# conta própria; o UPDATE em lote por chave primária não recebe o filtro, então os ids devem
+# vir de uma consulta já filtrada. Para consultas entre clínicas, use a opção todas_as_clinicas.
+def clinica_atual():
+    return g.get('clinica_id') if has_app_context() else None
+
+@event.listens_for(db.session, 'do_orm_execute')
+def _filtrar_clinica(execute_state):
+    clinica_id = clinica_atual()
+    if (clinica_id is None or execute_state.is_column_load or execute_state.is_relationship_load
+            or not (execute_state.is_select or execute_state.is_update or execute_state.is_delete)
+            or execute_state.execution_options.get('todas_as_clinicas', False)):
+        return
+    execute_state.statement = execute_state.statement.options(*(
+        with_loader_criteria(modelo, lambda cls: cls.clinica_id == clinica_id, include_aliases=True)
+        for modelo in (PertenceAClinicaMixin, AppointmentArquivado, PagamentoArquivado, RegistroAuditoria)
+    ))
+
+@event.listens_for(db.session, 'before_flush')
+def _atribuir_clinica(session, flush_context, instances):
+    clinica_id = clinica_atual()
+    if clinica_id is None:
+        return
+    for obj in session.new:
+        if isinstance(obj, PertenceAClinicaMixin):
+            obj.clinica_id = clinica_id
+
+
+# --- Exclusão Lógica e Limpeza em Segundo Plano ---
+@event.listens_for(db.session, 'do_orm_execute')
+def _filtrar_excluidos(execute_state):
+    if (execute_state.is_select and not execute_state.is_column_load and not execute_state.is_relationship_load
+            and not execute_state.execution_options.get('incluir_excluidos', False)):
+        execute_state.statement = execute_state.statement.options(
+            with_loader_criteria(ExclusaoLogicaMixin, lambda cls: cls.deleted_at.is_(None), include_aliases=True),
+            # Agendamentos e pagamentos de pacientes excluídos somem junto com o paciente, antes de a
+            # limpeza removê-los. A subconsulta usa a tabela (não o model) para escapar do filtro
+            # acima e percorre só os excluídos ainda não removidos, pelo ix_pacientes_deleted_at.
+            *(with_loader_criteria(modelo, lambda cls: _do_paciente(cls).not_in(_ids_pacientes_excluidos()), include_aliases=True)
+              for modelo in (Appointment, AppointmentArquivado, Pagamento, PagamentoArquivado)),
+        )
+
+def _do_paciente(modelo):
+    return modelo.patient_id if hasattr(modelo, 'patient_id') else modelo.paciente_id
+
+def _ids_pacientes_excluidos():
+    pacientes = Paciente.__table__
+    return select(pacientes.c.id).where(pacientes.c.deleted_at.isnot(None))
+
+def _excluir_em_lotes(conn, tabela, condicao, tamanho_lote):
+    """DELETE em lotes pequenos (uma transação por lote) para não bloquear tabelas grandes."""
+    total = 0
+    while True:
+        with conn.begin():
+            ids = conn.execute(select(tabela.c.id).where(condicao).limit(tamanho_lote)).scalars().all()
+            if not ids:
+                return total
+            if tabela.name == 'historico_pacientes' and _fts_disponivel(conn):
+                conn.execute(text("DELETE FROM historico_fts WHERE rowid IN :ids").bindparams(bindparam('ids', expanding=True)),
+                             {'ids': ids})
+            conn.execute(tabela.delete().where(tabela.c.id.in_(ids)))
+        total += len(ids)
+
+def remover_arquivos_orfaos(conn, idade_minima_s=3600):
+    """Apaga de uploads/ os arquivos que nenhum histórico referencia (ignora os recém-enviados)."""
+    if not os.path.isdir(UPLOAD_DIR):
+        return 0
+    referenciados = set(conn.execute(
+        select(HistoricoPaciente.arquivo_nome).where(HistoricoPaciente.arquivo_nome.isnot(None))
+    ).scalars())
+    limite = time.time() - idade_minima_s
+    removidos = 0
+    for entrada in os.scandir(UPLOAD_DIR):
+        nome = entrada.name[:-len(SUFIXO_ANEXO_COMPRIMIDO)] if entrada.name.endswith(SUFIXO_ANEXO_COMPRIMIDO) else entrada.name
+        if entrada.is_file() and nome not in referenciados and entrada.stat().st_mtime < limite:
+            os.remove(entrada.path)
+            removidos += 1
+    return removidos
+
+def executar_limpeza(tamanho_lote=None):
+    """Remove definitivamente pacientes/históricos excluídos logicamente e seus dependentes,
+    além das chaves de idempotência expiradas."""
+    tamanho_lote = tamanho_lote or app.config['CLEANUP_BATCH_SIZE']
+    resumo = {'pacientes': 0, 'dependentes': 0, 'historicos': 0, 'arquivos': 0, 'chaves_idempotencia': 0}
+    paciente, historico = Paciente.__table__, HistoricoPaciente.__table__
+    budget, procedimento = Budget.__table__, BudgetProcedure.__table__
+    with db.engine.connect() as conn:
+        while True:
+            ids_pacientes = conn.execute(
+                select(paciente.c.id).where(paciente.c.deleted_at.isnot(None)).limit(tamanho_lote)
+            ).scalars().all()
+            conn.rollback()
+            if not ids_pacientes:
+                break
+            orcamentos = select(budget.c.id).where(budget.c.patient_id.in_(ids_pacientes))
+            resumo['dependentes'] += _excluir_em_lotes(conn, procedimento, procedimento.c.budget_id.in_(orcamentos), tamanho_lote)
+            resumo['dependentes'] += _excluir_em_lotes(conn, budget, budget.c.patient_id.in_(ids_pacientes), tamanho_lote)
+            for tabela in (Appointment.__table__, Pagamento.__table__, AppointmentArquivado.__table__, PagamentoArquivado.__table__):
+                coluna = tabela.c.patient_id if 'patient_id' in tabela.c else tabela.c.paciente_id
+                resumo['dependentes'] += _excluir_em_lotes(conn, tabela, coluna.in_(ids_pacientes), tamanho_lote)
+            resumo['dependentes'] += _excluir_em_lotes(conn, historico, historico.c.patient_id.in_(ids_pacientes), tamanho_lote)
+            resumo['pacientes'] += _excluir_em_lotes(conn, paciente, paciente.c.id.in_(ids_pacientes), tamanho_lote)
+
+        if resumo['dependentes']:
+            with conn.begin():
+                marcar_agendas_alteradas(conn)
+        resumo['historicos'] = _excluir_em_lotes(conn, historico, historico.c.deleted_at.isnot(None), tamanho_lote)
+        resumo['arquivos'] = remover_arquivos_orfaos(conn)
+        if resumo['pacientes'] or resumo['dependentes'] or resumo['historicos']:
+            cache_respostas.invalidar({'pacientes', 'appointments', 'pagamentos', 'budgets', 'historico_pacientes',
+                                       'appointments_arquivo', 'pagamentos_arquivo'})
+        chaves = ChaveIdempotencia.__table__
+        resumo['chaves_idempotencia'] = _excluir_em_lotes(
+            conn, chaves, chaves.c.expira_em <= datetime.now(timezone.utc), tamanho_lote)
+        conn.rollback()
+    return resumo
+
+def _loop_limpeza(intervalo):
+    while True:
+        time.sleep(intervalo)
+        try:
+            with app.app_context():
+                resumo = executar_limpeza()
+                arquivados = executar_arquivamento() if app.config['ARCHIVE_AFTER_DAYS'] > 0 else {}
+            if any(resumo.values()):
+                app.logger.info(f"Limpeza de excluídos: {resumo}")
+            if any(arquivados.values()):
+                app.logger.info(f"Arquivamento: {arquivados}")
+        except Exception as e:
+            app.logger.error(f"Erro na limpeza de registros excluídos: {str(e)}")
+
+def iniciar_limpeza_periodica():
+    intervalo = app.config['CLEANUP_INTERVAL_SECONDS']
+    if intervalo > 0:
+        threading.Thread(target=_loop_limpeza, args=(intervalo,), daemon=True, name='limpeza-excluidos').start()
+
+
+# --- Arquivamento de Agendamentos e Pagamentos Antigos ---
+# Agendamentos anteriores a ARCHIVE_AFTER_DAYS e pagamentos já processados (aprovados ou
+# rejeitados) desse período são movidos em lotes para appointments_arquivo e pagamentos_arquivo,
+# mantendo as tabelas usadas no dia a dia pequenas. A leitura da agenda consulta o arquivo só
+# quando o período pedido alcança a última data arquivada (ver buscar_agendamentos).
+def _tabela_arquivo(tabela, nome, *indices):
+    # Mesmas colunas e ids da tabela original, sem chaves estrangeiras nem autoincremento
+    colunas = [db.Column(c.name, c.type, primary_key=c.primary_key, nullable=c.nullable, autoincrement=False)
+               for c in tabela.columns]
+    return db.Table(nome, db.metadata, *colunas, *indices)
+
+class AppointmentArquivado(db.Model):
+    __table__ = _tabela_arquivo(
+        Appointment.__table__, 'appointments_arquivo',
+        db.Index('ix_appointments_arquivo_dentista_data', 'clinica_id', 'dentista_id', 'appointment_date'),
+        db.Index('ix_appointments_arquivo_data', 'clinica_id', 'appointment_date'),
+        db.Index('ix_appointments_arquivo_patient', 'patient_id'),
+    )
+
+    def to_dict(self):
+        return {**Appointment.to_dict(self), 'arquivado': True}
+
+class PagamentoArquivado(db.Model):
+    __table__ = _tabela_arquivo(
+        Pagamento.__table__, 'pagamentos_arquivo',
+        db.Index('ix_pagamentos_arquivo_data', 'clinica_id', 'data_pagamento'),
+        db.Index('ix_pagamentos_arquivo_paciente', 'paciente_id'),
+        db.Index('ix_pagamentos_arquivo_dentista', 'dentista_id'),
+    )
+
+    def to_dict(self):
+        return {**Pagamento.to_dict(self), 'arquivado': True}
+
+def _mover_em_lotes(conn, origem, destino, condicao, tamanho_lote):
+    """Copia para `destino` e apaga de `origem` as linhas da condição, uma transação por lote."""
+    colunas = [c.name for c in destino.columns]
+    total = 0
+    while True:
+        with conn.begin():
+            ids = conn.execute(select(origem.c.id).where(condicao).order_by(origem.c.id).limit(tamanho_lote)).scalars().all()
+            if not ids:
+                return total
+            conn.execute(destino.insert().from_select(
+                colunas, select(*(origem.c[nome] for nome in colunas)).where(origem.c.id.in_(ids))
+            ))
+            conn.execute(origem.delete().where(origem.c.id.in_(ids)))
+        total += len(ids)
+
+def executar_arquivamento(dias=None, tamanho_lote=None):
+    """Move para as tabelas de arquivo os agendamentos e pagamentos processados com mais de `dias` dias."""
+    dias = dias or app.config['ARCHIVE_AFTER_DAYS']
+    tamanho_lote = tamanho_lote or app.config['CLEANUP_BATCH_SIZE']
+    if dias <= 0:
+        return {'agendamentos': 0, 'pagamentos': 0}
+    limite = datetime.now(timezone.utc).date() - timedelta(days=dias)
+    agendamentos, pagamentos = Appointment.__table__, Pagamento.__table__
+    with db.engine.connect() as conn:
+        # O maior id fica na tabela original para que o autoincremento nunca reutilize um id já arquivado
+        maior_agendamento = conn.execute(select(func.max(agendamentos.c.id))).scalar() or 0
+        maior_pagamento = conn.execute(select(func.max(pagamentos.c.id))).scalar() or 0
+        conn.rollback()
+        resumo = {
+            'agendamentos': _mover_em_lotes(
+                conn, agendamentos, AppointmentArquivado.__table__,
+                (agendamentos.c.appointment_date < limite) & (agendamentos.c.id < maior_agendamento), tamanho_lote),
+            'pagamentos': _mover_em_lotes(
+                conn, pagamentos, PagamentoArquivado.__table__,
+                (pagamentos.c.status != 'pendente')
+                & (pagamentos.c.data_pagamento < datetime(limite.year, limite.month, limite.day))
+                & (pagamentos.c.id < maior_pagamento), tamanho_lote),
+        }
+    if any(resumo.values()):
+        cache_respostas.invalidar({'appointments', 'pagamentos', 'appointments_arquivo', 'pagamentos_arquivo'})
+    return resumo
+
+def buscar_agendamentos(dentista_id=None, inicio=None, fim=None):
+    """Agendamentos do período, ordenados por data e hora, incluindo os arquivados quando o período os alcança."""
+    def consulta(modelo):
+        query = modelo.query
+        if dentista_id:
+            query = query.filter(modelo.dentista_id == dentista_id)
+        if inicio:
+            query = query.filter(modelo.appointment_date >= inicio)
+        if fim:
+            query = query.filter(modelo.appointment_date <= fim)
+        return query.order_by(modelo.appointment_date, modelo.appointment_time)
+
+    agendamentos = consulta(Appointment).all()
+    ultima_arquivada = db.session.query(func.max(AppointmentArquivado.appointment_date)).scalar()
+    if ultima_arquivada and (inicio is None or inicio <= ultima_arquivada):
+        agendamentos = consulta(AppointmentArquivado).all() + agendamentos # Arquivados são sempre mais antigos
+    return agendamentos
+
+
+# --- Feed iCalendar da Agenda ---
+# Cada dentista pode gerar uma URL secreta (/api/agenda/<token>.ics) para assinar a própria
+# agenda no calendário do celular, cobrindo de ICS_FEED_DAYS_BEFORE dias atrás até
+# ICS_FEED_DAYS_AFTER dias à frente. A linha do feed guarda uma versão incrementada pelos
+# eventos do ORM sempre que um agendamento do dentista muda; a ETag é versão + início da
+# janela, então as consultas periódicas dos aplicativos de calendário recebem 304 após uma
+# única leitura por chave primária, e o .ics só é remontado quando a agenda muda.
+class FeedAgenda(db.Model):
+    __tablename__ = 'feeds_agenda'
+    dentista_id = db.Column(db.Integer, db.ForeignKey('usuarios.id'), primary_key=True, autoincrement=False)
+    token = db.Column(db.String(64), nullable=False, unique=True)
+    versao = db.Column(db.Integer, nullable=False, default=1)
+    alterado_em = db.Column(db.DateTime, nullable=False, default=lambda: datetime.now(timezone.utc))
+
+def marcar_agendas_alteradas(connection, condicao=None):
+    """Incrementa a versão dos feeds (de todos, sem `condicao`), invalidando a ETag."""
+    comando = update(FeedAgenda).values(versao=FeedAgenda.versao + 1, alterado_em=datetime.now(timezone.utc))
+    connection.execute(comando if condicao is None else comando.where(condicao))
+
+def marcar_agendas_do_paciente(connection, paciente_id):
+    marcar_agendas_alteradas(connection, FeedAgenda.dentista_id.in_(
+        select(Appointment.dentista_id).where(Appointment.patient_id == paciente_id).union(
+            select(AppointmentArquivado.dentista_id).where(AppointmentArquivado.patient_id == paciente_id))
+    ))
+
+@event.listens_for(Appointment, 'after_insert')
+@event.listens_for(Appointment, 'after_update')
+@event.listens_for(Appointment, 'after_delete')
+def _marcar_feed_do_agendamento(mapper, connection, target):
+    # Inclui o dentista anterior quando o agendamento é transferido
+    dentistas = {target.dentista_id, *inspect(target).attrs.dentista_id.history.deleted}
+    marcar_agendas_alteradas(connection, FeedAgenda.dentista_id.in_(dentistas))
+
+_feeds_ics = {} # dentista_id -> (etag, conteúdo): remontado só quando a ETag muda
+
+def _linha_ics(nome, valor):
+    """Linha de conteúdo com texto escapado e dobrada em 75 octetos (RFC 5545)."""
+    valor = valor.replace('\\', '\\\\').replace(';', '\\;').replace(',', '\\,').replace('\r\n', '\\n').replace('\n', '\\n')
+    linha = f"{nome}:{valor}".encode('utf-8')
+    partes = []
+    while len(linha) > 75:
+        corte = 75 if not partes else 74
+        while (linha[corte] & 0xC0) == 0x80: # Não corta no meio de um caractere UTF-8
+            corte -= 1
+        partes.append(linha[:corte])
+        linha = linha[corte:]
+    partes.append(linha)
+    return b'\r\n '.join(partes).decode('utf-8')
+
+def gerar_ics(dentista, agendamentos, carimbo):
+    dtstamp = carimbo.strftime('%Y%m%dT%H%M%SZ')
+    linhas = [
+        'BEGIN:VCALENDAR', 'VERSION:2.0', 'PRODID:-//AutoDente//Agenda//PT-BR', 'CALSCALE:GREGORIAN', 'METHOD:PUBLISH',
+        _linha_ics('X-WR-CALNAME', f"Agenda - {dentista.nome}"),
+        'REFRESH-INTERVAL;VALUE=DURATION:PT15M', 'X-PUBLISHED-TTL:PT15M',
+    ]
+    for agendamento in agendamentos:
+        # Horário "flutuante" (sem fuso): o celular mostra o mesmo horário cadastrado na clínica
+        inicio = datetime.combine(agendamento.appointment_date, datetime.strptime(agendamento.appointment_time, '%H:%M').time())
+        fim = inicio + timedelta(minutes=agendamento.duration_minutes)
+        linhas += [
+            'BEGIN:VEVENT',
+            f"UID:agendamento-{agendamento.id}@autodente",
+            f"DTSTAMP:{dtstamp}",
+            f"DTSTART:{inicio:%Y%m%dT%H%M%S}",
+            f"DTEND:{fim:%Y%m%dT%H%M%S}",
+            _linha_ics('SUMMARY', agendamento.patient_name or "Paciente"),
+        ]
+        if agendamento.observacao:
+            linhas.append(_linha_ics('DESCRIPTION', agendamento.observacao))
+        linhas.append('END:VEVENT')
+    linhas.append('END:VCALENDAR')
+    return '\r\n'.join(linhas) + '\r\n'
+
+
+# --- Pacientes Duplicados ---
+# O agendamento rápido cria um paciente sem cadastro sempre que o nome digitado não coincide
+# exatamente, o que gera duplicatas. A busca agrupa os pacientes por chaves de bloqueio (CPF,
+# telefone, data de nascimento e código fonético do nome) numa única leitura e só compara os
+# pares que compartilham alguma chave; blocos maiores que BLOCO_MAXIMO_DUPLICADOS (ex.: datas
+# de nascimento de preenchimento) são ignorados para não voltar à comparação de todos com todos.
+BLOCO_MAXIMO_DUPLICADOS = 50
+
+# Regras aplicadas em ordem a cada palavra, já sem acentos: grafias com o mesmo som viram a mesma letra
+REGRAS_FONETICAS = [(re.compile(padrao), troca) for padrao, troca in (
+    (r'ph', 'f'), (r'[lnc]h', lambda m: {'l': 'l', 'n': 'n', 'c': 's'}[m.group()[0]]), (r'sh', 's'),
+    (r's?c(?=[ei])', 's'), (r'qu(?=[ei])', 'k'), (r'gu(?=[ei])', 'g'), (r'g(?=[ei])', 'j'),
+    (r'[xz]', 's'), (r'[cqk]', 'k'), (r'w', 'v'), (r'y', 'i'), (r'h', ''), (r'n$', 'm'),
+    (r'(?<=.)[aeiou]', ''), (r'(.)\1+', r'\1'),
+)]
+RE_NAO_LETRAS = re.compile(r'[^a-z ]')
+
+def normalizar_nome(nome):
+    """Minúsculas, sem acentos e sem pontuação."""
+    sem_acentos = unicodedata.normalize('NFKD', (nome or '').lower()).encode('ascii', 'ignore').decode()
+    return ' '.join(RE_NAO_LETRAS.sub(' ', sem_acentos).split())
+
+@lru_cache(maxsize=50000)
+def codigo_fonetico_palavra(palavra):
+    for padrao, troca in REGRAS_FONETICAS:
+        palavra = padrao.sub(troca, palavra)
+    return palavra
+
+def codigo_fonetico(nome, normalizado=False):
+    """Código fonético do nome (ex.: 'Thiago Souza' e 'Tiago Sousa' -> 'tg s')."""
+    palavras = (nome if normalizado else normalizar_nome(nome)).split()
+    return ' '.join(codigo_fonetico_palavra(p) for p in palavras if p not in ('da', 'de', 'do', 'das', 'dos', 'e'))
+
+def _telefones(*numeros):
+    # Últimos 8 dígitos: ignora DDD, DDI e o nono dígito
+    return {d[-8:] for d in (RE_NAO_DIGITOS.sub('', n or '') for n in numeros) if len(d) >= 8}
+
+def _chaves_bloqueio(paciente):
+    chaves = {('fonetico', paciente['fonetico'])} if paciente['fonetico'] else set()
+    palavras = paciente['fonetico'].split()
+    if len(palavras) > 2:
+        chaves.add(('fonetico', f"{palavras[0]} {palavras[-1]}")) # Sem os sobrenomes do meio
+    if paciente['cpf']:
+        chaves.add(('cpf', paciente['cpf']))
+    if paciente['data_nascimento']:
+        chaves.add(('data_nascimento', paciente['data_nascimento']))
+    chaves.update(('telefone', t) for t in paciente['telefones'])
+    return chaves
+
+def pontuar_duplicata(a, b):
+    """Similaridade de 0 a 1 entre dois pacientes e os motivos. Dados ausentes não contam contra."""
+    if a['cpf'] and b['cpf']:
+        return (1.0, ['cpf']) if a['cpf'] == b['cpf'] else (0.0, [])
+    if a['fonetico'] == b['fonetico']:
+        pontuacao, motivos = 1.0, ['nome']
+    else:
+        pontuacao = difflib.SequenceMatcher(None, a['nome'], b['nome']).ratio()
+        motivos = ['nome'] if pontuacao >= 0.8 else []
+    if a['data_nascimento'] and b['data_nascimento']:
+        if a['data_nascimento'] == b['data_nascimento']:
+            pontuacao += 0.15
+            motivos.append('data_nascimento')
+        else:
+            pontuacao -= 0.4
+    if a['telefones'] and b['telefones']:
+        if a['telefones'] & b['telefones']:
+            pontuacao += 0.15
+            motivos.append('telefone')
+        else:
+            pontuacao -= 0.1
+    return max(0.0, min(1.0, pontuacao)), motivos
+
+def encontrar_duplicados(limiar=0.85, limite=200):
+    """Pares de pacientes prováveis duplicatas, do mais ao menos similar."""
+    colunas = (Paciente.id, Paciente.nome_completo, Paciente.cpf, Paciente.data_nascimento,
+               Paciente.celular, Paciente.fone_fixo, Paciente.is_fully_registered)
+    pacientes, blocos = {}, {}
+    for id_, nome_completo, cpf, data_nascimento, celular, fone_fixo, completo in db.session.execute(select(*colunas)):
+        nome = normalizar_nome(nome_completo)
+        paciente = {
+            'id': id_, 'nome_completo': nome_completo, 'nome': nome,
+            'fonetico': codigo_fonetico(nome, normalizado=True), 'cpf': RE_NAO_DIGITOS.sub('', cpf or '') or None,
+            'data_nascimento': data_nascimento, 'telefones': _telefones(celular, fone_fixo),
+            'is_fully_registered': completo,
+        }
+        pacientes[id_] = paciente
+        for chave in _chaves_bloqueio(paciente):
+            blocos.setdefault(chave, []).append(id_)
+
+    pares, comparacoes = [], 0
+    vistos = set()
+    for ids in blocos.values():
+        if len(ids) < 2 or len(ids) > BLOCO_MAXIMO_DUPLICADOS:
+            continue
+        for i, j in itertools.combinations(ids, 2):
+            if (i, j) in vistos:
+                continue
+            vistos.add((i, j))
+            comparacoes += 1
+            pontuacao, motivos = pontuar_duplicata(pacientes[i], pacientes[j])
+            if pontuacao >= limiar:
+                pares.append((pontuacao, motivos, pacientes[i], pacientes[j]))
+
+    pares.sort(key=lambda par: (-par[0], par[2]['id'], par[3]['id']))
+
+    def resumo(p):
+        return {'id': p['id'], 'nome_completo': p['nome_completo'], 'cpf': p['cpf'],
+                'data_nascimento': p['data_nascimento'].isoformat() if p['data_nascimento'] else None,
+                'is_fully_registered': p['is_fully_registered']}
+
+    return {
+        'pacientes_analisados': len(pacientes),
+        'comparacoes': comparacoes,
+        'total': len(pares),
+        'pares': [{
+            'pontuacao': round(pontuacao, 3),
+            'motivos': motivos,
+            # Sugestão: manter o cadastro completo ou, empatando, o mais antigo
+            'manter_id': min((a, b), key=lambda p: (not p['is_fully_registered'], p['id']))['id'],
+            'pacientes': [resumo(a), resumo(b)],
+        } for pontuacao, motivos, a, b in pares[:limite]],
+    }
+
+def mesclar_pacientes(destino, duplicados):
+    """Move agendamentos, pagamentos, orçamentos e histórico dos duplicados para `destino`,
+    completa os campos vazios dele com os dos duplicados e exclui os duplicados (logicamente).
+    Não faz commit. Retorna quantos registros foram movidos por tabela."""
+    ids = [d.id for d in duplicados]
+    complementos = {}
+    campos = [c.key for c in Paciente.__table__.columns
+              if c.key not in CAMPOS_NAO_EDITAVEIS_PACIENTE and not isinstance(c.type, db.Boolean)]
+    for duplicado in duplicados:
+        for campo in campos:
+            valor = getattr(duplicado, campo)
+            if valor not in (None, '') and getattr(destino, campo) in (None, '') and campo not in complementos:
+                complementos[campo] = valor
+        duplicado.cpf = None # Libera o CPF (único na clínica) antes de passá-lo ao destino
+        duplicado.deleted_at = datetime.now(timezone.utc)
+    db.session.flush()
+
+    for campo, valor in complementos.items():
+        setattr(destino, campo, valor)
+    if any(d.is_fully_registered for d in duplicados):
+        destino.is_fully_registered = True
+    db.session.flush() # Atualiza nome_completo antes de copiá-lo para os dependentes
+
+    dados_paciente = {'patient_name': destino.nome_completo, 'patient_is_fully_registered': destino.is_fully_registered}
+    movidos = {}
+    for modelo, coluna, valores in (
+        (Appointment, 'patient_id', dados_paciente),
+        (AppointmentArquivado, 'patient_id', dados_paciente),
+        (Pagamento, 'paciente_id', {'paciente_nome': destino.nome_completo}),
+        (PagamentoArquivado, 'paciente_id', {'paciente_nome': destino.nome_completo}),
+        (Budget, 'patient_id', {}),
+        (HistoricoPaciente, 'patient_id', {}),
+    ):
+        # Um UPDATE por tabela, independente de quantos registros os duplicados tenham
+        movidos[modelo.__table__.name] = db.session.execute(
+            update(modelo).where(getattr(modelo, coluna).in_(ids)).values({coluna: destino.id, **valores}),
+            execution_options={'synchronize_session': False},
+        ).rowcount
+    marcar_agendas_do_paciente(db.session.connection(), destino.id)
+    return movidos
+
+
+# --- Idempotência das Rotas de Criação ---
+# Com o cabeçalho Idempotency-Key, a primeira requisição reserva a chave (por usuário),
+# executa a rota e grava a resposta; repetições com a mesma chave recebem a resposta
+# gravada sem reexecutar consultas, verificação de conflitos ou INSERT. Respostas 5xx não
+# são gravadas (a repetição executa de novo). Chaves expiram após IDEMPOTENCY_TTL_HOURS e
+# são removidas pela limpeza em segundo plano.
+class ChaveIdempotencia(db.Model):
+    __tablename__ = 'chaves_idempotencia'
+    __table_args__ = (
+        db.UniqueConstraint('usuario_id', 'chave', name='uq_chaves_idempotencia_usuario_chave'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    usuario_id = db.Column(db.Integer, db.ForeignKey('usuarios.id'), nullable=False)
+    chave = db.Column(db.String(100), nullable=False)
+    rota = db.Column(db.String(100), nullable=False)
+    hash_requisicao = db.Column(db.String(64), nullable=False) # SHA-256 do corpo da requisição
+    status_code = db.Column(db.Integer, nullable=True) # Nulo enquanto a requisição original está em processamento
+    resposta = db.Column(db.Text, nullable=True)
+    criada_em = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc))
+    expira_em = db.Column(db.DateTime, nullable=False, index=True)
+
+def _repetir_resposta(registro, hash_requisicao):
+    if registro is None or registro.status_code is None:
+        return jsonify({"success": False, "message": "Uma requisição com esta Idempotency-Key ainda está em processamento."}), 409
+    if registro.rota != request.endpoint or registro.hash_requisicao != hash_requisicao:
+        return jsonify({"success": False, "message": "Idempotency-Key já utilizada com outra requisição."}), 422
+    return Response(registro.resposta, status=registro.status_code, mimetype='application/json',
+                    headers={'Idempotent-Replayed': 'true'})
+
+def idempotente(f):
+    @wraps(f)
+    def decorated(current_user, *args, **kwargs):
+        chave = request.headers.get('Idempotency-Key')
+        if not chave:
+            return f(current_user, *args, **kwargs)
+        if len(chave) > 100:
+            return jsonify({"success": False, "message": "Idempotency-Key deve ter no máximo 100 caracteres."}), 400
+
+        hash_requisicao = hashlib.sha256(request.get_data()).hexdigest()
+        agora = datetime.now(timezone.utc)
+        registro = ChaveIdempotencia.query.filter(
+            ChaveIdempotencia.usuario_id == current_user.id,
+            ChaveIdempotencia.chave == chave,
+            ChaveIdempotencia.expira_em > agora
+        ).first()
+        if registro:
+            return _repetir_resposta(registro, hash_requisicao)
+
+        # Reserva a chave antes de executar; a restrição única resolve repetições simultâneas
+        try:
+            ChaveIdempotencia.query.filter(
+                ChaveIdempotencia.usuario_id == current_user.id,
+                ChaveIdempotencia.chave == chave,
+                ChaveIdempotencia.expira_em <= agora
+            ).delete(synchronize_session=False) # Só a versão expirada; uma reserva viva cai no IntegrityError
+            registro = ChaveIdempotencia(
+                usuario_id=current_user.id, chave=chave, rota=request.endpoint, hash_requisicao=hash_requisicao,
+                expira_em=agora + timedelta(hours=app.config['IDEMPOTENCY_TTL_HOURS'])
+            )
+            db.session.add(registro)
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+            return _repetir_resposta(ChaveIdempotencia.query.filter_by(usuario_id=current_user.id, chave=chave).first(),
+                                     hash_requisicao)
+        registro_id = registro.id
+
+        try:
+            resposta = app.make_response(f(current_user, *args, **kwargs))
+        except Exception:
+            db.session.rollback()
+            db.session.execute(ChaveIdempotencia.__table__.delete().where(ChaveIdempotencia.id == registro_id))
+            db.session.commit()
+            raise
+
+        try:
+            if resposta.status_code >= 500:
+                db.session.execute(ChaveIdempotencia.__table__.delete().where(ChaveIdempotencia.id == registro_id))
+            else:
+                db.session.execute(
+                    update(ChaveIdempotencia).where(ChaveIdempotencia.id == registro_id)
+                    .values(status_code=resposta.status_code, resposta=resposta.get_data(as_text=True))
+                )
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            app.logger.error(f"Erro ao gravar resposta da Idempotency-Key '{chave}': {str(e)}")
+        return resposta
+    return decorated
+
+
+# --- Cache de Respostas das Rotas de Leitura ---
+# GETs repetidos por todas as estações (agenda do dia, dentistas, usuários, bootstrap) ficam
+# guardados por RESPONSE_CACHE_TTL_SECONDS, com chave por caminho + query string + escopo do
+# usuário. Requisições simultâneas para uma chave ausente aguardam uma única execução da rota
+# (single-flight). Cada rota declara as tabelas que lê; todo commit que escreve numa delas
+# incrementa a geração da tabela, que faz parte da chave, invalidando as entradas antigas.
+# Com RESPONSE_CACHE_REDIS_URL, entradas e gerações ficam num Redis (ou servidor compatível)
+# compartilhado entre os workers; sem ele, o cache e a invalidação valem só para o processo.
+class ArmazenamentoCacheLocal:
+    LIMITE_ENTRADAS = 1000
+
+    def __init__(self):
+        self._entradas = {}
+        self._geracoes = {}
+        self._lock = threading.Lock()
+
+    def geracoes(self, tabelas):
+        return [self._geracoes.get(tabela, 0) for tabela in tabelas]
+
+    def incrementar(self, tabelas):
+        with self._lock:
+            for tabela in tabelas:
+                self._geracoes[tabela] = self._geracoes.get(tabela, 0) + 1
+
+    def obter(self, chave):
+        entrada = self._entradas.get(chave)
+        if entrada and entrada[0] > time.monotonic():
+            return entrada[1]
+        return None
+
+    def gravar(self, chave, valor, ttl):
+        agora = time.monotonic()
+        with self._lock:
+            if len(self._entradas) >= self.LIMITE_ENTRADAS: # Descarta as expiradas (e as de gerações antigas)
+                self._entradas = {c: e for c, e in self._entradas.items() if e[0] > agora}
+                if len(self._entradas) >= self.LIMITE_ENTRADAS:
+                    self._entradas.clear()
+            self._entradas[chave] = (agora + ttl, valor)
+
+
+class ArmazenamentoCacheRedis:
+    PREFIXO = 'autodente:cache:'
+
+    def __init__(self, url):
+        import redis # Dependência opcional, só necessária com RESPONSE_CACHE_REDIS_URL
+        self._redis = redis.Redis.from_url(url)
+
+    def geracoes(self, tabelas):
+        valores = self._redis.mget([f"{self.PREFIXO}geracao:{tabela}" for tabela in tabelas])
+        return [int(valor or 0) for valor in valores]
+
+    def incrementar(self, tabelas):
+        pipeline = self._redis.pipeline()
+        for tabela in tabelas:
+            pipeline.incr(f"{self.PREFIXO}geracao:{tabela}")
+        pipeline.execute()
+
+    def _chave(self, chave):
+        return f"{self.PREFIXO}resposta:{hashlib.sha256(chave.encode()).hexdigest()}"
+
+    def obter(self, chave):
+        valor = self._redis.get(self._chave(chave))
+        return json.loads(valor) if valor else None
+
+    def gravar(self, chave, valor, ttl):
+        self._redis.set(self._chave(chave), json.dumps(valor), px=int(ttl * 1000))
+
+
+class _Voo:
+    """Execução em andamento de uma chave; as requisições concorrentes esperam pelo resultado."""
+    def __init__(self):
+        self.evento = threading.Event()
+        self.valor = None
+
+
+class CacheRespostas:
+    def __init__(self):
+        self.armazenamento = ArmazenamentoCacheLocal()
+        self._voos = {}
+        self._lock = threading.Lock()
+
+    def configurar(self, redis_url=None):
+        if redis_url:
+            self.armazenamento = ArmazenamentoCacheRedis(redis_url)
+
+    # Falhas do armazenamento (ex.: Redis indisponível) nunca derrubam a requisição: a rota é executada normalmente
+    def geracoes(self, tabelas):
+        try:
+            return self.armazenamento.geracoes(tabelas)
+        except Exception as e:
+            app.logger.warning(f"Cache de respostas indisponível: {str(e)}")
+            return None
+
+    def invalidar(self, tabelas):
+        try:
+            self.armazenamento.incrementar(sorted(tabelas))
+        except Exception as e:
+            app.logger.error(f"Erro ao invalidar o cache de respostas ({', '.join(sorted(tabelas))}): {str(e)}")
+
+    def obter_ou_calcular(self, chave, calcular, ttl):
+        """Retorna ([status, mimetype, corpo], origem), com origem HIT, COALESCED ou MISS."""
+        try:
+            valor = self.armazenamento.obter(chave)
+        except Exception as e:
+            app.logger.warning(f"Cache de respostas indisponível: {str(e)}")
+            valor = None
+        if valor is not None:
+            return valor, 'HIT'
+
+        with self._lock:
+            voo = self._voos.get(chave)
+            lider = voo is None
+            if lider:
+                voo = self._voos[chave] = _Voo()
+        if not lider:
+            voo.evento.wait(timeout=30)
+            if voo.valor is not None:
+                return voo.valor, 'COALESCED'
+            return calcular(), 'MISS' # A execução líder falhou ou não era armazenável
+
+        try:
+            valor = calcular()
+            if valor[0] == 200:
+                voo.valor = valor
+                try:
+                    self.armazenamento.gravar(chave, valor, ttl)
+                except Exception as e:
+                    app.logger.warning(f"Erro ao gravar no cache de respostas: {str(e)}")
+        finally:
+            with self._lock:
+                self._voos.pop(chave, None)
+            voo.evento.set()
+        return valor, 'MISS'
+
+cache_respostas = CacheRespostas()
+cache_respostas.configurar(app.config['RESPONSE_CACHE_REDIS_URL'])
+
+# Escopos: quais usuários podem compartilhar a mesma resposta
+def escopo_todos(usuario):
+    return 'todos'
+
+def escopo_perfil(usuario):
+    return usuario.perfil
+
+def escopo_dentista(usuario):
+    # Admins veem os mesmos dados; cada dentista (comum) vê apenas os seus
+    return 'admin' if usuario.perfil == 'admin' else f"usuario:{usuario.id}"
+
+def escopo_usuario(usuario):
+    return f"usuario:{usuario.id}"
+
+def cache_resposta(*tabelas, escopo=escopo_perfil):
+    """Guarda respostas 200 de uma rota GET; `tabelas` são as tabelas cuja escrita a invalida."""
+    def decorator(f):
+        @wraps(f)
+        def decorated(current_user, *args, **kwargs):
+            ttl = app.config['RESPONSE_CACHE_TTL_SECONDS']
+            # Geração global da tabela (escritas fora de requisições) e a da clínica do usuário
+            tabelas_clinica = (*tabelas, *(f"{tabela}@{current_user.clinica_id}" for tabela in tabelas))
+            geracoes = cache_respostas.geracoes(tabelas_clinica) if ttl > 0 and request.method == 'GET' else None
+            if geracoes is None:
+                return f(current_user, *args, **kwargs)
+
+            parametros = '&'.join(f"{k}={v}" for k, v in sorted(request.args.items(multi=True)))
+            chave = (f"{request.path}?{parametros}|clinica:{current_user.clinica_id}|{escopo(current_user)}"
+                     f"|{','.join(map(str, geracoes))}")
+
+            def calcular():
+                resposta = app.make_response(f(current_user, *args, **kwargs))
+                return [resposta.status_code, resposta.mimetype, resposta.get_data(as_text=True)]
+
+            (status, mimetype, corpo), origem = cache_respostas.obter_ou_calcular(chave, calcular, ttl)
+            return Response(corpo, status=status, mimetype=mimetype, headers={'X-Cache': origem})
+        return decorated
+    return decorator
+
+# Tabelas escritas em cada transação; invalidadas no commit, descartadas no rollback. Escritas
+# de uma requisição invalidam só as respostas da clínica dela (tabela@clinica_id)
+def _marcar_tabelas_alteradas(session, tabelas):
+    clinica_id = clinica_atual()
+    if clinica_id is not None:
+        tabelas = {f"{tabela}@{clinica_id}" for tabela in tabelas}
+    session.info.setdefault('tabelas_alteradas', set()).update(tabelas)
+
+@event.listens_for(db.session, 'after_flush')
+def _tabelas_do_flush(session, flush_context):
+    _marcar_tabelas_alteradas(session, {
+        obj.__table__.name for obj in (*session.new, *session.dirty, *session.deleted) if hasattr(obj, '__table__')
+    })
+
+@event.listens_for(db.session, 'do_orm_execute')
+def _tabelas_de_comandos_em_lote(execute_state):
+    if execute_state.is_insert or execute_state.is_update or execute_state.is_delete:
+        tabela = getattr(execute_state.statement, 'table', None)
+        if tabela is not None:
+            _marcar_tabelas_alteradas(execute_state.session, {tabela.name})
+
+@event.listens_for(db.session, 'after_commit')
+def _invalidar_cache_apos_commit(session):
+    tabelas = session.info.pop('tabelas_alteradas', None)
+    if tabelas:
+        cache_respostas.invalidar(tabelas)
+
+@event.listens_for(db.session, 'after_rollback')
+def _descartar_tabelas_alteradas(session):
+    session.info.pop('tabelas_alteradas', None)
+
+
+# --- Auditoria ---
+# Os eventos da sessão capturam quem criou, alterou ou excluiu registros das tabelas de
+# TABELAS_AUDITADAS: o flush gera um registro por objeto com os campos alterados
+# ({campo: [antes, depois]}) e os UPDATE/DELETE em lote geram um registro por linha (UPDATE
+# por chave primária) ou um registro com a condição e os parâmetros do comando. Os registros
+# da transação só seguem para o GravadorAuditoria no commit; a thread dele os grava em
+# INSERTs de várias linhas a cada AUDIT_FLUSH_INTERVAL_SECONDS (ou ao juntar AUDIT_BATCH_SIZE),
+# fora do caminho da requisição. Uma queda do processo perde no máximo esse intervalo; na
+# saída normal o buffer é descarregado. A tabela auditoria é somente anexação: nenhuma rota ou
+# limpeza a altera. Os comandos dos eventos de sincronização de nomes, do arquivamento e da
+# limpeza usam a conexão diretamente e, por serem derivados, não são auditados.
+TABELAS_AUDITADAS = {'usuarios', 'pacientes', 'appointments', 'pagamentos', 'budgets', 'budget_procedures', 'historico_pacientes'}
+CAMPOS_OCULTOS_AUDITORIA = {'senha_hash'}
+
+class RegistroAuditoria(db.Model):
+    __tablename__ = 'auditoria'
+    __table_args__ = (
+        db.Index('ix_auditoria_entidade', 'clinica_id', 'entidade', 'entidade_id', 'id'),
+        db.Index('ix_auditoria_usuario', 'clinica_id', 'usuario_id', 'id'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    clinica_id = db.Column(db.Integer, nullable=True) # Clínica do registro alterado (ou da requisição, em lote)
+    entidade = db.Column(db.String(50), nullable=False) # Nome da tabela
+    entidade_id = db.Column(db.Integer, nullable=True) # None em comandos em lote por condição
+    acao = db.Column(db.String(30), nullable=False) # criado, alterado, excluido, alterado_em_lote, excluido_em_lote
+    alteracoes = db.Column(db.Text, nullable=False) # JSON
+    usuario_id = db.Column(db.Integer, nullable=True) # Sem chave estrangeira: o registro sobrevive ao usuário
+    usuario_nome = db.Column(db.String(100), nullable=True)
+    criado_em = db.Column(db.DateTime, nullable=False)
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'entidade': self.entidade,
+            'entidade_id': self.entidade_id,
+            'acao': self.acao,
+            'alteracoes': json.loads(self.alteracoes),
+            'usuario_id': self.usuario_id,
+            'usuario_nome': self.usuario_nome or "Sistema",
+            'criado_em': self.criado_em.isoformat(),
+        }
+
+def _registro_auditoria(entidade, entidade_id, acao, alteracoes, clinica_id=None):
+    usuario_id, usuario_nome = g.get('usuario_auditoria', (None, None)) if has_request_context() else (None, None)
+    for campo in CAMPOS_OCULTOS_AUDITORIA.intersection(alteracoes):
+        alteracoes[campo] = '***'
+    return {'clinica_id': clinica_id or clinica_atual(), 'entidade': entidade, 'entidade_id': entidade_id, 'acao': acao, 'alteracoes': alteracoes,
+            'usuario_id': usuario_id, 'usuario_nome': usuario_nome, 'criado_em': datetime.now(timezone.utc)}
+
+class GravadorAuditoria:
+    """Buffer em memória esvaziado por uma thread própria, iniciada no primeiro registro.
+
+    Cada destino (banco e, com AUDIT_LOG_FILE, o arquivo) tem sua fila: uma falha em um deles
+    mantém os registros para a próxima tentativa sem duplicá-los no outro. Cada fila guarda
+    no máximo AUDIT_MAX_BUFFER registros; acima disso os mais antigos são descartados.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._lock_gravacao = threading.Lock()
+        self._acordar = threading.Event()
+        self._filas = {}
+        self._thread = None
+        self.descartados = 0
+
+    def registrar(self, registros):
+        destinos = ('banco', 'arquivo') if app.config['AUDIT_LOG_FILE'] else ('banco',)
+        with self._lock:
+            for destino in destinos:
+                fila = self._filas.setdefault(destino, [])
+                fila.extend(registros)
+                excesso = len(fila) - app.config['AUDIT_MAX_BUFFER']
+                if excesso > 0:
+                    del fila[:excesso]
+                    self.descartados += excesso
+                    app.logger.warning(f"Buffer de auditoria ({destino}) cheio: {excesso} registro(s) descartado(s).")
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._loop, daemon=True, name='gravador-auditoria')
+                self._thread.start()
+            cheio = any(len(fila) >= app.config['AUDIT_BATCH_SIZE'] for fila in self._filas.values())
+        if cheio:
+            self._acordar.set()
+
+    def _loop(self):
+        while True:
+            self._acordar.wait(app.config['AUDIT_FLUSH_INTERVAL_SECONDS'])
+            self._acordar.clear()
+            self.descarregar()
+
+    def descarregar(self):
+        """Grava tudo o que está pendente; retorna o número de registros gravados no banco."""
+        gravados = 0
+        with self._lock_gravacao:
+            for destino, gravar in (('arquivo', self._gravar_arquivo), ('banco', self._gravar_banco)):
+                while True:
+                    with self._lock:
+                        fila = self._filas.get(destino, [])
+                        lote = fila[:app.config['AUDIT_BATCH_SIZE']]
+                        del fila[:len(lote)]
+                    if not lote:
+                        break
+                    try:
+                        gravar(lote)
+                    except Exception as e:
+                        with self._lock:
+                            self._filas[destino][:0] = lote # Tenta de novo no próximo ciclo
+                        app.logger.error(f"Erro ao gravar {len(lote)} registro(s) de auditoria ({destino}): {str(e)}")
+                        break
+                    if destino == 'banco':
+                        gravados += len(lote)
+        return gravados
+
+    def _gravar_banco(self, lote):
+        linhas = [{**r, 'alteracoes': json.dumps(r['alteracoes'], ensure_ascii=False, default=str)} for r in lote]
+        with app.app_context(), db.engine.begin() as conn:
+            conn.execute(insert(RegistroAuditoria.__table__), linhas)
+
+    def _gravar_arquivo(self, lote):
+        with open(app.config['AUDIT_LOG_FILE'], 'a', encoding='utf-8') as arquivo:
+            arquivo.writelines(json.dumps(r, ensure_ascii=False, default=str) + '\n' for r in lote)
+            arquivo.flush()
+            os.fsync(arquivo.fileno())
+
+gravador_auditoria = GravadorAuditoria()
+atexit.register(gravador_auditoria.descarregar)
+
+@event.listens_for(db.session, 'after_flush')
+def _auditar_flush(session, flush_context):
+    registros = []
+    for objetos, acao in ((session.new, 'criado'), (session.dirty, 'alterado'), (session.deleted, 'excluido')):
+        for obj in objetos:
+            tabela = getattr(obj, '__table__', None)
+            if tabela is None or tabela.name not in TABELAS_AUDITADAS:
+                continue
+            estado = inspect(obj)
+            alteracoes = {}
+            for atributo in estado.mapper.column_attrs:
+                if acao == 'alterado':
+                    historico = estado.attrs[atributo.key].history
+                    if historico.has_changes():
+                        alteracoes[atributo.key] = [historico.deleted[0] if historico.deleted else None,
+                                                    historico.added[0] if historico.added else None]
+                elif estado.dict.get(atributo.key) is not None:
+                    alteracoes[atributo.key] = estado.dict[atributo.key]
+            if acao == 'alterado' and not alteracoes:
+                continue # Só relacionamentos mudaram
+            acao_registro = acao
+            if acao == 'alterado' and 'deleted_at' in alteracoes and alteracoes['deleted_at'][0] is None:
+                acao_registro = 'excluido' # Exclusão lógica
+            registros.append(_registro_auditoria(tabela.name, estado.mapper.primary_key_from_instance(obj)[0],
+                                                 acao_registro, alteracoes, getattr(obj, 'clinica_id', None)))
+    if registros:
+        session.info.setdefault('auditoria', []).extend(registros)
+
+@event.listens_for(db.session, 'do_orm_execute')
+def _auditar_comandos_em_lote(execute_state):
+    if not (execute_state.is_insert or execute_state.is_update or execute_state.is_delete):
+        return
+    tabela = getattr(execute_state.statement, 'table', None)
+    if tabela is None or tabela.name not in TABELAS_AUDITADAS:
+        return
+    parametros = execute_state.parameters
+    if execute_state.is_insert:
+        # INSERT multi-linha (ex.: procedimentos do orçamento): um registro por linha; o id gerado não é conhecido
+        linhas = parametros if isinstance(parametros, list) else [parametros or {}]
+        execute_state.session.info.setdefault('auditoria', []).extend(
+            _registro_auditoria(tabela.name, linha.get('id'), 'criado', {k: v for k, v in linha.items() if v is not None},
+                                linha.get('clinica_id'))
+            for linha in linhas
+        )
+        return
+    acao = 'alterado' if execute_state.is_update else 'excluido'
+    if isinstance(parametros, list) and parametros and 'id' in parametros[0]:
+        # UPDATE em lote por chave primária: o valor anterior não é conhecido
+        registros = [_registro_auditoria(tabela.name, p['id'], acao, {k: [None, v] for k, v in p.items() if k != 'id'})
+                     for p in parametros]
+    else:
+        comando = execute_state.statement
+        registros = [_registro_auditoria(tabela.name, None, f"{acao}_em_lote", {
+            'condicao': str(comando.whereclause) if comando.whereclause is not None else None,
+            'parametros': comando.compile().params,
+        })]
+    execute_state.session.info.setdefault('auditoria', []).extend(registros)
+
+@event.listens_for(db.session, 'after_commit')
+def _enviar_auditoria_apos_commit(session):
+    registros = session.info.pop('auditoria', None)
+    if registros:
+        gravador_auditoria.registrar(registros)
+
+@event.listens_for(db.session, 'after_rollback')
+def _descartar_auditoria(session):
+    session.info.pop('auditoria', None)
+
+
+class SchemaMigration(db.Model):
+    __tablename__ = 'schema_migrations'
+    versao = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    nome = db.Column(db.String(100), nullable=False)
+    aplicada_em = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc))
+
+
+# --- Migrações de Esquema ---
+# db.create_all() só cria tabelas que ainda não existem; índices e colunas novas em
+# tabelas já existentes são aplicados pelas migrações abaixo, em ordem de versão, e
+# registrados em schema_migrations. Cada migração deve ser idempotente (checkfirst),
+# pois em bancos novos o create_all já pode ter criado parte do que ela aplica.
+def _indices_do_model(*nomes):
+    indices = {indice.name: indice for tabela in db.metadata.tables.values() for indice in tabela.indexes}
+    return [indices[nome] for nome in nomes]
+
+def _criar_indices(conn, *nomes):
+    colunas_por_tabela = {}
+    for indice in _indices_do_model(*nomes):
+        tabela = indice.table.name
+        if tabela not in colunas_por_tabela:
+            colunas_por_tabela[tabela] = {c['name'] for c in inspect(conn).get_columns(tabela)}
+        # Índices que usam colunas ainda inexistentes são criados pela migração que adiciona a coluna
+        if all(c.name in colunas_por_tabela[tabela] for c in indice.columns):
+            indice.create(conn, checkfirst=True)
+
+def _recriar_indices(conn, *nomes):
+    """Cria os índices ou, se já existem com outras colunas no banco, os recria com a definição do model."""
+    for indice in _indices_do_model(*nomes):
+        existentes = {i['name']: i['column_names'] for i in inspect(conn).get_indexes(indice.table.name)}
+        if indice.name in existentes and existentes[indice.name] != [c.name for c in indice.columns]:
+            indice.drop(conn)
+        indice.create(conn, checkfirst=True)
+
+def _adicionar_coluna(conn, tabela, coluna, ddl):
+    colunas_existentes = {c['name'] for c in inspect(conn).get_columns(tabela)}
+    if coluna not in colunas_existentes:
+        conn.execute(text(f"ALTER TABLE {tabela} ADD COLUMN {coluna} {ddl}"))
+
+def _migracao_indices_performance(conn):
+    _criar_indices(
+        conn,
+        'ix_appointments_dentista_data', 'ix_appointments_data', 'ix_appointments_patient',
+        'ix_pagamentos_status_data', 'ix_pagamentos_paciente', 'ix_pagamentos_dentista',
+        'ix_budgets_patient', 'ix_budget_procedures_budget', 'ix_historico_pacientes_patient_data',
+    )
+
+def _migracao_nomes_desnormalizados(conn):
+    _adicionar_coluna(conn, 'pacientes', 'nome_completo', 'VARCHAR(201)')
+    _adicionar_coluna(conn, 'appointments', 'patient_name', 'VARCHAR(201)')
+    _adicionar_coluna(conn, 'appointments', 'patient_is_fully_registered', 'BOOLEAN')
+    _adicionar_coluna(conn, 'appointments', 'dentista_nome', 'VARCHAR(100)')
+    _adicionar_coluna(conn, 'pagamentos', 'paciente_nome', 'VARCHAR(201)')
+    _adicionar_coluna(conn, 'pagamentos', 'dentista_nome', 'VARCHAR(100)')
+    _adicionar_coluna(conn, 'pagamentos', 'aprovado_por_nome', 'VARCHAR(100)')
+
+    # Preenche os dados já existentes (|| no SQLite, CONCAT no MySQL — gerado pelo SQLAlchemy)
+    conn.execute(update(Paciente).values(nome_completo=func.trim(Paciente.nome + ' ' + func.coalesce(Paciente.sobrenome, ''))))
+    paciente = Paciente.__table__
+    usuario = Usuario.__table__
+    conn.execute(update(Appointment).values(
+        patient_name=select(paciente.c.nome_completo).where(paciente.c.id == Appointment.patient_id).scalar_subquery(),
+        patient_is_fully_registered=select(paciente.c.is_fully_registered).where(paciente.c.id == Appointment.patient_id).scalar_subquery(),
+        dentista_nome=select(usuario.c.nome).where(usuario.c.id == Appointment.dentista_id).scalar_subquery(),
+    ))
+    conn.execute(update(Pagamento).values(
+        paciente_nome=select(paciente.c.nome_completo).where(paciente.c.id == Pagamento.paciente_id).scalar_subquery(),
+        dentista_nome=select(usuario.c.nome).where(usuario.c.id == Pagamento.dentista_id).scalar_subquery(),
+        aprovado_por_nome=select(usuario.c.nome).where(usuario.c.id == Pagamento.aprovado_por_id).scalar_subquery(),
+    ))
+
+def _migracao_busca_historico(conn):
+    reconstruir_indice_busca_historico(conn)
+
+def _migracao_exclusao_logica(conn):
+    _adicionar_coluna(conn, 'pacientes', 'deleted_at', 'DATETIME')
+    _adicionar_coluna(conn, 'historico_pacientes', 'deleted_at', 'DATETIME')
+    _criar_indices(conn, 'ix_pacientes_deleted_at', 'ix_historico_pacientes_deleted_at')
+
+def _migracao_versao_paciente(conn):
+    _adicionar_coluna(conn, 'pacientes', 'versao', 'INTEGER NOT NULL DEFAULT 1')
+
+TABELAS_POR_CLINICA = ('usuarios', 'pacientes', 'appointments', 'pagamentos', 'budgets', 'historico_pacientes',
+                       'appointments_arquivo', 'pagamentos_arquivo')
+
+def garantir_clinica_padrao(conn):
+    if not conn.execute(select(Clinica.id).where(Clinica.id == CLINICA_PADRAO_ID)).first():
+        conn.execute(insert(Clinica).values(id=CLINICA_PADRAO_ID, nome=NOME_CLINICA_PADRAO, criado_em=datetime.now(timezone.utc)))
+
+def _remover_cpf_unico_global(conn):
+    """Troca a unicidade antiga do CPF (banco inteiro) pela da clínica (uq_pacientes_clinica_cpf)."""
+    antigas = [u for u in inspect(conn).get_unique_constraints('pacientes') if u['column_names'] == ['cpf']]
+    if not antigas:
+        return # Tabela criada pelo model atual
+    if conn.dialect.name == 'sqlite':
+        # O índice de um UNIQUE de coluna não pode ser removido no SQLite: a tabela é recriada
+        # com a definição do model (as chaves estrangeiras não são verificadas por padrão)
+        colunas = ', '.join(c['name'] for c in inspect(conn).get_columns('pacientes'))
+        nova = Paciente.__table__.to_metadata(db.metadata, name='pacientes_nova') # Resolve a chave de clinicas
+        try:
+            nova.indexes.clear()
+            nova.create(conn)
+        finally:
+            db.metadata.remove(nova)
+        conn.execute(text(f"INSERT INTO pacientes_nova ({colunas}) SELECT {colunas} FROM pacientes"))
+        conn.execute(text("DROP TABLE pacientes"))
+        conn.execute(text("ALTER TABLE pacientes_nova RENAME TO pacientes"))
+        for indice in Paciente.__table__.indexes:
+            indice.create(conn, checkfirst=True)
+        return
+    for restricao in antigas:
+        conn.execute(text(f"ALTER TABLE pacientes DROP INDEX {restricao['name']}"))
+    conn.execute(text("ALTER TABLE pacientes ADD CONSTRAINT uq_pacientes_clinica_cpf UNIQUE (clinica_id, cpf)"))
+
+def _migracao_clinicas(conn):
+    # Os dados existentes passam a ser da clínica padrão. Em tabelas já existentes a coluna é
+    # adicionada sem a chave estrangeira (o SQLite não a aceita em ALTER TABLE). Bancos vazios
+    # ficam sem clínicas: recebem a padrão junto com o admin ou os dados de migrar-dados
+    for tabela in TABELAS_POR_CLINICA:
+        _adicionar_coluna(conn, tabela, 'clinica_id', f'INTEGER NOT NULL DEFAULT {CLINICA_PADRAO_ID}')
+    if any(conn.execute(select(db.metadata.tables[tabela].c.id).limit(1)).first() for tabela in TABELAS_POR_CLINICA):
+        garantir_clinica_padrao(conn)
+    _adicionar_coluna(conn, 'auditoria', 'clinica_id', 'INTEGER')
+    conn.execute(update(RegistroAuditoria).where(RegistroAuditoria.clinica_id.is_(None)).values(clinica_id=CLINICA_PADRAO_ID))
+    _remover_cpf_unico_global(conn)
+    _criar_indices(conn, 'ix_appointments_dentista', 'ix_usuarios_clinica_perfil', 'ix_pacientes_clinica_nome')
+    _recriar_indices(
+        conn,
+        'ix_appointments_dentista_data', 'ix_appointments_data', 'ix_pagamentos_status_data',
+        'ix_appointments_arquivo_dentista_data', 'ix_appointments_arquivo_data', 'ix_pagamentos_arquivo_data',
+        'ix_auditoria_entidade', 'ix_auditoria_usuario',
+    )
+
+MIGRACOES = [
+    (1, 'indices_performance', _migracao_indices_performance),
+    (2, 'nomes_desnormalizados', _migracao_nomes_desnormalizados),
+    (3, 'busca_historico', _migracao_busca_historico),
+    (4, 'exclusao_logica', _migracao_exclusao_logica),
+    (5, 'versao_paciente', _migracao_versao_paciente),
+    (6, 'clinicas', _migracao_clinicas),
+]
+
+def aplicar_migracoes():
+    """Cria tabelas ausentes e aplica as migrações pendentes. Retorna as versões aplicadas."""
+    db.create_all()
+    ja_aplicadas = {versao for (versao,) in db.session.query(SchemaMigration.versao)}
+    db.session.close()
+    aplicadas = []
+    for versao, nome, migracao in MIGRACOES:
+        if versao in ja_aplicadas:
+            continue
+        with db.engine.begin() as conn:
+            migracao(conn)
+            conn.execute(SchemaMigration.__table__.insert().values(
+                versao=versao, nome=nome, aplicada_em=datetime.now(timezone.utc)
+            ))
+        app.logger.info(f"Migração {versao:04d} ({nome}) aplicada.")
+        aplicadas.append(versao)
+    return aplicadas
+
+
+# --- Backup Online do SQLite ---
+# A cópia usa a API de backup online do SQLite em passos de BACKUP_PAGES_PER_STEP páginas;
+# entre um passo e outro o banco fica livre para escritas (e, com gevent, os outros greenlets
+# rodam). Se outra conexão escrever no meio da cópia, o SQLite a recomeça para manter o
+# snapshot consistente; depois de BACKUP_MAX_RESTARTS recomeços a cópia é feita num passo só.
+# Cada snapshot é gravado comprimido (.db.gz), com o SHA-256 ao lado (.sha256, no formato do
+# sha256sum), e apenas os BACKUP_RETENTION mais recentes são mantidos.
+class BackupEmAndamento(RuntimeError):
+    pass
+
+class _RecomecosDemais(Exception):
+    pass
+
+_backup_em_andamento = threading.Lock()
+
+def _caminho_sqlite():
+    url = db.engine.url
+    if url.get_backend_name() != 'sqlite' or url.database in (None, '', ':memory:'):
+        raise RuntimeError("Backup online disponível apenas para bancos SQLite em arquivo.")
+    return url.database
+
+def _sha256_arquivo(caminho):
+    sha = hashlib.sha256()
+    with open(caminho, 'rb') as arquivo:
+        for bloco in iter(lambda: arquivo.read(1 << 20), b''):
+            sha.update(bloco)
+    return sha.hexdigest()
+
+def listar_backups(diretorio=None):
+    """Caminhos dos snapshots, do mais recente ao mais antigo (o nome contém a data em UTC)."""
+    diretorio = diretorio or app.config['BACKUP_DIR']
+    if not os.path.isdir(diretorio):
+        return []
+    return sorted((os.path.join(diretorio, nome) for nome in os.listdir(diretorio) if nome.endswith('.db.gz')), reverse=True)
+
+def _copiar_sqlite(origem, destino, paginas_por_passo):
+    passos, recomecos, restantes_antes = 0, 0, None
+
+    def progresso(status, restantes, total):
+        nonlocal passos, recomecos, restantes_antes
+        passos += 1
+        if restantes_antes is not None and restantes > restantes_antes:
+            recomecos += 1
+            if recomecos > app.config['BACKUP_MAX_RESTARTS']:
+                raise _RecomecosDemais()
+        restantes_antes = restantes
+        time.sleep(0.005) # Libera o banco (e o loop do gevent) entre os passos
+
+    try:
+        origem.backup(destino, pages=paginas_por_passo, progress=progresso)
+    except _RecomecosDemais:
+        origem.backup(destino) # Passo único: bloqueia as escritas só durante a cópia
+    return passos, recomecos
+
+def criar_backup(diretorio=None, retencao=None, paginas_por_passo=None):
+    """Grava um snapshot comprimido do banco sem bloquear as escritas e aplica a retenção."""
+    caminho_banco = _caminho_sqlite()
+    diretorio = diretorio or app.config['BACKUP_DIR']
+    retencao = retencao or app.config['BACKUP_RETENTION']
+    paginas_por_passo = paginas_por_passo or app.config['BACKUP_PAGES_PER_STEP']
+    base = os.path.splitext(os.path.basename(caminho_banco))[0]
+    destino = os.path.join(diretorio, f"{base}-{datetime.now(timezone.utc):%Y%m%dT%H%M%SZ}.db.gz")
+    copia, parcial = destino + '.copia', destino + '.parcial'
+    if not _backup_em_andamento.acquire(blocking=False):
+        raise BackupEmAndamento("Já existe um backup em andamento.")
+    try:
+        os.makedirs(diretorio, exist_ok=True)
+        inicio = time.perf_counter()
+
+        origem, conn_copia = sqlite3.connect(caminho_banco), sqlite3.connect(copia)
+        try:
+            passos, recomecos = _copiar_sqlite(origem, conn_copia, paginas_por_passo)
+        finally:
+            conn_copia.close()
+            origem.close()
+
+        with open(copia, 'rb') as entrada, gzip.open(parcial, 'wb', compresslevel=6) as saida:
+            shutil.copyfileobj(entrada, saida, 1 << 20)
+        sha256 = _sha256_arquivo(parcial)
+        with open(destino + '.sha256', 'w', encoding='utf-8') as arquivo:
+            arquivo.write(f"{sha256}  {os.path.basename(destino)}\n")
+        os.replace(parcial, destino) # Só aparece na listagem depois de completo
+        tamanho_banco = os.path.getsize(copia)
+        os.remove(copia)
+
+        removidos = []
+        for antigo in listar_backups(diretorio)[retencao:]:
+            for caminho in (antigo, antigo + '.sha256'):
+                if os.path.exists(caminho):
+                    os.remove(caminho)
+            removidos.append(os.path.basename(antigo))
+        return {
+            'arquivo': os.path.basename(destino),
+            'tamanho_bytes': os.path.getsize(destino),
+            'tamanho_banco_bytes': tamanho_banco,
+            'sha256': sha256,
+            'passos': passos,
+            'recomecos': recomecos,
+            'duracao_s': round(time.perf_counter() - inicio, 3),
+            'removidos': removidos,
+        }
+    finally:
+        for temporario in (copia, parcial):
+            if os.path.exists(temporario):
+                os.remove(temporario)
+        _backup_em_andamento.release()
+
+def verificar_backup(caminho):
+    """Confere o SHA-256, restaura o snapshot num arquivo temporário e roda PRAGMA integrity_check."""
+    resultado = {'arquivo': os.path.basename(caminho), 'checksum_ok': None, 'integridade': None,
+                 'versao_esquema': None, 'tabelas': {}}
+    if os.path.exists(caminho + '.sha256'):
+        with open(caminho + '.sha256', encoding='utf-8') as arquivo:
+            esperado = arquivo.read().split()[0]
+        resultado['checksum_ok'] = esperado == _sha256_arquivo(caminho)
+    if resultado['checksum_ok'] is not False:
+        with tempfile.TemporaryDirectory() as pasta:
+            restaurado = os.path.join(pasta, 'restaurado.db')
+            try:
+                with gzip.open(caminho, 'rb') as entrada, open(restaurado, 'wb') as saida:
+                    shutil.copyfileobj(entrada, saida, 1 << 20)
+                conn = sqlite3.connect(restaurado)
+                try:
+                    problemas = [linha[0] for linha in conn.execute("PRAGMA integrity_check")]
+                    resultado['integridade'] = 'ok' if problemas == ['ok'] else problemas
+                    tabelas = [linha[0] for linha in conn.execute(
+                        "SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%' ORDER BY name")]
+                    for tabela in tabelas:
+                        resultado['tabelas'][tabela] = conn.execute(f'SELECT COUNT(*) FROM "{tabela}"').fetchone()[0]
+                    if 'schema_migrations' in tabelas:
+                        resultado['versao_esquema'] = conn.execute("SELECT MAX(versao) FROM schema_migrations").fetchone()[0]
+                finally:
+                    conn.close()
+            except (OSError, EOFError, zlib.error, sqlite3.DatabaseError) as e:
+                resultado['integridade'] = f"Snapshot ilegível: {e}"
+    resultado['ok'] = resultado['checksum_ok'] is not False and resultado['integridade'] == 'ok'
+    return resultado
+
+
+# --- Migração de Dados entre Bancos ---
+# 'flask migrar-dados --origem URL' copia as tabelas dos models de outro banco (ex.: o SQLite
+# em que a instalação começou) para o banco de DATABASE_URL (ex.: o MySQL do docker-compose),
+# em ordem de chaves estrangeiras e mantendo os ids. A origem é lida em ordem de id com cursor
+# no servidor (stream_results) e gravada em lotes, com um commit por lote, então a memória não
+# cresce com o tamanho do banco. O maior id já gravado em cada tabela do destino é o ponto de
+# retomada (--retomar). No fim, contagem e checksum de cada tabela são comparados nos dois bancos.
+# Com --clinica N só os dados dessa clínica são copiados, para que ela passe a ter um banco próprio.
+TABELAS_FORA_DA_MIGRACAO = {'schema_migrations'} # O destino tem o próprio controle de versão do esquema
+
+def _valor_checksum(valor):
+    if valor is None:
+        return '\x00'
+    if isinstance(valor, bool):
+        return '1' if valor else '0'
+    if isinstance(valor, float):
+        return f"{valor:.2f}"
+    if isinstance(valor, datetime):
+        return valor.replace(microsecond=0).isoformat() # DATETIME do MySQL não guarda microssegundos
+    if isinstance(valor, date):
+        return valor.isoformat()
+    return str(valor)
+
+def _condicao_da_clinica(tabela, clinica_id):
+    """Linhas de `tabela` que pertencem à clínica: pela coluna clinica_id ou pela chave estrangeira
+    para uma tabela que a tenha. None para tabelas sem vínculo com clínicas (copiadas inteiras)."""
+    if tabela.name == Clinica.__tablename__:
+        return tabela.c.id == clinica_id
+    if 'clinica_id' in tabela.c:
+        return tabela.c.clinica_id == clinica_id
+    for chave in tabela.foreign_keys:
+        pai = chave.column.table
+        if 'clinica_id' in pai.c:
+            return chave.parent.in_(select(chave.column).where(pai.c.clinica_id == clinica_id))
+    return None
+
+def _contar_e_resumir(conn, tabela, colunas, tamanho_lote, condicao=None):
+    """Número de linhas e SHA-256 das linhas em ordem de id, lidas em streaming."""
+    sha, total = hashlib.sha256(), 0
+    consulta = select(*colunas).order_by(*tabela.primary_key.columns)
+    resultado = conn.execution_options(stream_results=True, yield_per=tamanho_lote).execute(
+        consulta if condicao is None else consulta.where(condicao))
+    for linha in resultado:
+        sha.update('\x1f'.join(map(_valor_checksum, linha)).encode() + b'\x1e')
+        total += 1
+    conn.rollback()
+    return total, sha.hexdigest()
+
+def migrar_dados(url_origem, tamanho_lote=1000, retomar=False, limpar_destino=False, ao_gravar_lote=None, clinica_id=None):
+    """Copia os dados de `url_origem` (só os da clínica `clinica_id`, se informada) para o banco da
+    aplicação. Retorna, por tabela, as linhas copiadas e o resultado da verificação
+    ({'copiadas', 'origem', 'destino', 'ok'})."""
+    if retomar and limpar_destino:
+        raise RuntimeError("Use --retomar ou --limpar-destino, não os dois.")
+    origem_engine = create_engine(url_origem)
+    if origem_engine.url == db.engine.url:
+        raise RuntimeError("A origem é o próprio banco da aplicação (DATABASE_URL).")
+    aplicar_migracoes() # Cria no destino as tabelas, colunas e índices que faltarem
+
+    resumo = {}
+    with origem_engine.connect() as origem, db.engine.connect() as destino:
+        existentes = set(inspect(origem).get_table_names())
+        if clinica_id is not None and Clinica.__tablename__ not in existentes:
+            raise RuntimeError("A origem não tem clínicas (esquema anterior); copie sem --clinica.")
+        tabelas = [t for t in db.metadata.sorted_tables if t.name in existentes and t.name not in TABELAS_FORA_DA_MIGRACAO]
+        # Só as colunas que a origem tem; as demais recebem o padrão do model (origem com esquema mais antigo)
+        colunas = {t.name: [c for c in t.columns if c.name in {col['name'] for col in inspect(origem).get_columns(t.name)}]
+                   for t in tabelas}
+        condicoes = {t.name: _condicao_da_clinica(t, clinica_id) if clinica_id is not None else None for t in tabelas}
+        origem.rollback()
+        mysql = destino.dialect.name == 'mysql'
+        if mysql:
+            # Como no mysqldump: o SQLite não impõe chaves estrangeiras, e os ids são mantidos
+            destino.execute(text("SET FOREIGN_KEY_CHECKS = 0"))
+
+        if limpar_destino:
+            for tabela in reversed(tabelas):
+                destino.execute(tabela.delete())
+            destino.commit()
+        elif not retomar:
+            ocupadas = [t.name for t in tabelas if destino.execute(select(func.count()).select_from(t)).scalar()]
+            destino.rollback()
+            if ocupadas:
+                raise RuntimeError(f"O destino já tem dados em {', '.join(ocupadas)}. "
+                                   "Use --retomar para continuar uma cópia ou --limpar-destino para substituí-los.")
+
+        for tabela in tabelas:
+            chave = tabela.primary_key.columns[0]
+            consulta = select(*colunas[tabela.name]).order_by(chave)
+            if condicoes[tabela.name] is not None:
+                consulta = consulta.where(condicoes[tabela.name])
+            if retomar:
+                ultimo_id = destino.execute(select(func.max(chave))).scalar()
+                destino.rollback()
+                if ultimo_id is not None:
+                    consulta = consulta.where(chave > ultimo_id)
+            copiadas = 0
+            resultado = origem.execution_options(stream_results=True, yield_per=tamanho_lote).execute(consulta)
+            for lote in resultado.mappings().partitions(tamanho_lote):
+                linhas = [dict(linha) for linha in lote]
+                if mysql:
+                    for linha in linhas:
+                        for nome, valor in linha.items():
+                            if isinstance(valor, datetime):
+                                linha[nome] = valor.replace(microsecond=0) # Trunca em vez de deixar o MySQL arredondar
+                destino.execute(tabela.insert(), linhas) # executemany: INSERT com várias linhas no PyMySQL
+                destino.commit()
+                copiadas += len(linhas)
+                if ao_gravar_lote:
+                    ao_gravar_lote(tabela.name, copiadas)
+            origem.rollback()
+            resumo[tabela.name] = {'copiadas': copiadas}
+
+        if destino.dialect.name == 'sqlite':
+            reconstruir_indice_busca_historico(destino) # Os INSERTs em lote não passam pelos eventos do ORM
+            destino.commit()
+
+        for tabela in tabelas:
+            total_origem, sha_origem = _contar_e_resumir(origem, tabela, colunas[tabela.name], tamanho_lote, condicoes[tabela.name])
+            total_destino, sha_destino = _contar_e_resumir(destino, tabela, colunas[tabela.name], tamanho_lote, condicoes[tabela.name])
+            resumo[tabela.name].update(origem=total_origem, destino=total_destino,
+                                       ok=total_origem == total_destino and sha_origem == sha_destino)
+    origem_engine.dispose()
+    return resumo
+
+
+# --- Verificação de Planos de Consulta ---
+# Consultas executadas com frequência pelas rotas; nenhuma deve varrer a tabela inteira. Nas
+# rotas o filtro da clínica é aplicado automaticamente; aqui (fora de requisições) ele é explícito.
+def _consultas_criticas():
+    hoje = datetime.now(timezone.utc).date()
+    clinica = CLINICA_PADRAO_ID
+    return {
+        'agenda_dentista': Appointment.query.filter_by(clinica_id=clinica, dentista_id=1, appointment_date=hoje),
+        'agenda_do_dia': Appointment.query.filter_by(clinica_id=clinica, appointment_date=hoje),
+        'agenda_arquivada_dentista': AppointmentArquivado.query.filter(
+            AppointmentArquivado.clinica_id == clinica, AppointmentArquivado.dentista_id == 1,
+            AppointmentArquivado.appointment_date >= hoje - timedelta(days=7)),
+        'pagamentos_pendentes': Pagamento.query.filter_by(clinica_id=clinica, status='pendente').order_by(Pagamento.data_pagamento.desc()),
+        'dentistas_da_clinica': Usuario.query.filter_by(clinica_id=clinica, perfil='comum', status='ativo'),
+        'pacientes_da_clinica': Paciente.query.filter_by(clinica_id=clinica).order_by(Paciente.nome_completo),
+        'orcamentos_paciente': Budget.query.filter_by(patient_id=1),
+        'procedimentos_orcamento': BudgetProcedure.query.filter_by(budget_id=1),
+        'historico_paciente': HistoricoPaciente.query.filter_by(patient_id=1).order_by(HistoricoPaciente.created_at.desc()),
+    }
+
+def verificar_planos_de_consulta():
+    """Retorna {nome_consulta: [linhas do plano]} para as consultas críticas que fazem varredura completa."""
+    dialeto = db.engine.dialect
+    varreduras = {}
+    for nome, query in _consultas_criticas().items():
+        sql = str(query.statement.compile(dialect=dialeto, compile_kwargs={'literal_binds': True}))
+        if dialeto.name == 'sqlite':
+            plano = [linha[-1] for linha in db.session.execute(text(f"EXPLAIN QUERY PLAN {sql}"))]
+            varredura_completa = any(p.startswith('SCAN') and 'USING' not in p for p in plano)
+        elif dialeto.name == 'mysql':
+            linhas = db.session.execute(text(f"EXPLAIN {sql}")).mappings().all()
+            plano = [f"{l['table']}: type={l['type']} key={l['key']}" for l in linhas]
+            varredura_completa = any(l['type'] == 'ALL' for l in linhas)
+        else:
+            continue
+        if varredura_completa:
+            varreduras[nome] = plano
+    return varreduras
+
+
+@app.cli.command('migrar')
+def migrar_command():
+    """Aplica as migrações de esquema pendentes."""
+    aplicadas = aplicar_migracoes()
+    print(f"Migrações aplicadas: {aplicadas}" if aplicadas else "Esquema já está atualizado.")
+
+@app.cli.command('criar-admin')
+def criar_admin_command():
+    """Cria (ou verifica) o usuário admin padrão definido por ADMIN_EMAIL/ADMIN_NOME/ADMIN_SENHA."""
+    garantir_admin_padrao()
+
+@app.cli.command('criar-clinica')
+@click.argument('nome')
+@click.option('--admin-usuario', required=True, help='Username do primeiro administrador da clínica.')
+@click.option('--admin-email', required=True)
+@click.option('--admin-senha', required=True)
+@click.option('--admin-nome', default=None, help='Nome exibido (padrão: o username).')
+def criar_clinica_command(nome, admin_usuario, admin_email, admin_senha, admin_nome):
+    """Cria uma clínica e o primeiro administrador dela."""
+    if Clinica.query.filter_by(nome=nome).first():
+        raise SystemExit(f"Já existe uma clínica chamada '{nome}'.")
+    if Usuario.query.filter((Usuario.username == admin_usuario) | (Usuario.email == admin_email)).first():
+        raise SystemExit("Username ou email do administrador já cadastrado (são únicos entre as clínicas).")
+    if not Clinica.query.first():
+        garantir_clinica_padrao(db.session.connection()) # A clínica padrão fica com o id 1 (padrão da coluna clinica_id)
+    clinica = Clinica(nome=nome)
+    db.session.add(clinica)
+    db.session.flush()
+    admin = Usuario(username=admin_usuario, nome=admin_nome or admin_usuario, email=admin_email, perfil='admin', clinica_id=clinica.id)
+    admin.set_password(admin_senha)
+    db.session.add(admin)
+    db.session.commit()
+    print(f"Clínica '{clinica.nome}' criada (id {clinica.id}) com o administrador '{admin.username}'.")
+
+@app.cli.command('reindexar-historico')
+def reindexar_historico_command():
+    """Reconstrói o índice de busca textual do histórico clínico."""
+    with db.engine.begin() as conn:
+        total = reconstruir_indice_busca_historico(conn)
+    print(f"{total} registros de histórico indexados.")
+
+@app.cli.command('limpar-excluidos')
+def limpar_excluidos_command():
+    """Remove definitivamente os registros excluídos logicamente e os arquivos órfãos."""
+    print(f"Limpeza concluída: {executar_limpeza()}")
+
+@app.cli.command('arquivar')
+@click.option('--dias', type=int, default=None, help='Arquiva o que for mais antigo que N dias (padrão: ARCHIVE_AFTER_DAYS).')
+def arquivar_command(dias):
+    """Move agendamentos e pagamentos processados antigos para as tabelas de arquivo."""
+    if not (dias or app.config['ARCHIVE_AFTER_DAYS']):
+        raise SystemExit("Informe --dias ou defina ARCHIVE_AFTER_DAYS.")
+    print(f"Arquivamento concluído: {executar_arquivamento(dias)}")
+
+@app.cli.command('backup')
+@click.option('--retencao', type=int, default=None, help='Snapshots mantidos (padrão: BACKUP_RETENTION).')
+def backup_command(retencao):
+    """Grava um snapshot online, comprimido e com checksum do banco SQLite em BACKUP_DIR."""
+    try:
+        resultado = criar_backup(retencao=retencao)
+    except RuntimeError as e:
+        raise SystemExit(str(e))
+    print(f"Backup gravado: {resultado}")
+
+@app.cli.command('verificar-backup')
+@click.argument('arquivo', required=False)
+def verificar_backup_command(arquivo):
+    """Confere checksum e integridade de um snapshot (padrão: o mais recente). Falha com código 1."""
+    if not arquivo:
+        backups = listar_backups()
+        if not backups:
+            raise SystemExit(f"Nenhum backup encontrado em {app.config['BACKUP_DIR']}.")
+        arquivo = backups[0]
+    resultado = verificar_backup(arquivo)
+    print(json.dumps(resultado, indent=2, ensure_ascii=False))
+    if not resultado['ok']:
+        raise SystemExit(1)
+
+@app.cli.command('migrar-dados')
+@click.option('--origem', required=True, help='URL do banco de origem (ex.: sqlite:////app/instance/dentist.db).')
+@click.option('--lote', type=int, default=1000, help='Linhas por lote (e por commit).')
+@click.option('--retomar', is_flag=True, help='Continua uma cópia interrompida a partir do maior id já gravado.')
+@click.option('--limpar-destino', is_flag=True, help='Apaga os dados do destino antes de copiar.')
+@click.option('--clinica', type=int, default=None, help='Copia apenas os dados desta clínica (id).')
+def migrar_dados_command(origem, lote, retomar, limpar_destino, clinica):
+    """Copia os dados de outro banco para o de DATABASE_URL e confere contagens e checksums (código 1 se divergirem)."""
+    def progresso(tabela, copiadas):
+        if copiadas % (lote * 50) < lote:
+            print(f"  {tabela}: {copiadas} linhas copiadas")
+    try:
+        resumo = migrar_dados(origem, lote, retomar, limpar_destino, ao_gravar_lote=progresso, clinica_id=clinica)
+    except RuntimeError as e:
+        raise SystemExit(str(e))
+    print(f"{'tabela':25} {'copiadas':>10} {'origem':>10} {'destino':>10}")
+    for nome, r in resumo.items():
+        print(f"{nome:25} {r['copiadas']:>10} {r['origem']:>10} {r['destino']:>10}  {'OK' if r['ok'] else 'DIVERGENTE'}")
+    if not all(r['ok'] for r in resumo.values()):
+        raise SystemExit(1)
+    print("Migração concluída e verificada.")
+
+@app.cli.command('comprimir-historico')
+@click.option('--lote', type=int, default=500, help='Anotações regravadas por transação.')
+def comprimir_historico_command(lote):
+    """Comprime as anotações (SQLite) e os anexos já existentes que passam de COMPRESS_MIN_BYTES."""
+    limite = app.config['COMPRESS_MIN_BYTES']
+    if limite <= 0:
+        raise SystemExit("Compressão desativada (COMPRESS_MIN_BYTES=0).")
+    anotacoes = 0
+    if db.engine.dialect.name == 'sqlite':
+        tabela = HistoricoPaciente.__table__
+        regravar = update(tabela).where(tabela.c.id == bindparam('b_id')).values(historico=bindparam('b_historico', type_=TextoComprimido))
+        ultimo_id = 0
+        while True:
+            with db.engine.begin() as conn:
+                linhas = conn.execute(
+                    select(tabela.c.id, tabela.c.historico)
+                    .where(tabela.c.id > ultimo_id, func.typeof(tabela.c.historico) == 'text', func.length(tabela.c.historico) >= limite // 4)
+                    .order_by(tabela.c.id).limit(lote)
+                ).all()
+                if not linhas:
+                    break
+                conn.execute(regravar, [{'b_id': id_, 'b_historico': historico} for id_, historico in linhas])
+            ultimo_id = linhas[-1][0]
+            anotacoes += len(linhas)
+    anexos = 0
+    if os.path.isdir(UPLOAD_DIR):
+        for entrada in os.scandir(UPLOAD_DIR):
+            if entrada.is_file() and not entrada.name.endswith((SUFIXO_ANEXO_COMPRIMIDO, '.tmp')):
+                anexos += comprimir_anexo(entrada.path)
+    print(f"Anotações verificadas: {anotacoes}. Anexos comprimidos: {anexos}.")
+
+@app.cli.command('verificar-planos')
+def verificar_planos_command():
+    """Falha (código 1) se alguma consulta crítica regredir para varredura completa de tabela."""
+    varreduras = verificar_planos_de_consulta()
+    for nome, plano in varreduras.items():
+        print(f"[VARREDURA COMPLETA] {nome}: {' | '.join(plano)}")
+    if varreduras:
+        raise SystemExit(1)
+    print("Todas as consultas críticas usam índices.")
+
+# --- Esquemas de Validação ---
+# Campos que o cliente não envia para pacientes (os demais são mantidos pelo servidor)
+CAMPOS_NAO_EDITAVEIS_PACIENTE = {'id', 'cadastrado_em', 'nome_completo', 'versao', 'deleted_at', 'is_fully_registered', 'clinica_id'}
+
+def _campo_da_coluna(coluna):
+    """Regra padrão derivada do tipo e do tamanho da coluna."""
+    if isinstance(coluna.type, db.Date):
+        return Campo(data_aaaa_mm_dd)
+    if isinstance(coluna.type, db.Boolean):
+        return Campo(booleano, padrao=False)
+    return Campo(texto(getattr(coluna.type, 'length', None)))
+
+ESQUEMA_PACIENTE = Esquema({
+    **{c.key: _campo_da_coluna(c) for c in Paciente.__table__.columns if c.key not in CAMPOS_NAO_EDITAVEIS_PACIENTE},
+    'nome': Campo(texto(100), obrigatorio="Nome é obrigatório."),
+    'data_nascimento': Campo(data_aaaa_mm_dd, mensagem="Formato de data de nascimento inválido. Use YYYY-MM-DD."),
+    'cpf': Campo(cpf_valido, mensagem="CPF inválido."),
+    'email': Campo(email_valido, mensagem="Email inválido."),
+    'celular': Campo(telefone_valido, mensagem="Número de celular inválido."),
+    'fone_fixo': Campo(telefone_valido, mensagem="Número de telefone fixo inválido."),
+})
+
+ESQUEMA_USUARIO = Esquema({
+    'username': Campo(texto(80), obrigatorio="Nome de usuário é obrigatório."),
+    'nome': Campo(texto(100), obrigatorio="Nome é obrigatório."),
+    'email': Campo(email_valido, obrigatorio="Email é obrigatório.", mensagem="Email inválido."),
+    'password': Campo(texto(), obrigatorio="Senha é obrigatória."),
+    'perfil': Campo(escolha('admin', 'comum'), padrao='comum', mensagem="Perfil inválido. Use 'admin' ou 'comum'."),
+})
+
+def _paciente_informado(valores):
+    if not valores['patient_id'] and not valores['patient_name']:
+        return {'patient_name': "Nome do paciente ou ID do paciente é obrigatório."}
+    return {}
+
+ESQUEMA_AGENDAMENTO = Esquema({
+    'patient_id': Campo(inteiro(minimo=1)),
+    'patient_name': Campo(texto(201)),
+    'dentista_id': Campo(inteiro(minimo=1)),
+    'appointment_date': Campo(data_aaaa_mm_dd, obrigatorio="Data do agendamento é obrigatória.",
+                              mensagem="Formato de data inválido. Use YYYY-MM-DD."),
+    'appointment_time': Campo(hora, obrigatorio="Hora do agendamento é obrigatória."),
+    'duration_minutes': Campo(inteiro(minimo=5, maximo=24 * 60), padrao=30),
+    'observacao': Campo(texto()),
+}, regras=[_paciente_informado])
+
+ESQUEMA_PROCEDIMENTO = Esquema({
+    'table_name': Campo(texto(100), padrao=''),
+    'description': Campo(texto(200), padrao=''),
+    'tooth': Campo(texto(10), padrao=''),
+    'dentist': Campo(texto(100), padrao=''),
+    'value': Campo(decimal(minimo=0), padrao=0.0, mensagem="Valor do procedimento inválido."),
+})
+
+ESQUEMA_ORCAMENTO = Esquema({
+    'patient_id': Campo(inteiro(minimo=1), obrigatorio="ID do paciente é obrigatório."),
+    'clinic_name': Campo(texto(100)), # Padrão: nome da clínica do usuário
+    'observations': Campo(texto(), padrao=''),
+    'procedures': Campo(lista(ESQUEMA_PROCEDIMENTO, minimo=1), obrigatorio="Informe ao menos um procedimento."),
+})
+
+ESQUEMA_PAGAMENTOS_LOTE = Esquema({
+    'acao': Campo(escolha('aprovar', 'rejeitar'), obrigatorio=True, mensagem="Ação inválida. Use 'aprovar' ou 'rejeitar'."),
+    'ids': Campo(lista(inteiro(minimo=1), minimo=1), obrigatorio="Informe uma lista de IDs de pagamentos."),
+})
+
+MAX_DIAS_LOTE_AGENDAMENTOS = 62 # Período máximo de uma operação em lote na agenda
+
+def _periodo_lote_agendamentos(valores):
+    fim = valores['data_fim'] or valores['data_inicio']
+    if fim < valores['data_inicio']:
+        return {'data_fim': "Data final deve ser igual ou posterior à data inicial."}
+    if (fim - valores['data_inicio']).days >= MAX_DIAS_LOTE_AGENDAMENTOS:
+        return {'data_fim': f"O período deve ter no máximo {MAX_DIAS_LOTE_AGENDAMENTOS} dias."}
+    if valores['acao'] == 'mover' and not valores['dias'] and not valores['novo_dentista_id']:
+        return {'dias': "Informe os dias de deslocamento e/ou o novo_dentista_id."}
+    return {}
+
+ESQUEMA_AGENDAMENTOS_LOTE = Esquema({
+    'acao': Campo(escolha('mover', 'cancelar'), obrigatorio=True, mensagem="Ação inválida. Use 'mover' ou 'cancelar'."),
+    'dentista_id': Campo(inteiro(minimo=1)),
+    'data_inicio': Campo(data_aaaa_mm_dd, obrigatorio="Data inicial é obrigatória.", mensagem="Formato de data inválido. Use YYYY-MM-DD."),
+    'data_fim': Campo(data_aaaa_mm_dd, mensagem="Formato de data inválido. Use YYYY-MM-DD."),
+    'dias': Campo(inteiro(minimo=-365, maximo=365), padrao=0),
+    'novo_dentista_id': Campo(inteiro(minimo=1)),
+    'simular': Campo(booleano, padrao=False),
+}, regras=[_periodo_lote_agendamentos])
+
+ESQUEMA_MESCLAGEM_PACIENTES = Esquema({
+    'duplicados': Campo(lista(inteiro(minimo=1), minimo=1, maximo=50), obrigatorio="Informe os IDs dos pacientes duplicados."),
+})
+
+
 # Routes
 @app.route('/api/login', methods=['POST'])
 def login():
@@ -385,6 +2827,7 @@ def login():
     token_payload = {
         'user_id': user.id,
         'perfil': user.perfil,
+        'clinica_id': user.clinica_id,
         'exp': datetime.now(timezone.utc) + timedelta(hours=24) # Token expira em 24 horas
     }
     token = jwt.encode(token_payload, app.config['JWT_SECRET_KEY'], algorithm="HS256")
@@ -396,29 +2839,53 @@ def login():
         'user': user.to_dict() # Retorna dados do usuário, incluindo perfil
     })
 
-@app.route("/api/usuarios", methods=["POST"])
-@admin_required # Apenas admins podem criar novos usuários (dentistas/admins)
-def create_usuario(current_user):
-    data = request.get_json()
-    username = data.get('username')
-    nome = data.get('nome')
-    email = data.get('email')
-    password = data.get('password')
-    perfil = data.get('perfil', 'comum')
+@app.route('/api/bootstrap', methods=['GET'])
+@token_required
+@cache_resposta('usuarios', 'appointments', 'pacientes', 'pagamentos', escopo=escopo_usuario)
+def bootstrap(current_user):
+    """Dados da tela inicial em uma única resposta: usuário, dentistas ativos, agenda de
+    hoje e amanhã e, para admins, o resumo dos pagamentos pendentes."""
+    hoje = datetime.now(timezone.utc).date()
+    amanha = hoje + timedelta(days=1)
 
-    if not username or not nome or not email or not password:
-        return jsonify({"success": False, "message": "Nome de usuário, nome, email e senha são obrigatórios."}), 400
+    dentistas = Usuario.query.filter_by(perfil='comum', status='ativo').order_by(Usuario.nome).all()
 
-    if not is_valid_email(email):
-        return jsonify({"success": False, "message": "Email inválido."}), 400
+    # Hoje e amanhã em uma consulta (índice ix_appointments_data / ix_appointments_dentista_data)
+    agenda_query = Appointment.query.filter(Appointment.appointment_date.in_([hoje, amanha]))
+    if current_user.perfil == 'comum':
+        agenda_query = agenda_query.filter_by(dentista_id=current_user.id)
+    agenda = {'hoje': [], 'amanha': []}
+    for appointment in agenda_query.order_by(Appointment.appointment_date, Appointment.appointment_time):
+        agenda['hoje' if appointment.appointment_date == hoje else 'amanha'].append(appointment.to_dict())
 
-    if perfil not in ['admin', 'comum']:
-        return jsonify({"success": False, "message": "Perfil inválido. Use 'admin' ou 'comum'."}), 400
+    resposta = {
+        "success": True,
+        "user": current_user.to_dict(),
+        "dentistas": [dentista.to_dict() for dentista in dentistas],
+        "data_referencia": hoje.isoformat(),
+        "agenda": agenda,
+    }
+    if current_user.perfil == 'admin':
+        quantidade, valor_total = db.session.query(
+            func.count(Pagamento.id), func.coalesce(func.sum(Pagamento.valor), 0.0)
+        ).filter(Pagamento.status == 'pendente').one()
+        resposta["pagamentos_pendentes"] = {"quantidade": quantidade, "valor_total": float(valor_total)}
+    return jsonify(resposta)
 
-    if Usuario.query.filter_by(username=username).first():
+@app.route("/api/usuarios", methods=["POST"])
+@admin_required # Apenas admins podem criar novos usuários (dentistas/admins)
+def create_usuario(current_user):
+    valores, errors = ESQUEMA_USUARIO.validar(request.get_json())
+    if errors:
+        return resposta_erro_validacao(errors)
+    username, nome, email, password, perfil = (
+        valores['username'], valores['nome'], valores['email'], valores['password'], valores['perfil'])
+
+    # Username e email são únicos entre todas as clínicas (o login não informa a clínica)
+    if Usuario.query.execution_options(todas_as_clinicas=True).filter_by(username=username).first():
         return jsonify({"success": False, "message": "Nome de usuário já cadastrado."}), 409
 
-    if Usuario.query.filter_by(email=email).first(): # Email também deve ser único
+    if Usuario.query.execution_options(todas_as_clinicas=True).filter_by(email=email).first(): # Email também deve ser único
         return jsonify({"success": False, "message": "Email já cadastrado."}), 409
 
     try:
@@ -435,6 +2902,7 @@ def create_usuario(current_user):
 
 @app.route("/api/usuarios", methods=["GET"])
 @admin_required
+@cache_resposta('usuarios')
 def get_usuarios(current_user):
     try:
         usuarios = Usuario.query.order_by(Usuario.nome).all()
@@ -503,11 +2971,11 @@ def update_usuario(current_user, user_id):
         return jsonify({"success": False, "message": "Perfil inválido. Use 'admin' ou 'comum'."}), 400
 
     # Verificar unicidade de username se ele foi alterado
-    if novo_username != usuario_alvo.username and Usuario.query.filter_by(username=novo_username).first():
+    if novo_username != usuario_alvo.username and Usuario.query.execution_options(todas_as_clinicas=True).filter_by(username=novo_username).first():
         return jsonify({"success": False, "message": "Novo nome de usuário já está em uso."}), 409
 
     # Verificar unicidade de email se ele foi alterado
-    if novo_email != usuario_alvo.email and Usuario.query.filter_by(email=novo_email).first():
+    if novo_email != usuario_alvo.email and Usuario.query.execution_options(todas_as_clinicas=True).filter_by(email=novo_email).first():
         return jsonify({"success": False, "message": "Novo email já está em uso."}), 409
 
     # Regra de segurança: não permitir que o último admin mude seu perfil para 'comum'
@@ -549,6 +3017,11 @@ def update_usuario(current_user, user_id):
         return jsonify({"success": False, "message": "Erro interno ao atualizar usuário."}), 500
 
 
+def cpf_duplicado(erro):
+    """IntegrityError da unicidade do CPF na clínica (SQLite: pacientes.clinica_id, pacientes.cpf; MySQL: uq_pacientes_clinica_cpf)."""
+    mensagem = str(erro.orig)
+    return "pacientes.cpf" in mensagem or "uq_pacientes_clinica_cpf" in mensagem
+
 @app.route("/api/pacientes", methods=["GET"]) # Renomeado de /api/patients para /api/pacientes
 @token_required
 def get_pacientes(current_user):
@@ -558,96 +3031,14 @@ def get_pacientes(current_user):
 @app.route("/api/pacientes", methods=["POST"]) # Renomeado de /api/patients para /api/pacientes
 @token_required # Todos usuários logados podem cadastrar pacientes
 def create_paciente(current_user):
-    data = request.get_json()
-    errors = {}
-
-    # Validações
-    nome = data.get("nome")
-    if not nome or len(nome.strip()) == 0:
-        errors["nome"] = "Nome é obrigatório."
-
-    # Adicionando validação para sobrenome se for decidido que é obrigatório no backend
-    sobrenome = data.get("sobrenome")
-    # if not sobrenome or len(sobrenome.strip()) == 0: # Descomentar se sobrenome for obrigatório
-    #     errors["sobrenome"] = "Sobrenome é obrigatório."
-
-    cpf = data.get("cpf")
-    if cpf and not is_valid_cpf(cpf):
-        errors["cpf"] = "CPF inválido."
-
-    email = data.get("email")
-    nao_possui_email = data.get("nao_possui_email", False)
-    if not nao_possui_email and email and not is_valid_email(email):
-        errors["email"] = "Email inválido."
-    if nao_possui_email: # Garante que o email seja nulo se a flag estiver ativa
-        email = None
-        data["email"] = None # Atualiza o 'data' para consistência ao criar o Paciente
-
-    celular = data.get("celular")
-    if celular and not is_valid_phone(celular):
-        errors["celular"] = "Número de celular inválido."
-
-    fone_fixo = data.get("fone_fixo")
-    if fone_fixo and not is_valid_phone(fone_fixo): # Mesma validação para fixo
-        errors["fone_fixo"] = "Número de telefone fixo inválido."
-
-    data_nascimento_str = data.get("data_nascimento")
-    data_nascimento_obj = None
-    if data_nascimento_str:
-        try:
-            data_nascimento_obj = datetime.strptime(data_nascimento_str, "%Y-%m-%d").date()
-        except ValueError:
-            errors["data_nascimento"] = "Formato de data de nascimento inválido. Use YYYY-MM-DD."
-    
+    valores, errors = ESQUEMA_PACIENTE.validar(request.get_json())
     if errors:
-        return jsonify({"success": False, "message": "Erro de validação", "errors": errors}), 400
+        return resposta_erro_validacao(errors)
+    if valores["nao_possui_email"]: # Garante que o email seja nulo se a flag estiver ativa
+        valores["email"] = None
 
     try:
-        paciente = Paciente( # Renomeado de Patient para Paciente
-            nome=nome,
-            sobrenome=sobrenome,
-            data_nascimento=data_nascimento_obj,
-            sexo=data.get("sexo"),
-            cpf=cpf,
-            rg=data.get("rg"),
-            estado_civil=data.get("estado_civil"),
-            escolaridade=data.get("escolaridade"),
-            como_conheceu=data.get("como_conheceu"),
-            observacoes=data.get("observacoes"),
-            fone_fixo=fone_fixo,
-            celular=celular,
-            outros_telefones=data.get("outros_telefones"),
-            email=email,
-            nao_possui_email=nao_possui_email,
-            cep=data.get("cep"),
-            cidade=data.get("cidade"),
-            estado=data.get("estado"),
-            endereco=data.get("endereco"),
-            numero=data.get("numero"),
-            bairro=data.get("bairro"),
-            complemento=data.get("complemento"),
-            profissao=data.get("profissao"),
-            local_trabalho=data.get("local_trabalho"),
-            num_prontuario=data.get("num_prontuario"),
-            tempo_trabalho=data.get("tempo_trabalho"),
-            nome_plano=data.get("nome_plano"),
-            numero_plano=data.get("numero_plano"),
-            nome_pai=data.get("nome_pai"),
-            cpf_pai=data.get("cpf_pai"),
-            profissao_pai=data.get("profissao_pai"),
-            rg_pai=data.get("rg_pai"),
-            nome_mae=data.get("nome_mae"),
-            cpf_mae=data.get("cpf_mae"),
-            profissao_mae=data.get("profissao_mae"),
-            rg_mae=data.get("rg_mae"),
-            nome_representante=data.get("nome_representante"),
-            cpf_representante=data.get("cpf_representante"),
-            rg_representante=data.get("rg_representante"),
-            telefone_representante=data.get("telefone_representante"),
-            nascimento_representante=data.get("nascimento_representante"),
-            is_fully_registered=True
-        )
-        
+        paciente = Paciente(**valores, is_fully_registered=True) # Renomeado de Patient para Paciente
         db.session.add(paciente)
         db.session.commit()
         
@@ -655,9 +3046,7 @@ def create_paciente(current_user):
 
     except IntegrityError as e:
         db.session.rollback()
-        if "UNIQUE constraint failed: pacientes.cpf" in str(e) or \
-           "Duplicate entry" in str(e).lower() and "for key 'pacientes.cpf'" in str(e).lower() or \
-           "for key 'cpf'" in str(e).lower() and "pacientes" in str(e).lower() : # Adaptar para a msg do seu DB (SQLite vs MySQL)
+        if cpf_duplicado(e):
             return jsonify({"success": False, "message": "CPF já cadastrado."}), 409
         return jsonify({"success": False, "message": f"Erro de integridade no banco de dados: {str(e)}"}), 500
     except Exception as e:
@@ -669,61 +3058,114 @@ def create_paciente(current_user):
 @token_required
 def get_paciente(current_user, paciente_id): # Renomeado patient_id para paciente_id
     paciente = Paciente.query.get_or_404(paciente_id) # Renomeado de Patient para Paciente
-    return jsonify({
+    resposta = jsonify({
         "success": True,
         "data": paciente.to_dict()
     })
-
-@app.route("/api/pacientes/<int:paciente_id>", methods=["PUT"]) # Renomeado patient_id para paciente_id
+    resposta.set_etag(str(paciente.versao))
+    return resposta
+
+def _versao_if_match():
+    """Versão esperada pelo cliente, do cabeçalho If-Match (ETag) ou None se ausente."""
+    if not request.if_match or request.if_match.star_tag:
+        return None
+    for etag in request.if_match.as_set():
+        if etag.isdigit():
+            return int(etag)
+    return -1
+
+@app.route("/api/pacientes/<int:paciente_id>", methods=["PATCH"])
 @token_required
-def update_paciente(current_user, paciente_id): # Renomeado patient_id para paciente_id
-    paciente = Paciente.query.get_or_404(paciente_id) # Renomeado de Patient para Paciente
-    data = request.get_json()
-    errors = {}
-
-    # Validações (exemplo para alguns campos, aplicar a todos que precisam)
-    if "nome" in data and (not data["nome"] or len(data["nome"].strip()) == 0):
-        errors["nome"] = "Nome é obrigatório."
-
-    if "cpf" in data and data["cpf"] and not is_valid_cpf(data["cpf"]):
-        errors["cpf"] = "CPF inválido."
-    
-    email_update = data.get("email")
-    nao_possui_email_update = data.get("nao_possui_email", paciente.nao_possui_email) # Usa valor existente se não fornecido
-
-    if not nao_possui_email_update and email_update and not is_valid_email(email_update):
-        errors["email"] = "Email inválido."
+def patch_paciente(current_user, paciente_id):
+    paciente = Paciente.query.get_or_404(paciente_id)
+    data = request.get_json() or {}
 
-    if nao_possui_email_update:
-        data["email"] = None # Garante que o email seja nulo se a flag estiver ativa
+    versao_esperada = _versao_if_match()
+    if versao_esperada is not None and versao_esperada != paciente.versao:
+        return jsonify({
+            "success": False,
+            "message": "O paciente foi alterado por outro usuário. Recarregue os dados e tente novamente.",
+            "data": paciente.to_dict()
+        }), 412
 
-    if "data_nascimento" in data and data["data_nascimento"]:
+    novos_valores, errors = ESQUEMA_PACIENTE.validar(data, parcial=True, rejeitar_desconhecidos=True)
+    if errors:
+        return resposta_erro_validacao(errors)
+    if novos_valores.get("nao_possui_email", paciente.nao_possui_email) and \
+            ("nao_possui_email" in novos_valores or novos_valores.get("email")):
+        novos_valores["email"] = None
+
+    # Diferença em relação ao estado atual ('' e None são considerados iguais)
+    alteracoes = {}
+    for campo, novo in novos_valores.items():
+        atual = getattr(paciente, campo)
+        if (atual if atual != '' else None) != (novo if novo != '' else None):
+            alteracoes[campo] = {
+                'de': atual.isoformat() if hasattr(atual, 'isoformat') else atual,
+                'para': novo.isoformat() if hasattr(novo, 'isoformat') else novo
+            }
+
+    if alteracoes:
+        for campo in alteracoes:
+            setattr(paciente, campo, novos_valores[campo])
+        if not paciente.is_fully_registered:
+            paciente.is_fully_registered = True
         try:
-            datetime.strptime(data["data_nascimento"], "%Y-%m-%d").date()
-        except ValueError:
-            errors["data_nascimento"] = "Formato de data de nascimento inválido. Use YYYY-MM-DD."
+            db.session.commit()
+        except StaleDataError:
+            db.session.rollback()
+            return jsonify({"success": False, "message": "O paciente foi alterado por outro usuário. Recarregue os dados e tente novamente."}), 412
+        except IntegrityError as e:
+            db.session.rollback()
+            if cpf_duplicado(e):
+                return jsonify({"success": False, "message": "CPF já cadastrado para outro paciente."}), 409
+            return jsonify({"success": False, "message": f"Erro de integridade no banco de dados: {str(e)}"}), 500
+        except Exception as e:
+            db.session.rollback()
+            app.logger.error(f"Erro ao atualizar parcialmente o paciente {paciente_id}: {str(e)}")
+            return jsonify({"success": False, "message": "Erro interno ao atualizar paciente."}), 500
+
+    resposta = jsonify({
+        "success": True,
+        "message": "Paciente atualizado com sucesso" if alteracoes else "Nenhuma alteração",
+        "versao": paciente.versao,
+        "alteracoes": alteracoes
+    })
+    resposta.set_etag(str(paciente.versao))
+    return resposta
 
+@app.route("/api/pacientes/<int:paciente_id>", methods=["PUT"]) # Renomeado patient_id para paciente_id
+@token_required
+def update_paciente(current_user, paciente_id): # Renomeado patient_id para paciente_id
+    paciente = Paciente.query.get_or_404(paciente_id) # Renomeado de Patient para Paciente
+    # PUT aceita o registro completo enviado pelo formulário; campos mantidos pelo servidor são ignorados
+    dados = request.get_json()
+    if isinstance(dados, dict) and paciente.cpf and isinstance(dados.get('cpf'), str) and \
+       RE_NAO_DIGITOS.sub('', dados['cpf']) == RE_NAO_DIGITOS.sub('', paciente.cpf):
+        # CPF reenviado sem alteração: cadastros antigos só passaram pela checagem de formato,
+        # então os dígitos verificadores são conferidos apenas quando o CPF muda.
+        dados = {campo: valor for campo, valor in dados.items() if campo != 'cpf'}
+    valores, errors = ESQUEMA_PACIENTE.validar(dados, parcial=True)
     if errors:
-        return jsonify({"success": False, "message": "Erro de validação", "errors": errors}), 400
+        return resposta_erro_validacao(errors)
+    if valores.get("nao_possui_email", paciente.nao_possui_email):
+        valores["email"] = None # Garante que o email seja nulo se a flag estiver ativa
 
     try:
-        for field in data:
-            if field == "data_nascimento" and data[field]:
-                setattr(paciente, field, datetime.strptime(data[field], "%Y-%m-%d").date())
-            elif hasattr(paciente, field):
-                if field == "nao_possui_email" and data[field] is True:
-                    paciente.email = None
-                setattr(paciente, field, data[field])
+        for campo, valor in valores.items():
+            setattr(paciente, campo, valor)
         
         paciente.is_fully_registered = True # Garante que está marcado como completo
         db.session.commit()
         return jsonify({"success": True, "message": "Paciente atualizado com sucesso"})
 
+    except StaleDataError:
+        db.session.rollback()
+        return jsonify({"success": False, "message": "O paciente foi alterado por outro usuário. Recarregue os dados e tente novamente."}), 409
+
     except IntegrityError as e:
         db.session.rollback()
-        if "UNIQUE constraint failed: pacientes.cpf" in str(e) or \
-           "Duplicate entry" in str(e).lower() and "for key 'pacientes.cpf'" in str(e).lower() or \
-           "for key 'cpf'" in str(e).lower() and "pacientes" in str(e).lower():
+        if cpf_duplicado(e):
             return jsonify({"success": False, "message": "CPF já cadastrado para outro paciente."}), 409
         return jsonify({"success": False, "message": f"Erro de integridade no banco de dados: {str(e)}"}), 500
     except Exception as e:
@@ -737,8 +3179,14 @@ def delete_paciente(current_user, paciente_id): # Renomeado patient_id para paci
     paciente = Paciente.query.get_or_404(paciente_id) # Renomeado de Patient para Paciente
     
     try:
-        # Adicionar verificação se há dependências (agendamentos, pagamentos) antes de excluir se necessário
-        db.session.delete(paciente)
+        # Exclusão lógica: o paciente some das consultas imediatamente; agendamentos, pagamentos,
+        # orçamentos e histórico são removidos em lotes pela limpeza em segundo plano.
+        paciente.cpf = None # Libera o CPF (único na clínica) para um novo cadastro; o valor antigo fica na auditoria
+        paciente.deleted_at = datetime.now(timezone.utc)
+        # Os agendamentos e pagamentos dele deixam de aparecer já (ver _filtrar_excluidos): invalida
+        # as respostas em cache e os feeds .ics que os incluíam
+        _marcar_tabelas_alteradas(db.session, TABELAS_COM_NOMES_COPIADOS)
+        marcar_agendas_do_paciente(db.session.connection(), paciente.id)
         db.session.commit()
         return jsonify({"success": True, "message": "Paciente excluído com sucesso"})
         
@@ -746,19 +3194,149 @@ def delete_paciente(current_user, paciente_id): # Renomeado patient_id para paci
         db.session.rollback()
         return jsonify({"success": False, "message": f"Erro ao excluir paciente: {str(e)}"}), 500
 
+@app.route("/api/pacientes/duplicados", methods=["GET"])
+@admin_required
+def get_pacientes_duplicados(current_user):
+    limiar = min(max(request.args.get('limiar', 0.85, type=float), 0.0), 1.0)
+    limite = min(max(request.args.get('limite', 200, type=int), 1), 1000)
+    return jsonify({"success": True, **encontrar_duplicados(limiar, limite)})
+
+@app.route("/api/pacientes/<int:paciente_id>/mesclar", methods=["POST"])
+@admin_required
+def mesclar_pacientes_route(current_user, paciente_id):
+    valores, errors = ESQUEMA_MESCLAGEM_PACIENTES.validar(request.get_json())
+    if errors:
+        return resposta_erro_validacao(errors)
+    destino = Paciente.query.get_or_404(paciente_id)
+    versao_esperada = _versao_if_match()
+    if versao_esperada is not None and versao_esperada != destino.versao:
+        return jsonify({"success": False, "message": "O paciente foi alterado por outro usuário. Recarregue os dados e tente novamente.",
+                        "versao": destino.versao}), 412
+
+    ids = set(valores['duplicados']) - {destino.id}
+    duplicados = Paciente.query.filter(Paciente.id.in_(ids)).order_by(Paciente.id).all()
+    if not ids or len(duplicados) != len(ids):
+        nao_encontrados = sorted(ids - {d.id for d in duplicados})
+        return jsonify({"success": False, "message": f"Pacientes duplicados não encontrados: {nao_encontrados}" if nao_encontrados
+                        else "Informe ao menos um paciente diferente do paciente mantido."}), 404 if nao_encontrados else 400
+
+    try:
+        movidos = mesclar_pacientes(destino, duplicados)
+        db.session.commit()
+        return jsonify({
+            "success": True,
+            "message": f"{len(duplicados)} paciente(s) mesclado(s) em {destino.nome_completo}.",
+            "data": destino.to_dict(),
+            "registros_movidos": movidos,
+        })
+    except StaleDataError:
+        db.session.rollback()
+        return jsonify({"success": False, "message": "O paciente foi alterado por outro usuário. Tente novamente."}), 409
+    except Exception as e:
+        db.session.rollback()
+        app.logger.error(f"Erro ao mesclar pacientes em {paciente_id}: {str(e)}")
+        return jsonify({"success": False, "message": "Erro interno ao mesclar pacientes."}), 500
+
+
+# --- Eventos de Agenda em Tempo Real (Server-Sent Events) ---
+# Cada assinante recebe uma fila própria; as rotas de escrita publicam após o commit, apenas
+# para os assinantes da clínica da requisição.
+# O canal é por processo: rode com um único worker assíncrono (gunicorn -k gevent, ver
+# gunicorn.conf.py) para que centenas de conexões ociosas não ocupem uma thread cada.
+class CanalAgendamentos:
+    def __init__(self, tamanho_fila=100):
+        self._lock = threading.Lock()
+        self._assinantes = []
+        self._tamanho_fila = tamanho_fila
+
+    def assinar(self, clinica_id, dentista_id=None):
+        fila = queue.Queue(maxsize=self._tamanho_fila)
+        with self._lock:
+            self._assinantes.append((fila, clinica_id, dentista_id))
+        return fila
+
+    def cancelar(self, fila):
+        with self._lock:
+            self._assinantes = [a for a in self._assinantes if a[0] is not fila]
+
+    def publicar(self, tipo, dados, *dentista_ids):
+        mensagem = f"event: {tipo}\ndata: {json.dumps(dados, ensure_ascii=False)}\n\n"
+        clinica_id = clinica_atual()
+        with self._lock:
+            assinantes = list(self._assinantes)
+        for fila, clinica_assinante, filtro in assinantes:
+            if clinica_assinante != clinica_id:
+                continue
+            if filtro is None or filtro in dentista_ids:
+                try:
+                    fila.put_nowait(mensagem)
+                except queue.Full:
+                    pass # Cliente lento: perde o evento e recarrega a agenda ao reconectar
+
+canal_agendamentos = CanalAgendamentos()
+INTERVALO_HEARTBEAT_SSE = 15 # segundos
+VALIDADE_TICKET_STREAM = 60 # segundos
+
+@app.route("/api/appointments/stream/ticket", methods=["POST"])
+@token_required
+def ticket_stream_appointments(current_user):
+    # EventSource não envia cabeçalhos customizados, então a credencial do stream vai na query
+    # string. Em vez do token de sessão (24 h), que ficaria nos logs de acesso, o cliente troca
+    # o token por este ticket de curta duração, que só é aceito por /api/appointments/stream
+    ticket = jwt.encode({
+        'user_id': current_user.id,
+        'clinica_id': current_user.clinica_id,
+        'proposito': 'stream',
+        'exp': datetime.now(timezone.utc) + timedelta(seconds=VALIDADE_TICKET_STREAM)
+    }, app.config['JWT_SECRET_KEY'], algorithm="HS256")
+    return jsonify({'success': True, 'ticket': ticket, 'expira_em_s': VALIDADE_TICKET_STREAM})
+
+@app.route("/api/appointments/stream", methods=["GET"])
+def stream_appointments():
+    current_user, erro = _usuario_do_token(request.args.get('ticket'), proposito='stream')
+    if erro:
+        return erro
+
+    if current_user.perfil == 'comum':
+        dentista_id = current_user.id
+    else:
+        dentista_id = request.args.get('dentista_id', type=int) # None = clínica inteira
+    clinica_id = current_user.clinica_id
+    db.session.remove() # Não mantém a conexão do banco presa durante o stream
+
+    fila = canal_agendamentos.assinar(clinica_id, dentista_id)
+
+    def eventos():
+        try:
+            yield "retry: 5000\n: conectado\n\n"
+            while True:
+                try:
+                    yield fila.get(timeout=INTERVALO_HEARTBEAT_SSE)
+                except queue.Empty:
+                    yield ": ping\n\n"
+        finally:
+            canal_agendamentos.cancelar(fila)
+
+    return Response(stream_with_context(eventos()), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no' # Desativa buffer em proxies nginx
+    })
 
 @app.route("/api/appointments", methods=["POST"])
 @token_required
+@idempotente
 def create_appointment(current_user):
-    data = request.get_json()
-    patient_name = data.get("patient_name")
-    appointment_date_str = data.get("appointment_date")
-    appointment_time = data.get("appointment_time")
-    observacao = data.get("observacao")
-    duration_minutes = data.get("duration_minutes", 30) # Receber duration_minutes, default 30
+    data, errors = ESQUEMA_AGENDAMENTO.validar(request.get_json())
+    if errors:
+        return resposta_erro_validacao(errors)
+    patient_name = data["patient_name"]
+    appointment_date = data["appointment_date"]
+    appointment_time = data["appointment_time"] # Já normalizado para HH:MM
+    observacao = data["observacao"]
+    duration_minutes = data["duration_minutes"] # Default 30
 
     # Definição do dentista_id: Se admin, pode ser enviado no payload, senão é o próprio usuário logado
-    dentista_id_payload = data.get("dentista_id")
+    dentista_id_payload = data["dentista_id"]
     if current_user.perfil == 'admin' and dentista_id_payload:
         dentista_agendamento_id = dentista_id_payload
         dentista_para_agendamento = Usuario.query.get(dentista_agendamento_id)
@@ -771,18 +3349,7 @@ def create_appointment(current_user):
              return jsonify({"success": False, "message": "Admin deve especificar o dentista_id para o agendamento."}), 400
         dentista_agendamento_id = current_user.id # Fallback, mas idealmente admin sempre especifica
 
-    if not patient_name and not data.get("patient_id"):
-        return jsonify({"success": False, "message": "Nome do paciente ou ID do paciente é obrigatório."}), 400
-
-    if not appointment_date_str or not appointment_time:
-        return jsonify({"success": False, "message": "Data e hora do agendamento são obrigatórios."}), 400
-
-    try:
-        appointment_date = datetime.strptime(appointment_date_str, "%Y-%m-%d").date()
-    except ValueError:
-        return jsonify({"success": False, "message": "Formato de data inválido. Use YYYY-MM-DD."}), 400
-
-    paciente_id_frontend = data.get("patient_id")
+    paciente_id_frontend = data["patient_id"]
     paciente = None
 
     if paciente_id_frontend:
@@ -818,12 +3385,9 @@ def create_appointment(current_user):
             app.logger.error(f"Erro ao criar novo paciente durante agendamento: {str(e)}")
             return jsonify({"success": False, "message": f"Erro ao registrar novo paciente: {str(e)}"}), 500
     
-    try:
-        appointment_time_obj = datetime.strptime(appointment_time, "%H:%M").time()
-        new_start_datetime = datetime.combine(appointment_date, appointment_time_obj)
-        new_end_datetime = new_start_datetime + timedelta(minutes=int(duration_minutes))
-    except ValueError:
-        return jsonify({"success": False, "message": "Formato de hora inválido. Use HH:MM."}), 400
+    appointment_time_obj = datetime.strptime(appointment_time, "%H:%M").time()
+    new_start_datetime = datetime.combine(appointment_date, appointment_time_obj)
+    new_end_datetime = new_start_datetime + timedelta(minutes=duration_minutes)
 
     # Verificar conflitos para o dentista específico
     existing_appointments_query = Appointment.query.filter_by(
@@ -844,8 +3408,7 @@ def create_appointment(current_user):
             existing_end_datetime = existing_start_datetime + timedelta(minutes=existing_app.duration_minutes)
 
             if max(new_start_datetime, existing_start_datetime) < min(new_end_datetime, existing_end_datetime):
-                dentista_conflito = Usuario.query.get(existing_app.dentista_id)
-                nome_dentista_conflito = dentista_conflito.nome if dentista_conflito else "desconhecido"
+                nome_dentista_conflito = existing_app.dentista_nome or "desconhecido"
                 return jsonify({
                     "success": False, 
                     "message": f"Horário em conflito com agendamento existente para Dr(a). {nome_dentista_conflito} às {existing_app.appointment_time} (duração: {existing_app.duration_minutes} min)."
@@ -860,7 +3423,7 @@ def create_appointment(current_user):
         appointment_date=appointment_date,
         appointment_time=appointment_time,
         observacao=observacao,
-        duration_minutes=int(duration_minutes)
+        duration_minutes=duration_minutes
     )
 
     try:
@@ -868,7 +3431,9 @@ def create_appointment(current_user):
         if not paciente.id: # Se o paciente foi criado nesta transação e ainda não foi salvo
              db.session.add(paciente) # Adiciona o paciente à sessão se for novo
         db.session.commit()
-        return jsonify({"success": True, "message": "Agendamento criado com sucesso", "appointment": novo_agendamento.to_dict()}), 201
+        agendamento_dict = novo_agendamento.to_dict()
+        canal_agendamentos.publicar('created', agendamento_dict, novo_agendamento.dentista_id)
+        return jsonify({"success": True, "message": "Agendamento criado com sucesso", "appointment": agendamento_dict}), 201
     except Exception as e:
         db.session.rollback()
         app.logger.error(f"Erro ao salvar agendamento: {str(e)}")
@@ -877,7 +3442,15 @@ def create_appointment(current_user):
 @app.route("/api/appointments", methods=["GET"])
 @token_required
 def get_appointments(current_user):
-    appointments_query = Appointment.query
+    # Período opcional (data_inicio/data_fim, YYYY-MM-DD); sem período, inclui todo o arquivo
+    periodo = {}
+    for parametro in ('data_inicio', 'data_fim'):
+        if request.args.get(parametro):
+            try:
+                periodo[parametro] = data_aaaa_mm_dd(request.args[parametro])
+            except ValueError as e:
+                return resposta_erro_validacao({parametro: str(e)})
+    dentista_id = None
 
     if current_user.perfil == 'admin':
         dentista_id_param = request.args.get('dentista_id', type=int)
@@ -886,7 +3459,7 @@ def get_appointments(current_user):
             target_dentist = Usuario.query.filter_by(id=dentista_id_param, perfil='comum').first()
             if not target_dentist:
                 return jsonify({"success": False, "message": f"Dentista com ID {dentista_id_param} não encontrado ou não é um usuário comum."}), 404
-            appointments_query = appointments_query.filter_by(dentista_id=dentista_id_param)
+            dentista_id = dentista_id_param
         else:
             # Admin não especificou dentista_id, retorna todos os agendamentos (comportamento padrão anterior)
             # Ou poderia retornar uma lista vazia/mensagem para selecionar um dentista.
@@ -894,17 +3467,18 @@ def get_appointments(current_user):
             pass # Nenhuma filtragem adicional por dentista_id se não for fornecido
     elif current_user.perfil == 'comum':
         # Usuário comum só pode ver seus próprios agendamentos
-        appointments_query = appointments_query.filter_by(dentista_id=current_user.id)
+        dentista_id = current_user.id
     else:
         return jsonify({"success": False, "message": "Perfil de usuário desconhecido."}), 403
 
-    appointments = appointments_query.order_by(Appointment.appointment_date, Appointment.appointment_time).all()
+    appointments = buscar_agendamentos(dentista_id, periodo.get('data_inicio'), periodo.get('data_fim'))
 
     # Adicionado success: True e a chave 'appointments' para consistência com outras rotas
     return jsonify({"success": True, "appointments": [appointment.to_dict() for appointment in appointments]})
 
 @app.route("/api/appointments/today", methods=["GET"])
 @token_required
+@cache_resposta('appointments', 'pacientes', 'usuarios', escopo=escopo_dentista)
 def get_appointments_today(current_user):
     today = datetime.now(timezone.utc).date()
     query = Appointment.query.filter_by(appointment_date=today)
@@ -915,6 +3489,7 @@ def get_appointments_today(current_user):
 
 @app.route("/api/appointments/tomorrow", methods=["GET"])
 @token_required
+@cache_resposta('appointments', 'pacientes', 'usuarios', escopo=escopo_dentista)
 def get_appointments_tomorrow(current_user):
     tomorrow = datetime.now(timezone.utc).date() + timedelta(days=1)
     query = Appointment.query.filter_by(appointment_date=tomorrow)
@@ -926,7 +3501,9 @@ def get_appointments_tomorrow(current_user):
 @app.route("/api/appointments/<int:appointment_id>", methods=["GET"])
 @token_required
 def get_appointment_by_id(current_user, appointment_id):
-    appointment = Appointment.query.get_or_404(appointment_id)
+    appointment = db.session.get(Appointment, appointment_id) or db.session.get(AppointmentArquivado, appointment_id)
+    if not appointment:
+        return jsonify({"success": False, "message": "Agendamento não encontrado."}), 404
     if current_user.perfil == 'comum' and appointment.dentista_id != current_user.id:
         return jsonify({"success": False, "message": "Acesso não autorizado a este agendamento."}), 403
     return jsonify(appointment.to_dict())
@@ -934,16 +3511,16 @@ def get_appointment_by_id(current_user, appointment_id):
 @app.route("/api/appointments/<int:appointment_id>", methods=["DELETE"])
 @token_required
 def delete_appointment(current_user, appointment_id):
-    try:
-        appointment = Appointment.query.get_or_404(appointment_id)
-        db.session.delete(appointment)
-        db.session.commit()
-        # Adicionar lógica para verificar se o usuário tem permissão para excluir (ex: admin ou o dentista do agendamento)
-        if current_user.perfil == 'comum' and appointment.dentista_id != current_user.id:
-            return jsonify({"success": False, "message": "Você não tem permissão para excluir este agendamento."}), 403
+    appointment = Appointment.query.get_or_404(appointment_id)
+    # Verifica a permissão antes de excluir: admin ou o dentista do agendamento
+    if current_user.perfil == 'comum' and appointment.dentista_id != current_user.id:
+        return jsonify({"success": False, "message": "Você não tem permissão para excluir este agendamento."}), 403
 
+    try:
+        dentista_id = appointment.dentista_id
         db.session.delete(appointment)
         db.session.commit()
+        canal_agendamentos.publicar('deleted', {'id': appointment_id, 'dentista_id': dentista_id}, dentista_id)
         return jsonify({"success": True, "message": "Agendamento excluído com sucesso"})
     except Exception as e:
         db.session.rollback()
@@ -1004,13 +3581,13 @@ def update_appointment_route(current_user, appointment_id):
         existing_end_datetime = existing_start_datetime + timedelta(minutes=existing_app.duration_minutes)
 
         if max(new_start_dt, existing_start_datetime) < min(new_end_dt, existing_end_datetime):
-            dentista_conflito = Usuario.query.get(existing_app.dentista_id)
-            nome_dentista_conflito = dentista_conflito.nome if dentista_conflito else "desconhecido"
+            nome_dentista_conflito = existing_app.dentista_nome or "desconhecido"
             return jsonify({
                 "success": False, 
                 "message": f"Horário em conflito com outro agendamento para Dr(a). {nome_dentista_conflito} às {existing_app.appointment_time} (duração: {existing_app.duration_minutes} min)."
             }), 409
 
+    dentista_anterior_id = appointment.dentista_id
     appointment.patient_id = new_patient_id
     appointment.dentista_id = new_dentista_id # Atualiza o dentista_id
     appointment.appointment_date = new_appointment_date_obj
@@ -1020,54 +3597,247 @@ def update_appointment_route(current_user, appointment_id):
 
     try:
         db.session.commit()
-        return jsonify({"success": True, "message": "Agendamento atualizado com sucesso", "appointment": appointment.to_dict()})
+        agendamento_dict = appointment.to_dict()
+        # Notifica também a agenda do dentista anterior, caso o agendamento tenha sido transferido
+        canal_agendamentos.publicar('updated', agendamento_dict, new_dentista_id, dentista_anterior_id)
+        return jsonify({"success": True, "message": "Agendamento atualizado com sucesso", "appointment": agendamento_dict})
     except Exception as e:
         db.session.rollback()
         return jsonify({"success": False, "message": f"Erro ao atualizar agendamento: {str(e)}"}), 500
 
+def _minutos_do_dia(horario):
+    horas, minutos = horario.split(':')
+    return int(horas) * 60 + int(minutos)
+
+def conflitos_do_lote(agendamentos, destino_id, dias):
+    """Conflitos de `agendamentos` (ordenados por data) deslocados `dias` na agenda de `destino_id`.
+
+    Uma única consulta traz a agenda de destino no período inteiro; os agendamentos do
+    próprio lote são ignorados, pois também saem do lugar.
+    """
+    deslocamento = timedelta(days=dias)
+    ids_lote = {a.id for a in agendamentos}
+    existentes = Appointment.query.filter(
+        Appointment.dentista_id == destino_id,
+        Appointment.appointment_date.between(agendamentos[0].appointment_date + deslocamento,
+                                             agendamentos[-1].appointment_date + deslocamento)
+    ).all()
+    por_dia = {}
+    for existente in existentes:
+        if existente.id in ids_lote:
+            continue
+        try:
+            inicio = _minutos_do_dia(existente.appointment_time)
+        except ValueError:
+            app.logger.warning(f"Agendamento ID {existente.id} com formato de hora inválido no banco de dados.")
+            continue
+        por_dia.setdefault(existente.appointment_date, []).append((inicio, inicio + existente.duration_minutes, existente))
+
+    conflitos = []
+    for agendamento in agendamentos:
+        nova_data = agendamento.appointment_date + deslocamento
+        inicio = _minutos_do_dia(agendamento.appointment_time)
+        fim = inicio + agendamento.duration_minutes
+        for inicio_existente, fim_existente, existente in por_dia.get(nova_data, ()):
+            if max(inicio, inicio_existente) < min(fim, fim_existente):
+                conflitos.append({
+                    'id': agendamento.id,
+                    'appointment_date': nova_data.isoformat(),
+                    'appointment_time': agendamento.appointment_time,
+                    'conflito_com': existente.to_dict(),
+                })
+    return conflitos
+
+@app.route("/api/appointments/bulk", methods=["POST"])
+@token_required
+@idempotente # Repetir um deslocamento por dias o aplicaria duas vezes
+def processar_agendamentos_em_lote(current_user):
+    """Move (desloca dias e/ou transfere de dentista) ou cancela todos os agendamentos de um dentista no período.
+
+    Os conflitos com a agenda de destino são verificados de uma vez e, havendo qualquer um,
+    nada é alterado (409 com a lista completa). Com simular=true, só retorna o resultado.
+    """
+    data, errors = ESQUEMA_AGENDAMENTOS_LOTE.validar(request.get_json())
+    if errors:
+        return resposta_erro_validacao(errors)
+    acao, inicio = data['acao'], data['data_inicio']
+    fim = data['data_fim'] or inicio
+
+    if current_user.perfil == 'comum':
+        if data['dentista_id'] not in (None, current_user.id):
+            return jsonify({"success": False, "message": "Você só pode alterar a sua própria agenda."}), 403
+        if data['novo_dentista_id'] not in (None, current_user.id):
+            return jsonify({"success": False, "message": "Você não pode alterar o dentista responsável."}), 403
+        dentista_id = current_user.id
+    elif not data['dentista_id']:
+        return resposta_erro_validacao({'dentista_id': "Admin deve especificar o dentista_id."})
+    else:
+        dentista_id = data['dentista_id']
+
+    destino_id = data['novo_dentista_id'] or dentista_id
+    destino = db.session.get(Usuario, destino_id)
+    if not destino or destino.perfil != 'comum':
+        return jsonify({"success": False, "message": "Dentista (comum) de destino inválido ou não encontrado."}), 404
+    dias = data['dias'] if acao == 'mover' else 0
+
+    agendamentos = Appointment.query.filter(
+        Appointment.dentista_id == dentista_id,
+        Appointment.appointment_date.between(inicio, fim)
+    ).order_by(Appointment.appointment_date, Appointment.appointment_time).all()
+
+    if acao == 'mover':
+        if agendamentos:
+            conflitos = conflitos_do_lote(agendamentos, destino_id, dias)
+            if conflitos:
+                return jsonify({
+                    "success": False,
+                    "message": f"{len(conflitos)} agendamento(s) em conflito na agenda de Dr(a). {destino.nome}. Nada foi alterado.",
+                    "conflitos": conflitos
+                }), 409
+        deslocamento = timedelta(days=dias)
+        resultado = [{**a.to_dict(), 'appointment_date': (a.appointment_date + deslocamento).isoformat(),
+                      'dentista_id': destino_id, 'dentista_nome': destino.nome} for a in agendamentos]
+    else:
+        resultado = [a.to_dict() for a in agendamentos]
+
+    mensagem = f"{len(agendamentos)} agendamento(s) {'movido(s)' if acao == 'mover' else 'cancelado(s)'}."
+    if data['simular'] or not agendamentos:
+        return jsonify({"success": True, "message": mensagem, "simulacao": data['simular'],
+                        "afetados": len(agendamentos), "appointments": resultado})
+
+    ids = [a.id for a in agendamentos]
+    try:
+        # Comandos em lote (sem os eventos por objeto do ORM): nomes e versão dos feeds são mantidos aqui
+        for inicio_lote in range(0, len(ids), TAMANHO_LOTE_PAGAMENTOS):
+            lote = ids[inicio_lote:inicio_lote + TAMANHO_LOTE_PAGAMENTOS]
+            if acao == 'mover':
+                db.session.execute(update(Appointment), [
+                    {'id': a['id'], 'appointment_date': date.fromisoformat(a['appointment_date']),
+                     'dentista_id': destino_id, 'dentista_nome': destino.nome}
+                    for a in resultado[inicio_lote:inicio_lote + TAMANHO_LOTE_PAGAMENTOS]
+                ])
+            else:
+                db.session.execute(delete(Appointment).where(Appointment.id.in_(lote)),
+                                   execution_options={'synchronize_session': False})
+        marcar_agendas_alteradas(db.session.connection(), FeedAgenda.dentista_id.in_({dentista_id, destino_id}))
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        app.logger.error(f"Erro ao processar agendamentos em lote ({acao}) do dentista {dentista_id}: {str(e)}")
+        return jsonify({"success": False, "message": "Erro interno ao processar agendamentos em lote."}), 500
+
+    for agendamento in resultado:
+        if acao == 'mover':
+            canal_agendamentos.publicar('updated', agendamento, destino_id, dentista_id)
+        else:
+            canal_agendamentos.publicar('deleted', {'id': agendamento['id'], 'dentista_id': dentista_id}, dentista_id)
+    return jsonify({"success": True, "message": mensagem, "simulacao": False,
+                    "afetados": len(agendamentos), "appointments": resultado})
+
+# --- Feed iCalendar da Agenda ---
+@app.route("/api/agenda/feed", methods=["GET", "POST"])
+@token_required
+def feed_agenda(current_user):
+    """GET retorna a URL do feed do dentista; POST gera uma nova, revogando a anterior."""
+    if current_user.perfil == 'comum':
+        dentista = current_user
+    else:
+        dentista_id = request.args.get('dentista_id', type=int)
+        dentista = db.session.get(Usuario, dentista_id) if dentista_id else None
+        if not dentista or dentista.perfil != 'comum':
+            return jsonify({"success": False, "message": "Informe o dentista_id de um dentista (perfil comum)."}), 400
+
+    feed = db.session.get(FeedAgenda, dentista.id)
+    if request.method == 'GET':
+        if not feed:
+            return jsonify({"success": False, "message": "O feed da agenda ainda não foi gerado."}), 404
+    else:
+        try:
+            if feed:
+                feed.token = secrets.token_urlsafe(32)
+            else:
+                feed = FeedAgenda(dentista_id=dentista.id, token=secrets.token_urlsafe(32))
+                db.session.add(feed)
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            app.logger.error(f"Erro ao gerar feed da agenda do dentista {dentista.id}: {str(e)}")
+            return jsonify({"success": False, "message": "Erro interno ao gerar o feed da agenda."}), 500
+
+    url = url_for('feed_agenda_ics', token=feed.token, _external=True)
+    return jsonify({"success": True, "url": url, "webcal": 'webcal' + url[url.index(':'):]}), 201 if request.method == 'POST' else 200
+
+@app.route("/api/agenda/<token>.ics", methods=["GET"])
+def feed_agenda_ics(token):
+    # Aplicativos de calendário não enviam cabeçalhos: o token secreto na URL é a credencial
+    feed = FeedAgenda.query.join(Usuario, Usuario.id == FeedAgenda.dentista_id).filter(
+        FeedAgenda.token == token, Usuario.status == 'ativo').first()
+    if not feed:
+        return jsonify({"success": False, "message": "Feed não encontrado."}), 404
+
+    hoje = datetime.now(timezone.utc).date()
+    inicio = hoje - timedelta(days=app.config['ICS_FEED_DAYS_BEFORE'])
+    etag = f"{feed.dentista_id}-{feed.versao}-{inicio:%Y%m%d}"
+    # A janela avança à meia-noite (UTC), o que também altera o conteúdo
+    alterado_em = max(feed.alterado_em.replace(tzinfo=timezone.utc), datetime.combine(hoje, datetime.min.time(), timezone.utc))
+
+    resposta = Response(mimetype='text/calendar')
+    resposta.set_etag(etag)
+    resposta.last_modified = alterado_em
+    resposta.cache_control.private = True
+    resposta.cache_control.no_cache = True # Sempre revalida; a revalidação custa uma leitura por chave primária
+    if not is_resource_modified(request.environ, etag=etag, last_modified=alterado_em):
+        resposta.status_code = 304
+        return resposta
+
+    em_cache = _feeds_ics.get(feed.dentista_id)
+    if not em_cache or em_cache[0] != etag:
+        dentista = db.session.get(Usuario, feed.dentista_id)
+        g.clinica_id = dentista.clinica_id # Sem token na requisição: a clínica é a do dono do feed
+        agendamentos = buscar_agendamentos(feed.dentista_id, inicio, hoje + timedelta(days=app.config['ICS_FEED_DAYS_AFTER']))
+        em_cache = (etag, gerar_ics(dentista, agendamentos, alterado_em).encode('utf-8'))
+        _feeds_ics[feed.dentista_id] = em_cache
+    resposta.set_data(em_cache[1])
+    return resposta
+
 # --- Rotas de Orçamento (Budget) ---
 @app.route("/api/budgets", methods=["POST", "OPTIONS"])
 @token_required # Assumindo que qualquer usuário logado pode criar orçamentos
+@idempotente
 def create_budget(current_user):
     if request.method == 'OPTIONS':
         return '', 200
 
-    data = request.get_json()
-    paciente_id = data.get("patient_id") # Alterado de patient_id para paciente_id consistentemente
-    clinic_name = data.get("clinic_name", "Dr. Lucca Spinelli")
-    observations = data.get("observations", "")
-    procedures_data = data.get("procedures", []) # Renomeado para procedures_data
-
-    if not paciente_id or not procedures_data:
-        return jsonify({"success": False, "message": "ID do paciente e procedimentos são obrigatórios."}), 400
+    data, errors = ESQUEMA_ORCAMENTO.validar(request.get_json())
+    if errors:
+        return resposta_erro_validacao(errors)
+    paciente_id = data["patient_id"] # Alterado de patient_id para paciente_id consistentemente
+    if not data["clinic_name"]:
+        clinica = db.session.get(Clinica, current_user.clinica_id)
+        data["clinic_name"] = clinica.nome if clinica else NOME_CLINICA_PADRAO
+    clinic_name = data["clinic_name"]
+    observations = data["observations"]
+    procedimentos = data["procedures"] # Já convertidos (value como float)
 
     paciente_obj = Paciente.query.get(paciente_id)
     if not paciente_obj:
         return jsonify({"success": False, "message": f"Paciente com ID {paciente_id} não encontrado."}), 404
 
     try:
-        total_value = sum(float(proc.get("value", 0)) for proc in procedures_data) # campo 'value' ao invés de 'valor'
-
         budget = Budget(
             patient_id=paciente_id,
             clinic_name=clinic_name,
             observations=observations,
-            total_value=total_value
+            total_value=sum(proc["value"] for proc in procedimentos)
         )
 
         db.session.add(budget)
         db.session.flush()
 
-        for proc_data in procedures_data: # Renomeado para proc_data
-            procedure = BudgetProcedure(
-                budget_id=budget.id,
-                table_name=proc_data.get("table_name", ""), # campo 'table_name'
-                description=proc_data.get("description", ""), # campo 'description'
-                tooth=proc_data.get("tooth", ""), # campo 'tooth'
-                dentist=proc_data.get("dentist", ""), # campo 'dentist'
-                value=float(proc_data.get("value", 0)) # campo 'value'
-            )
-            db.session.add(procedure)
+        # Um único INSERT multi-linha para todos os procedimentos
+        for proc in procedimentos:
+            proc["budget_id"] = budget.id
+        db.session.execute(insert(BudgetProcedure), procedimentos)
 
         db.session.commit()
         return jsonify({"success": True, "message": "Orçamento criado com sucesso", "budget": budget.to_dict()}), 201
@@ -1082,13 +3852,44 @@ def create_budget(current_user):
 def get_patient_budgets(current_user, paciente_id): # Renomeado patient_id para paciente_id
     # Adicionar verificação se o usuário tem permissão para ver orçamentos deste paciente
     # Por exemplo, se for admin ou o dentista que atende o paciente (requer mais lógica)
-    paciente = Paciente.query.get_or_404(paciente_id)
     # Exemplo simples: admin vê todos, comum precisa de lógica adicional
     # if current_user.perfil == 'comum' and ... (lógica de permissão)
 
-    budgets = Budget.query.filter_by(patient_id=paciente_id).all()
+    # O paciente vem no JOIN (contains_eager) e os procedimentos em uma única consulta adicional
+    # (selectinload): duas consultas no total, sem N+1 em to_dict
+    budgets = Budget.query.join(Budget.patient).filter(Budget.patient_id == paciente_id) \
+        .options(contains_eager(Budget.patient), selectinload(Budget.procedures)).all()
+    if not budgets:
+        Paciente.query.get_or_404(paciente_id) # Sem orçamentos: distingue paciente inexistente (ou excluído) de lista vazia
     return jsonify([budget.to_dict() for budget in budgets])
 
+@app.route("/api/budgets/patient/<int:paciente_id>/resumo", methods=["GET"])
+@token_required
+def get_patient_budgets_resumo(current_user, paciente_id):
+    Paciente.query.get_or_404(paciente_id)
+
+    def soma_por_status(status):
+        return func.coalesce(func.sum(case((Budget.status == status, Budget.total_value), else_=0.0)), 0.0)
+
+    # Agregação feita no banco, sobre o índice ix_budgets_patient
+    quantidade, valor_total, valor_em_aberto, valor_aprovado = db.session.query(
+        func.count(Budget.id),
+        func.coalesce(func.sum(Budget.total_value), 0.0),
+        soma_por_status('pending'),
+        soma_por_status('approved')
+    ).filter(Budget.patient_id == paciente_id).one()
+
+    return jsonify({
+        "success": True,
+        "resumo": {
+            "patient_id": paciente_id,
+            "quantidade": quantidade,
+            "valor_total": float(valor_total),
+            "valor_em_aberto": float(valor_em_aberto),
+            "valor_aprovado": float(valor_aprovado)
+        }
+    })
+
 @app.route("/api/budgets/<int:budget_id>/approve", methods=["POST"])
 @admin_required # Apenas admin pode aprovar orçamentos
 def approve_budget(current_user, budget_id):
@@ -1105,6 +3906,7 @@ def approve_budget(current_user, budget_id):
 
 @app.route("/api/dentistas", methods=["GET"]) # Rota para listar dentistas (usuários com perfil 'comum')
 @token_required # Todos logados podem ver a lista de dentistas
+@cache_resposta('usuarios', escopo=escopo_todos)
 def get_dentistas(current_user):
     dentistas = Usuario.query.filter_by(perfil='comum').all()
     return jsonify([dentista.to_dict() for dentista in dentistas])
@@ -1112,6 +3914,7 @@ def get_dentistas(current_user):
 # --- Rotas de Pagamento ---
 @app.route("/api/pagamentos", methods=["POST"])
 @token_required # Dentista (comum) registra um pagamento
+@idempotente
 def registrar_pagamento(current_user):
     if current_user.perfil != 'comum':
         return jsonify({"success": False, "message": "Apenas dentistas podem registrar pagamentos."}), 403
@@ -1152,8 +3955,70 @@ def registrar_pagamento(current_user):
 @app.route("/api/pagamentos/pendentes", methods=["GET"])
 @admin_required # Apenas admin pode ver pagamentos pendentes
 def listar_pagamentos_pendentes(current_user):
-    pagamentos = Pagamento.query.filter_by(status='pendente').order_by(Pagamento.data_pagamento.desc()).all()
-    return jsonify([p.to_dict() for p in pagamentos])
+    page = request.args.get('page', 1, type=int)
+    per_page = min(max(request.args.get('per_page', 50, type=int), 1), 500)
+
+    # Ordenação coberta pelo índice ix_pagamentos_status_data; o id desempata pagamentos no mesmo instante
+    pagamentos = Pagamento.query.filter_by(status='pendente').order_by(
+        Pagamento.data_pagamento.desc(), Pagamento.id.desc()
+    ).offset((max(page, 1) - 1) * per_page).limit(per_page).all()
+
+    total, valor_total = db.session.query(
+        func.count(Pagamento.id), func.coalesce(func.sum(Pagamento.valor), 0.0)
+    ).filter(Pagamento.status == 'pendente').one()
+
+    return jsonify({
+        "success": True,
+        "pagamentos": [p.to_dict() for p in pagamentos],
+        "total": total,
+        "valor_total": float(valor_total),
+        "page": max(page, 1),
+        "per_page": per_page,
+        "pages": (total + per_page - 1) // per_page
+    })
+
+TAMANHO_LOTE_PAGAMENTOS = 500 # Mantém o número de parâmetros por UPDATE abaixo do limite do SQLite
+
+@app.route("/api/pagamentos/bulk", methods=["POST"])
+@admin_required # Apenas admin pode aprovar/rejeitar
+def processar_pagamentos_em_lote(current_user):
+    data, errors = ESQUEMA_PAGAMENTOS_LOTE.validar(request.get_json())
+    if errors:
+        return resposta_erro_validacao(errors)
+    acao = data['acao']
+    novos_status = {'aprovar': 'aprovado', 'rejeitar': 'rejeitado'}
+
+    ids = list(set(data['ids']))
+    agora = datetime.now(timezone.utc)
+    atualizados = 0
+    try:
+        # Tudo em uma transação; pagamentos que já não estão pendentes são ignorados pelo filtro de status
+        for inicio in range(0, len(ids), TAMANHO_LOTE_PAGAMENTOS):
+            lote = ids[inicio:inicio + TAMANHO_LOTE_PAGAMENTOS]
+            resultado = db.session.execute(
+                update(Pagamento)
+                .where(Pagamento.id.in_(lote), Pagamento.status == 'pendente')
+                .values(
+                    status=novos_status[acao],
+                    aprovado_por_id=current_user.id,
+                    aprovado_por_nome=current_user.nome,
+                    data_acao_aprovacao=agora
+                ),
+                execution_options={'synchronize_session': False}
+            )
+            atualizados += resultado.rowcount
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        app.logger.error(f"Erro ao processar pagamentos em lote ({acao}): {str(e)}")
+        return jsonify({"success": False, "message": "Erro interno ao processar pagamentos em lote."}), 500
+
+    return jsonify({
+        "success": True,
+        "message": f"{atualizados} pagamento(s) {novos_status[acao]}(s).",
+        "atualizados": atualizados,
+        "ignorados": len(ids) - atualizados
+    })
 
 @app.route("/api/pagamentos/<int:pagamento_id>/aprovar", methods=["POST"])
 @admin_required # Apenas admin pode aprovar
@@ -1218,7 +4083,7 @@ def create_historico(current_user):
         
         if arquivo and arquivo.filename:
             import uuid # os já importado no topo
-            upload_dir = os.path.join(os.path.dirname(__file__), 'uploads')
+            upload_dir = UPLOAD_DIR
             os.makedirs(upload_dir, exist_ok=True)
             file_extension = os.path.splitext(arquivo.filename)[1]
             unique_filename = f"{uuid.uuid4()}{file_extension}"
@@ -1226,7 +4091,8 @@ def create_historico(current_user):
             arquivo.save(file_path)
             historico.arquivo_nome = unique_filename
             historico.arquivo_tipo = arquivo.content_type
-            historico.arquivo_tamanho = os.path.getsize(file_path)
+            historico.arquivo_tamanho = os.path.getsize(file_path) # Tamanho original, mesmo se comprimido abaixo
+            comprimir_anexo(file_path)
         
         db.session.add(historico)
         db.session.commit()
@@ -1242,6 +4108,74 @@ def create_historico(current_user):
         app.logger.error(f"Erro ao salvar histórico: {str(e)}")
         return jsonify({"success": False, "message": f"Erro ao salvar histórico: {str(e)}"}), 500
 
+@app.route("/api/historico/busca", methods=["GET"])
+@token_required
+def buscar_historico(current_user):
+    termos = _termos_busca(request.args.get('q'))
+    if not termos:
+        return jsonify({"success": False, "message": "Informe o texto da busca (parâmetro q)."}), 400
+    page = max(request.args.get('page', 1, type=int), 1)
+    per_page = min(max(request.args.get('per_page', 20, type=int), 1), 100)
+    # SQL textual não passa pelo filtro automático: a clínica entra como parâmetro
+    parametros = {'limite': per_page, 'deslocamento': (page - 1) * per_page, 'clinica_id': current_user.clinica_id}
+
+    conn = db.session.connection()
+    if _fts_disponivel(conn):
+        # Termos entre aspas (evita erro de sintaxe FTS5), todos obrigatórios; o último aceita prefixo
+        parametros['consulta'] = ' '.join(f'"{t}"' for t in termos) + '*'
+        total = conn.execute(text(
+            "SELECT count(*) FROM historico_fts JOIN historico_pacientes h ON h.id = historico_fts.rowid "
+            "JOIN pacientes p ON p.id = h.patient_id "
+            "WHERE historico_fts MATCH :consulta AND h.clinica_id = :clinica_id AND h.deleted_at IS NULL AND p.deleted_at IS NULL"
+        ), parametros).scalar()
+        linhas = conn.execute(text(
+            "SELECT h.id, h.patient_id, p.nome_completo, h.created_at, "
+            f"snippet(historico_fts, 0, '{MARCA_INICIO}', '{MARCA_FIM}', '…', 16) AS trecho, bm25(historico_fts) AS relevancia "
+            "FROM historico_fts JOIN historico_pacientes h ON h.id = historico_fts.rowid "
+            "LEFT JOIN pacientes p ON p.id = h.patient_id "
+            "WHERE historico_fts MATCH :consulta AND h.clinica_id = :clinica_id AND h.deleted_at IS NULL AND p.deleted_at IS NULL "
+            "ORDER BY relevancia LIMIT :limite OFFSET :deslocamento"
+        ), parametros).all()
+        resultados = [(l.id, l.patient_id, l.nome_completo, l.created_at, l.trecho, -l.relevancia) for l in linhas]
+    elif conn.dialect.name == 'mysql':
+        parametros['consulta'] = ' '.join(f'+{t}' for t in termos) + '*'
+        total = conn.execute(text(
+            "SELECT count(*) FROM historico_pacientes h JOIN pacientes p ON p.id = h.patient_id "
+            "WHERE MATCH(h.historico) AGAINST (:consulta IN BOOLEAN MODE) AND h.clinica_id = :clinica_id "
+            "AND h.deleted_at IS NULL AND p.deleted_at IS NULL"
+        ), parametros).scalar()
+        linhas = conn.execute(text(
+            "SELECT h.id, h.patient_id, p.nome_completo, h.created_at, h.historico, "
+            "MATCH(h.historico) AGAINST (:consulta IN BOOLEAN MODE) AS relevancia "
+            "FROM historico_pacientes h LEFT JOIN pacientes p ON p.id = h.patient_id "
+            "WHERE MATCH(h.historico) AGAINST (:consulta IN BOOLEAN MODE) AND h.clinica_id = :clinica_id "
+            "AND h.deleted_at IS NULL AND p.deleted_at IS NULL "
+            "ORDER BY relevancia DESC LIMIT :limite OFFSET :deslocamento"
+        ), parametros).all()
+        resultados = [(l.id, l.patient_id, l.nome_completo, l.created_at, _trecho_destacado(l.historico, termos), l.relevancia) for l in linhas]
+    else:
+        filtro = db.and_(*[HistoricoPaciente.historico.ilike(f"%{t}%") for t in termos])
+        total = HistoricoPaciente.query.filter(filtro).count()
+        linhas = HistoricoPaciente.query.filter(filtro).order_by(HistoricoPaciente.created_at.desc()) \
+            .offset(parametros['deslocamento']).limit(per_page).all()
+        resultados = [(h.id, h.patient_id, h.patient.nome_completo if h.patient else None, h.created_at,
+                       _trecho_destacado(h.historico, termos), None) for h in linhas]
+
+    def data_iso(valor):
+        # Em SQL textual o SQLite devolve a data como string 'AAAA-MM-DD HH:MM:SS'
+        return valor.isoformat() if hasattr(valor, 'isoformat') else (valor.replace(' ', 'T', 1) if valor else None)
+
+    return jsonify({
+        "success": True,
+        "total": total,
+        "page": page,
+        "per_page": per_page,
+        "resultados": [{
+            "id": id_, "patient_id": patient_id, "paciente_nome": nome, "created_at": data_iso(criado_em),
+            "trecho": _trecho_html(trecho), "relevancia": relevancia
+        } for id_, patient_id, nome, criado_em, trecho, relevancia in resultados]
+    })
+
 @app.route("/api/historico/patient/<int:paciente_id>", methods=["GET"]) # Renomeado patient_id para paciente_id
 @token_required
 def get_patient_historicos(current_user, paciente_id): # Renomeado patient_id para paciente_id
@@ -1259,19 +4193,12 @@ def delete_historico(current_user, historico_id):
     try:
         historico = HistoricoPaciente.query.get_or_404(historico_id)
         
-        # Remover arquivo se existir
-        if historico.arquivo_nome:
-            import os
-            upload_dir = os.path.join(os.path.dirname(__file__), 'uploads')
-            file_path = os.path.join(upload_dir, historico.arquivo_nome)
-            if os.path.exists(file_path):
-                os.remove(file_path)
-        
         # Adicionar lógica de permissão: Apenas admin ou o usuário que criou o histórico (se aplicável)
         # Ex: if current_user.perfil != 'admin' and historico.criado_por_id != current_user.id:
         #         return jsonify({"success": False, "message": "Permissão negada."}), 403
 
-        db.session.delete(historico)
+        # Exclusão lógica; o registro e o arquivo anexo são removidos pela limpeza em segundo plano
+        historico.deleted_at = datetime.now(timezone.utc)
         db.session.commit()
         
         return jsonify({"success": True, "message": "Histórico excluído com sucesso"})
@@ -1281,58 +4208,227 @@ def delete_historico(current_user, historico_id):
         app.logger.error(f"Erro ao excluir histórico {historico_id}: {str(e)}")
         return jsonify({"success": False, "message": f"Erro ao excluir histórico: {str(e)}"}), 500
 
+# --- Rotas de Auditoria ---
+@app.route("/api/auditoria", methods=["GET"])
+@admin_required
+def listar_auditoria(current_user):
+    """Registros mais recentes primeiro, filtrados por entidade (e id) e/ou usuário; paginação por antes_id."""
+    entidade = request.args.get('entidade')
+    if entidade and entidade not in TABELAS_AUDITADAS:
+        return resposta_erro_validacao({'entidade': f"Use uma de: {', '.join(sorted(TABELAS_AUDITADAS))}."})
+    entidade_id = request.args.get('entidade_id', type=int)
+    if entidade_id and not entidade:
+        return resposta_erro_validacao({'entidade': "Informe a entidade junto com o entidade_id."})
+    usuario_id = request.args.get('usuario_id', type=int)
+    antes_id = request.args.get('antes_id', type=int)
+    limite = min(max(request.args.get('limite', 100, type=int), 1), 500)
+
+    gravador_auditoria.descarregar() # Inclui o que ainda está no buffer
+    query = RegistroAuditoria.query
+    if entidade:
+        query = query.filter(RegistroAuditoria.entidade == entidade)
+    if entidade_id:
+        query = query.filter(RegistroAuditoria.entidade_id == entidade_id)
+    if usuario_id:
+        query = query.filter(RegistroAuditoria.usuario_id == usuario_id)
+    if antes_id:
+        query = query.filter(RegistroAuditoria.id < antes_id)
+    registros = query.order_by(RegistroAuditoria.id.desc()).limit(limite).all()
+    return jsonify({
+        "success": True,
+        "registros": [r.to_dict() for r in registros],
+        "proximo_antes_id": registros[-1].id if len(registros) == limite else None
+    })
+
+# --- Rotas de Backup ---
+@app.route("/api/backups", methods=["GET"])
+@admin_clinica_padrao_required
+def listar_backups_route(current_user):
+    backups = []
+    for caminho in listar_backups():
+        sha256 = None
+        if os.path.exists(caminho + '.sha256'):
+            with open(caminho + '.sha256', encoding='utf-8') as arquivo:
+                sha256 = arquivo.read().split()[0]
+        backups.append({
+            'arquivo': os.path.basename(caminho),
+            'tamanho_bytes': os.path.getsize(caminho),
+            'criado_em': datetime.fromtimestamp(os.path.getmtime(caminho), timezone.utc).isoformat(),
+            'sha256': sha256,
+        })
+    return jsonify({"success": True, "backups": backups})
+
+@app.route("/api/backups", methods=["POST"])
+@admin_clinica_padrao_required
+def criar_backup_route(current_user):
+    try:
+        resultado = criar_backup()
+        return jsonify({"success": True, "message": "Backup gravado com sucesso.", "backup": resultado}), 201
+    except BackupEmAndamento as e:
+        return jsonify({"success": False, "message": str(e)}), 409
+    except RuntimeError as e:
+        return jsonify({"success": False, "message": str(e)}), 400
+    except Exception as e:
+        app.logger.error(f"Erro ao gravar backup: {str(e)}")
+        return jsonify({"success": False, "message": "Erro interno ao gravar backup."}), 500
+
+@app.route("/api/backups/<nome>/verificar", methods=["POST"])
+@admin_clinica_padrao_required
+def verificar_backup_route(current_user, nome):
+    caminho = next((c for c in listar_backups() if os.path.basename(c) == nome), None)
+    if not caminho:
+        return jsonify({"success": False, "message": "Backup não encontrado."}), 404
+    resultado = verificar_backup(caminho)
+    return jsonify({"success": resultado['ok'], "verificacao": resultado}), 200 if resultado['ok'] else 422
+
 # Rota para servir arquivos de upload (se aplicável, verificar se já existe ou se é necessária)
 @app.route("/uploads/<filename>")
 @token_required # Proteger acesso aos uploads
 def uploaded_file(current_user, filename):
-    # Adicionar verificação se o current_user tem permissão para acessar este arquivo específico
-    # Esta é uma implementação básica, pode precisar de mais segurança.
-    upload_dir = os.path.join(os.path.dirname(__file__), 'uploads')
-    # Verificar se o arquivo pertence a um histórico que o usuário pode ver, por exemplo.
-    # historico_associado = HistoricoPaciente.query.filter_by(arquivo_nome=filename).first()
-    # if not historico_associado:
-    #     return jsonify({"success": False, "message": "Arquivo não encontrado ou não associado."}), 404
-    # if current_user.perfil == 'comum' and ... (lógica de permissão para o histórico)
+    upload_dir = UPLOAD_DIR
+    # O diretório de uploads é compartilhado entre as clínicas: só serve arquivos referenciados por
+    # um histórico da clínica do usuário (filtro automático pelo token)
+    if not HistoricoPaciente.query.filter_by(arquivo_nome=filename).first():
+        return jsonify({"success": False, "message": "Arquivo não encontrado ou não associado."}), 404
 
     from flask import send_from_directory # Mover import para o topo se usado em mais lugares
+    caminho = safe_join(upload_dir, filename)
+    if caminho and not os.path.isfile(caminho) and os.path.isfile(caminho + SUFIXO_ANEXO_COMPRIMIDO):
+        return _servir_anexo_comprimido(caminho + SUFIXO_ANEXO_COMPRIMIDO, filename)
     return send_from_directory(upload_dir, filename)
 
+# --- Frontend (SPA) Servido pelo Backend ---
+# Com FRONTEND_DIST_DIR apontando para o build do Vite (frontend/dist), o backend serve a SPA
+# na mesma origem da API e o container do frontend deixa de ser necessário. Os arquivos de
+# assets/ têm hash no nome e recebem cache imutável de um ano; index.html é sempre revalidado.
+# As variantes .br/.gz geradas por 'flask comprimir-frontend' são escolhidas pelo
+# Accept-Encoding. Caminhos sem arquivo correspondente (rotas da SPA) recebem o index.html.
+RE_ASSET_COM_HASH = re.compile(r'^assets/.+-[A-Za-z0-9_-]{8}\.\w+$')
+EXTENSOES_COMPRIMIVEIS = ('.js', '.mjs', '.css', '.html', '.svg', '.json', '.map', '.ico', '.txt', '.webmanifest')
+CODIFICACOES_PRE_COMPRIMIDAS = (('br', '.br'), ('gzip', '.gz')) # Em ordem de preferência
+
+def indexar_frontend(raiz):
+    """Caminho relativo -> {codificação: arquivo}, lido uma vez na inicialização."""
+    arquivos = {}
+    for pasta, _, nomes in os.walk(raiz):
+        for nome in nomes:
+            caminho = os.path.join(pasta, nome)
+            if nome.endswith(('.br', '.gz')) and os.path.exists(caminho[:-3]):
+                continue # Variante de outro arquivo
+            variantes = {codificacao: caminho + extensao for codificacao, extensao in CODIFICACOES_PRE_COMPRIMIDAS
+                         if os.path.exists(caminho + extensao)}
+            arquivos[os.path.relpath(caminho, raiz).replace(os.sep, '/')] = {'identity': caminho, **variantes}
+    return arquivos
+
+def comprimir_frontend(raiz, tamanho_minimo=1024):
+    """Grava as variantes .gz (e .br, com o pacote brotli instalado) dos arquivos de texto do build."""
+    try:
+        import brotli # Dependência opcional: sem ela, só as variantes gzip são geradas
+    except ImportError:
+        brotli = None
+    resumo = {'gzip': 0, 'br': 0, 'ignorados': 0}
+    for relativo, variantes in indexar_frontend(raiz).items():
+        caminho = variantes['identity']
+        if not relativo.endswith(EXTENSOES_COMPRIMIVEIS) or os.path.getsize(caminho) < tamanho_minimo:
+            resumo['ignorados'] += 1
+            continue
+        with open(caminho, 'rb') as arquivo:
+            conteudo = arquivo.read()
+        compressores = {'gzip': lambda dados: gzip.compress(dados, compresslevel=9, mtime=0)}
+        if brotli:
+            compressores['br'] = lambda dados: brotli.compress(dados, quality=11)
+        for codificacao, extensao in CODIFICACOES_PRE_COMPRIMIDAS:
+            if codificacao not in compressores:
+                continue
+            comprimido = compressores[codificacao](conteudo)
+            if len(comprimido) < len(conteudo) * 0.9: # Só vale a pena se economizar ao menos 10%
+                with open(caminho + extensao, 'wb') as arquivo:
+                    arquivo.write(comprimido)
+                resumo[codificacao] += 1
+    return resumo
+
+def servir_frontend(caminho='index.html'):
+    if caminho == 'api' or caminho.startswith('api/'):
+        return jsonify({"success": False, "message": "Rota não encontrada."}), 404
+    variantes = arquivos_frontend.get(caminho)
+    if variantes is None:
+        if caminho.startswith('assets/') or '.' in caminho.rsplit('/', 1)[-1]:
+            return jsonify({"success": False, "message": "Arquivo não encontrado."}), 404
+        caminho, variantes = 'index.html', arquivos_frontend.get('index.html') # Rota da SPA (ex.: /agendamentos)
+        if variantes is None:
+            return jsonify({"success": False, "message": "index.html não encontrado em FRONTEND_DIST_DIR."}), 404
+
+    codificacao = next((c for c, _ in CODIFICACOES_PRE_COMPRIMIDAS if c in variantes and request.accept_encodings[c] > 0), 'identity')
+    imutavel = RE_ASSET_COM_HASH.match(caminho) is not None
+    # Sem max_age o send_file responde com no-cache (revalidação a cada uso), o desejado para o index.html
+    resposta = send_file(variantes[codificacao], mimetype=mimetypes.guess_type(caminho)[0] or 'application/octet-stream',
+                         conditional=True, etag=True, max_age=365 * 24 * 3600 if imutavel else None)
+    if imutavel:
+        resposta.cache_control.immutable = True
+    if codificacao != 'identity':
+        resposta.headers['Content-Encoding'] = codificacao
+    if len(variantes) > 1:
+        resposta.vary.add('Accept-Encoding')
+    return resposta
+
+arquivos_frontend = {}
+if app.config['FRONTEND_DIST_DIR']:
+    arquivos_frontend = indexar_frontend(app.config['FRONTEND_DIST_DIR'])
+    app.add_url_rule('/', 'frontend_index', servir_frontend)
+    app.add_url_rule('/<path:caminho>', 'frontend', servir_frontend)
+
+@app.cli.command('comprimir-frontend')
+@click.option('--diretorio', default=None, help='Build do frontend (padrão: FRONTEND_DIST_DIR).')
+def comprimir_frontend_command(diretorio):
+    """Gera as variantes .br/.gz pré-comprimidas do build do frontend."""
+    diretorio = diretorio or app.config['FRONTEND_DIST_DIR']
+    if not diretorio or not os.path.isdir(diretorio):
+        raise SystemExit("Informe --diretorio ou defina FRONTEND_DIST_DIR com o build do frontend.")
+    print(f"Variantes geradas: {comprimir_frontend(diretorio)}")
+
+
+def garantir_admin_padrao():
+    """Adiciona um usuário admin padrão se não existir (deve ser chamada dentro de um app_context)."""
+    admin_username = 'admin'
+    admin_email = os.environ.get('ADMIN_EMAIL', 'admin@example.com')
+    admin_nome = os.environ.get('ADMIN_NOME', 'Administrador Padrão')
+    admin_senha = os.environ.get('ADMIN_SENHA', 'admin') # Senha padrão 'admin'
+    garantir_clinica_padrao(db.session.connection()) # O admin padrão pertence à clínica padrão
+
+    if not Usuario.query.filter_by(username=admin_username).first():
+        if Usuario.query.filter_by(email=admin_email).first():
+            # Se o email já existe mas o username 'admin' não, pode ser um problema de dados legados ou configuração.
+            # Aqui, vamos priorizar a criação do admin com username 'admin'.
+            # Poderia ser necessário tratar esse caso de forma mais elaborada.
+            print(f"Atenção: Email {admin_email} já existe, mas usuário '{admin_username}' não. Verifique a consistência dos dados.")
+            # Decide-se não criar o admin se o email já está em uso por outro username para evitar conflito no email unique.
+            # Ou, alternativamente, atualizar o usuário existente se a política permitir.
+            # Por simplicidade, aqui não faremos nada se o email já existir e o username 'admin' não.
+        else:
+            admin_user = Usuario(
+                username=admin_username,
+                nome=admin_nome,
+                email=admin_email, # Email ainda precisa ser único
+                perfil='admin'
+            )
+            admin_user.set_password(admin_senha)
+            db.session.add(admin_user)
+            db.session.commit()
+            print(f"Usuário admin '{admin_user.username}' (Email: {admin_user.email}) criado com senha '{admin_senha}'.")
+    else:
+        # Garantir que o usuário admin existente tenha a senha 'admin' se desejado
+        existing_admin = Usuario.query.filter_by(username=admin_username).first()
+        if not existing_admin.check_password(admin_senha):
+            print(f"Atualizando senha do usuário admin '{existing_admin.username}' para '{admin_senha}'.")
+            existing_admin.set_password(admin_senha)
+            db.session.commit()
+        print(f"Usuário admin '{existing_admin.username}' (Email: {existing_admin.email}) verificado.")
+
 if __name__ == '__main__':
     with app.app_context():
-        db.create_all() # Cria as tabelas se não existirem
-        # Adicionar um usuário admin padrão se não existir
-        admin_username = 'admin'
-        admin_email = os.environ.get('ADMIN_EMAIL', 'admin@example.com')
-        admin_nome = os.environ.get('ADMIN_NOME', 'Administrador Padrão')
-        admin_senha = os.environ.get('ADMIN_SENHA', 'admin') # Senha padrão 'admin'
-
-        if not Usuario.query.filter_by(username=admin_username).first():
-            if Usuario.query.filter_by(email=admin_email).first():
-                # Se o email já existe mas o username 'admin' não, pode ser um problema de dados legados ou configuração.
-                # Aqui, vamos priorizar a criação do admin com username 'admin'.
-                # Poderia ser necessário tratar esse caso de forma mais elaborada.
-                print(f"Atenção: Email {admin_email} já existe, mas usuário '{admin_username}' não. Verifique a consistência dos dados.")
-                # Decide-se não criar o admin se o email já está em uso por outro username para evitar conflito no email unique.
-                # Ou, alternativamente, atualizar o usuário existente se a política permitir.
-                # Por simplicidade, aqui não faremos nada se o email já existir e o username 'admin' não.
-            else:
-                admin_user = Usuario(
-                    username=admin_username,
-                    nome=admin_nome,
-                    email=admin_email, # Email ainda precisa ser único
-                    perfil='admin'
-                )
-                admin_user.set_password(admin_senha)
-                db.session.add(admin_user)
-                db.session.commit()
-                print(f"Usuário admin '{admin_user.username}' (Email: {admin_user.email}) criado com senha '{admin_senha}'.")
-        else:
-            # Garantir que o usuário admin existente tenha a senha 'admin' se desejado
-            existing_admin = Usuario.query.filter_by(username=admin_username).first()
-            if not existing_admin.check_password(admin_senha):
-                print(f"Atualizando senha do usuário admin '{existing_admin.username}' para '{admin_senha}'.")
-                existing_admin.set_password(admin_senha)
-                db.session.commit()
-            print(f"Usuário admin '{existing_admin.username}' (Email: {existing_admin.email}) verificado.")
+        aplicar_migracoes() # Cria as tabelas se não existirem e aplica migrações pendentes
+        garantir_admin_padrao()
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true': # Com debug=True, só o processo filho do reloader atende requisições
+        iniciar_limpeza_periodica()
 
     app.run(host='0.0.0.0', port=5000, debug=True)
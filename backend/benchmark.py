@@ -0,0 +1,208 @@
+"""Benchmark de carga das rotas reais da API.
+
+Executa as rotas mais usadas pelo frontend através do test client do Flask (ou de
+um servidor já em execução, com --url) contra o banco de DATABASE_URL, e reporta
+p50/p95/p99 e vazão por endpoint. Use um banco populado por gerar_dados.py; a
+criação de agendamentos escreve no banco, então não rode contra produção.
+
+    DATABASE_URL=sqlite:////tmp/carga.db python benchmark.py --iteracoes 200 --salvar-baseline
+    DATABASE_URL=sqlite:////tmp/carga.db python benchmark.py --iteracoes 200 --comparar
+
+Com --comparar, sai com código 1 se o p95 de algum endpoint piorar mais que a
+tolerância em relação ao baseline salvo.
+"""
+import argparse
+import json
+import os
+import random
+import statistics
+import threading
+import time
+import urllib.error
+import urllib.request
+from datetime import date, timedelta
+
+from sqlalchemy import func
+
+from app import app, Usuario, Paciente, Pagamento
+
+ARQUIVO_BASELINE = os.path.join(os.path.dirname(__file__), 'benchmark_baseline.json')
+
+
+class ClienteHTTP:
+    """Interface mínima compatível com o test client, para rodar contra um servidor real."""
+
+    def __init__(self, url_base):
+        self.url_base = url_base.rstrip('/')
+
+    def open(self, caminho, method='GET', json_body=None, headers=None):
+        dados = json.dumps(json_body).encode() if json_body is not None else None
+        requisicao = urllib.request.Request(self.url_base + caminho, data=dados, method=method,
+                                            headers={'Content-Type': 'application/json', **(headers or {})})
+        try:
+            with urllib.request.urlopen(requisicao) as resposta:
+                return resposta.status, resposta.read()
+        except urllib.error.HTTPError as erro:
+            return erro.code, erro.read()
+
+
+class ClienteFlask:
+    def __init__(self):
+        self.cliente = app.test_client()
+
+    def open(self, caminho, method='GET', json_body=None, headers=None):
+        resposta = self.cliente.open(caminho, method=method, json=json_body, headers=headers)
+        return resposta.status_code, resposta.get_data()
+
+
+def percentil(valores, p):
+    ordenados = sorted(valores)
+    indice = min(len(ordenados) - 1, max(0, round(p / 100 * len(ordenados)) - 1))
+    return ordenados[indice]
+
+
+def _login(cliente, username, senha):
+    status, corpo = cliente.open('/api/login', method='POST', json_body={'username': username, 'password': senha})
+    if status != 200:
+        raise SystemExit(f"Falha no login de '{username}' (HTTP {status}).")
+    return {'x-access-token': json.loads(corpo)['token']}
+
+
+def montar_cenarios(args, cliente):
+    with app.app_context():
+        administrador = Usuario.query.filter_by(username=args.admin_usuario).first()
+        if not administrador:
+            raise SystemExit(f"Administrador '{args.admin_usuario}' não encontrado.")
+        clinica_id = administrador.clinica_id
+        # Por padrão, um dentista criado por gerar_dados.py na clínica do administrador (senha conhecida)
+        consulta = Usuario.query.filter_by(perfil='comum', status='ativo', clinica_id=clinica_id)
+        if args.dentista:
+            consulta = consulta.filter_by(username=args.dentista)
+        else:
+            consulta = consulta.filter(Usuario.username.like('dentista\\_carga\\_%', escape='\\'))
+        dentista = consulta.order_by(Usuario.id).first()
+        if not dentista:
+            raise SystemExit("Nenhum dentista encontrado. Popule o banco com gerar_dados.py antes ou informe --dentista.")
+        max_paciente = Paciente.query.filter_by(clinica_id=clinica_id).with_entities(func.max(Paciente.id)).scalar() or 1
+        tem_pendentes = Pagamento.query.filter_by(status='pendente', clinica_id=clinica_id).first() is not None
+
+    admin = _login(cliente, args.admin_usuario, args.admin_senha)
+    comum = _login(cliente, dentista.username, args.senha_dentista)
+    rnd = random.Random(args.seed)
+
+    def novo_agendamento():
+        # Datas futuras aleatórias: exercita a verificação de conflitos (409 é resposta válida)
+        dia = date.today() + timedelta(days=rnd.randint(1, 60))
+        return {'patient_id': rnd.randint(1, max_paciente), 'appointment_date': dia.isoformat(),
+                'appointment_time': f"{rnd.randint(8, 17):02d}:{rnd.choice(['00', '30'])}", 'duration_minutes': 30}
+
+    cenarios = {
+        'GET /api/appointments (dentista)': lambda: ('/api/appointments', 'GET', None, comum),
+        'GET /api/appointments?dentista_id': lambda: (f'/api/appointments?dentista_id={dentista.id}', 'GET', None, admin),
+        'GET /api/appointments/today': lambda: ('/api/appointments/today', 'GET', None, admin),
+        'POST /api/appointments': lambda: ('/api/appointments', 'POST', novo_agendamento(), comum),
+        'GET /api/pacientes/<id>': lambda: (f'/api/pacientes/{rnd.randint(1, max_paciente)}', 'GET', None, comum),
+        'GET /api/budgets/patient/<id>': lambda: (f'/api/budgets/patient/{rnd.randint(1, max_paciente)}', 'GET', None, comum),
+        'GET /api/historico/patient/<id>': lambda: (f'/api/historico/patient/{rnd.randint(1, max_paciente)}', 'GET', None, comum),
+        'GET /api/dentistas': lambda: ('/api/dentistas', 'GET', None, comum),
+    }
+    if tem_pendentes:
+        cenarios['GET /api/pagamentos/pendentes'] = lambda: ('/api/pagamentos/pendentes', 'GET', None, admin)
+    if args.incluir_lista_pacientes:
+        cenarios['GET /api/pacientes'] = lambda: ('/api/pacientes', 'GET', None, comum)
+    return cenarios
+
+
+def executar(args, cliente_factory, gerar_requisicao):
+    latencias, erros = [], []
+    lock = threading.Lock()
+    por_thread = max(1, args.iteracoes // args.concorrencia)
+
+    def trabalhador():
+        cliente = cliente_factory()
+        for _ in range(por_thread):
+            caminho, metodo, corpo, headers = gerar_requisicao()
+            inicio = time.perf_counter()
+            status, _ = cliente.open(caminho, method=metodo, json_body=corpo, headers=headers)
+            duracao = time.perf_counter() - inicio
+            with lock:
+                latencias.append(duracao)
+                if status >= 500 or status in (401, 403):
+                    erros.append(status)
+
+    inicio = time.perf_counter()
+    threads = [threading.Thread(target=trabalhador) for _ in range(args.concorrencia)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    total = time.perf_counter() - inicio
+
+    return {
+        'requisicoes': len(latencias),
+        'erros': len(erros),
+        'p50_ms': round(percentil(latencias, 50) * 1000, 2),
+        'p95_ms': round(percentil(latencias, 95) * 1000, 2),
+        'p99_ms': round(percentil(latencias, 99) * 1000, 2),
+        'media_ms': round(statistics.mean(latencias) * 1000, 2),
+        'req_por_s': round(len(latencias) / total, 1),
+    }
+
+
+def comparar(resultados, tolerancia):
+    with open(ARQUIVO_BASELINE, encoding='utf-8') as f:
+        baseline = json.load(f)['resultados']
+    regressoes = []
+    for nome, atual in resultados.items():
+        anterior = baseline.get(nome)
+        if anterior and atual['p95_ms'] > anterior['p95_ms'] * (1 + tolerancia):
+            regressoes.append(f"{nome}: p95 {anterior['p95_ms']}ms -> {atual['p95_ms']}ms")
+    return regressoes
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--url', help='URL de um servidor em execução (ex.: http://localhost:5000). Padrão: test client do Flask')
+    parser.add_argument('--iteracoes', type=int, default=100, help='Requisições por endpoint')
+    parser.add_argument('--concorrencia', type=int, default=1)
+    parser.add_argument('--endpoint', action='append', help='Executa apenas os endpoints cujo nome contenha este texto')
+    parser.add_argument('--incluir-lista-pacientes', action='store_true', help='Inclui GET /api/pacientes (lista completa)')
+    parser.add_argument('--admin-usuario', default='admin')
+    parser.add_argument('--admin-senha', default=os.environ.get('ADMIN_SENHA', 'admin'))
+    parser.add_argument('--dentista', help="Username do dentista (padrão: o primeiro dentista_carga_* da clínica do administrador)")
+    parser.add_argument('--senha-dentista', default='carga123', help="Senha do dentista (padrão: a dos criados por gerar_dados.py)")
+    parser.add_argument('--salvar-baseline', action='store_true')
+    parser.add_argument('--comparar', action='store_true')
+    parser.add_argument('--tolerancia', type=float, default=0.2, help='Piora aceitável do p95 (0.2 = 20%%)')
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    cliente_factory = (lambda: ClienteHTTP(args.url)) if args.url else ClienteFlask
+    cenarios = montar_cenarios(args, cliente_factory())
+    if args.endpoint:
+        cenarios = {n: c for n, c in cenarios.items() if any(e in n for e in args.endpoint)}
+
+    resultados = {}
+    print(f"{'endpoint':40} {'req':>6} {'erros':>6} {'p50':>9} {'p95':>9} {'p99':>9} {'req/s':>8}")
+    for nome, gerar_requisicao in cenarios.items():
+        r = executar(args, cliente_factory, gerar_requisicao)
+        resultados[nome] = r
+        print(f"{nome:40} {r['requisicoes']:>6} {r['erros']:>6} {r['p50_ms']:>7}ms {r['p95_ms']:>7}ms {r['p99_ms']:>7}ms {r['req_por_s']:>8}")
+
+    if args.salvar_baseline:
+        with open(ARQUIVO_BASELINE, 'w', encoding='utf-8') as f:
+            json.dump({'gerado_em': time.strftime('%Y-%m-%dT%H:%M:%S'), 'iteracoes': args.iteracoes,
+                       'concorrencia': args.concorrencia, 'resultados': resultados}, f, indent=2, ensure_ascii=False)
+        print(f"Baseline salvo em {ARQUIVO_BASELINE}.")
+
+    if args.comparar:
+        regressoes = comparar(resultados, args.tolerancia)
+        for regressao in regressoes:
+            print(f"[REGRESSÃO] {regressao}")
+        if regressoes:
+            raise SystemExit(1)
+        print("Nenhuma regressão de p95 acima da tolerância.")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,195 @@
+"""Gera dados sintéticos de clínica para testes de carga.
+
+Preenche usuarios (dentistas), pacientes, appointments, pagamentos, budgets,
+budget_procedures e historico_pacientes no banco configurado em DATABASE_URL,
+usando INSERTs multi-linha em lotes. Exemplo (10 dentistas, 100 mil pacientes,
+5 anos de agenda):
+
+    DATABASE_URL=sqlite:////tmp/carga.db python gerar_dados.py --dentistas 10 --pacientes 100000 --anos 5
+
+Com --clinica N os dados vão para uma clínica já criada (flask criar-clinica), o que permite
+medir uma clínica pequena ao lado de uma grande no mesmo banco.
+
+Não use em um banco de produção: os dados são fictícios.
+"""
+import argparse
+import random
+import time
+from datetime import date, datetime, timedelta, timezone
+
+from sqlalchemy import insert, func
+
+from app import (
+    app, db, aplicar_migracoes, garantir_admin_padrao, formatar_nome_completo, digitos_verificadores_cpf,
+    reconstruir_indice_busca_historico,
+    CLINICA_PADRAO_ID, Clinica, Usuario, Paciente, Appointment, Pagamento, Budget, BudgetProcedure, HistoricoPaciente
+)
+
+NOMES = ['Ana', 'Bruno', 'Carla', 'Daniel', 'Eduarda', 'Felipe', 'Gabriela', 'Henrique', 'Isabela', 'João',
+         'Karina', 'Lucas', 'Mariana', 'Nicolas', 'Olívia', 'Pedro', 'Rafaela', 'Samuel', 'Tatiana', 'Vinícius']
+SOBRENOMES = ['Silva', 'Santos', 'Oliveira', 'Souza', 'Rodrigues', 'Ferreira', 'Alves', 'Pereira', 'Lima', 'Gomes',
+              'Costa', 'Ribeiro', 'Martins', 'Carvalho', 'Almeida', 'Lopes', 'Soares', 'Fernandes', 'Vieira', 'Barbosa']
+PROCEDIMENTOS = [('Endodontia', 'Tratamento de canal', 900.0), ('Clínica Geral', 'Restauração', 180.0),
+                 ('Clínica Geral', 'Limpeza', 150.0), ('Cirurgia', 'Extração', 250.0), ('Prótese', 'Coroa', 1200.0)]
+ANOTACOES = ['Paciente relata sensibilidade ao frio.', 'Alergia a dipirona.', 'Retorno em 15 dias.',
+             'Complicação pós-extração, prescrito antibiótico.', 'Radiografia periapical solicitada.']
+HORARIOS = [f"{h:02d}:{m:02d}" for h in range(8, 18) for m in (0, 30)]
+
+
+def _inserir_em_lotes(model, linhas, tamanho_lote):
+    # Pela conexão, fora dos eventos da sessão: dados sintéticos não entram na auditoria
+    conn = db.session.connection()
+    for inicio in range(0, len(linhas), tamanho_lote):
+        conn.execute(insert(model.__table__), linhas[inicio:inicio + tamanho_lote])
+    db.session.commit()
+
+
+def _cpf_ficticio(n):
+    # Dígitos verificadores válidos, para que o paciente possa ser editado pelo formulário
+    base = f"{n:09d}"
+    return base + digitos_verificadores_cpf(base)
+
+
+def gerar(args):
+    rnd = random.Random(args.seed)
+    agora = datetime.now(timezone.utc)
+    lote = args.tamanho_lote
+    clinica = db.session.get(Clinica, args.clinica)
+    if not clinica:
+        raise SystemExit(f"Clínica {args.clinica} não encontrada. Crie-a antes com 'flask criar-clinica'.")
+
+    # Dentistas
+    inicio_ids = db.session.query(func.coalesce(func.max(Usuario.id), 0)).scalar()
+    dentistas = []
+    for i in range(args.dentistas):
+        dentista = Usuario(username=f"dentista_carga_{inicio_ids + i + 1}", nome=f"Dr(a). Carga {inicio_ids + i + 1}",
+                           email=f"dentista_carga_{inicio_ids + i + 1}@exemplo.com", perfil='comum', clinica_id=clinica.id)
+        dentista.set_password(args.senha)
+        dentistas.append(dentista)
+    db.session.add_all(dentistas)
+    db.session.commit()
+    dentistas = [(d.id, d.nome) for d in dentistas]
+    print(f"{len(dentistas)} dentistas criados (senha: '{args.senha}').")
+
+    # Pacientes
+    primeiro_paciente = db.session.query(func.coalesce(func.max(Paciente.id), 0)).scalar() + 1
+    pacientes = []
+    for n in range(args.pacientes):
+        nome, sobrenome = rnd.choice(NOMES), f"{rnd.choice(SOBRENOMES)} {rnd.choice(SOBRENOMES)}"
+        pacientes.append({
+            'id': primeiro_paciente + n,
+            'clinica_id': clinica.id,
+            'nome': nome,
+            'sobrenome': sobrenome,
+            'nome_completo': formatar_nome_completo(nome, sobrenome),
+            'data_nascimento': date(1940, 1, 1) + timedelta(days=rnd.randrange(30000)),
+            'cpf': _cpf_ficticio(primeiro_paciente + n),
+            'celular': f"119{rnd.randrange(10**8):08d}",
+            'cadastrado_em': agora - timedelta(days=rnd.randrange(365 * args.anos)),
+            'nao_possui_email': True,
+            'is_fully_registered': True,
+        })
+    _inserir_em_lotes(Paciente, pacientes, lote)
+    nomes_pacientes = {p['id']: p['nome_completo'] for p in pacientes}
+    ids_pacientes = list(nomes_pacientes)
+    print(f"{len(pacientes)} pacientes criados.")
+
+    # Agenda: dias úteis dos últimos `anos`, mais 60 dias à frente
+    hoje = agora.date()
+    dia = hoje - timedelta(days=365 * args.anos)
+    total_agendamentos = 0
+    agendamentos = []
+    while dia <= hoje + timedelta(days=60):
+        if dia.weekday() < 5:
+            for dentista_id, dentista_nome in dentistas:
+                for horario in rnd.sample(HORARIOS, min(args.agendamentos_por_dia, len(HORARIOS))):
+                    paciente_id = rnd.choice(ids_pacientes)
+                    agendamentos.append({
+                        'clinica_id': clinica.id, 'patient_id': paciente_id, 'patient_name': nomes_pacientes[paciente_id],
+                        'patient_is_fully_registered': True,
+                        'dentista_id': dentista_id, 'dentista_nome': dentista_nome,
+                        'appointment_date': dia, 'appointment_time': horario, 'duration_minutes': 30,
+                        'created_at': datetime.combine(dia, datetime.min.time()) - timedelta(days=rnd.randrange(1, 30)),
+                    })
+        if len(agendamentos) >= lote:
+            _inserir_em_lotes(Appointment, agendamentos, lote)
+            total_agendamentos += len(agendamentos)
+            agendamentos = []
+        dia += timedelta(days=1)
+    _inserir_em_lotes(Appointment, agendamentos, lote)
+    total_agendamentos += len(agendamentos)
+    print(f"{total_agendamentos} agendamentos criados.")
+
+    # Pagamentos (a maioria já processada, uma fração pendente)
+    pagamentos = []
+    for _ in range(int(args.pacientes * args.pagamentos_por_paciente)):
+        paciente_id = rnd.choice(ids_pacientes)
+        dentista_id, dentista_nome = rnd.choice(dentistas)
+        status = 'pendente' if rnd.random() < args.fracao_pendentes else rnd.choice(['aprovado', 'aprovado', 'rejeitado'])
+        data_pagamento = agora - timedelta(minutes=rnd.randrange(60 * 24 * 365 * args.anos))
+        pagamentos.append({
+            'clinica_id': clinica.id, 'paciente_id': paciente_id, 'paciente_nome': nomes_pacientes[paciente_id],
+            'dentista_id': dentista_id, 'dentista_nome': dentista_nome,
+            'valor': round(rnd.uniform(50, 2000), 2), 'data_pagamento': data_pagamento, 'status': status,
+            'data_acao_aprovacao': data_pagamento + timedelta(days=1) if status != 'pendente' else None,
+        })
+    _inserir_em_lotes(Pagamento, pagamentos, lote)
+    print(f"{len(pagamentos)} pagamentos criados.")
+
+    # Orçamentos e procedimentos
+    primeiro_orcamento = db.session.query(func.coalesce(func.max(Budget.id), 0)).scalar() + 1
+    orcamentos, procedimentos = [], []
+    for n in range(int(args.pacientes * args.orcamentos_por_paciente)):
+        escolhidos = [rnd.choice(PROCEDIMENTOS) for _ in range(rnd.randint(1, 5))]
+        orcamentos.append({
+            'id': primeiro_orcamento + n, 'clinica_id': clinica.id, 'patient_id': rnd.choice(ids_pacientes), 'clinic_name': clinica.nome,
+            'observations': '', 'total_value': sum(valor for _, _, valor in escolhidos),
+            'status': rnd.choice(['pending', 'approved', 'rejected']),
+            'created_at': agora - timedelta(days=rnd.randrange(365 * args.anos)),
+        })
+        for tabela, descricao, valor in escolhidos:
+            procedimentos.append({
+                'budget_id': primeiro_orcamento + n, 'table_name': tabela, 'description': descricao,
+                'tooth': str(rnd.randint(11, 48)), 'dentist': rnd.choice(dentistas)[1], 'value': valor,
+            })
+    _inserir_em_lotes(Budget, orcamentos, lote)
+    _inserir_em_lotes(BudgetProcedure, procedimentos, lote)
+    print(f"{len(orcamentos)} orçamentos e {len(procedimentos)} procedimentos criados.")
+
+    # Histórico clínico
+    historicos = [{
+        'clinica_id': clinica.id, 'patient_id': rnd.choice(ids_pacientes), 'historico': rnd.choice(ANOTACOES),
+        'created_at': agora - timedelta(minutes=rnd.randrange(60 * 24 * 365 * args.anos)),
+    } for _ in range(int(args.pacientes * args.historicos_por_paciente))]
+    _inserir_em_lotes(HistoricoPaciente, historicos, lote)
+    reconstruir_indice_busca_historico(db.session.connection()) # Os INSERTs em lote não passam pelos eventos do ORM
+    db.session.commit()
+    print(f"{len(historicos)} registros de histórico criados.")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--dentistas', type=int, default=10)
+    parser.add_argument('--pacientes', type=int, default=10000)
+    parser.add_argument('--anos', type=int, default=1, help='Anos de agenda, pagamentos e histórico no passado')
+    parser.add_argument('--agendamentos-por-dia', type=int, default=12, help='Por dentista, em dias úteis')
+    parser.add_argument('--pagamentos-por-paciente', type=float, default=2.0)
+    parser.add_argument('--fracao-pendentes', type=float, default=0.05)
+    parser.add_argument('--orcamentos-por-paciente', type=float, default=0.5)
+    parser.add_argument('--historicos-por-paciente', type=float, default=3.0)
+    parser.add_argument('--senha', default='carga123', help='Senha dos dentistas criados')
+    parser.add_argument('--clinica', type=int, default=CLINICA_PADRAO_ID, help='Clínica (id) que recebe os dados')
+    parser.add_argument('--tamanho-lote', type=int, default=5000)
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    inicio = time.perf_counter()
+    with app.app_context():
+        aplicar_migracoes()
+        garantir_admin_padrao() # O benchmark faz login como admin
+        gerar(args)
+    print(f"Concluído em {time.perf_counter() - inicio:.1f}s.")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,21 @@
+# Configuração do gunicorn usada pelo Dockerfile.
+# O worker gevent atende cada conexão em um greenlet, então os streams SSE de
+# /api/appointments/stream ficam ociosos sem ocupar uma thread cada. O canal de
+# eventos da agenda é por processo; mantenha 1 worker e aumente worker_connections.
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '5000')}"
+worker_class = 'gevent'
+workers = int(os.environ.get('GUNICORN_WORKERS', '1'))
+worker_connections = int(os.environ.get('GUNICORN_WORKER_CONNECTIONS', '1000'))
+timeout = 60
+accesslog = '-'
+# Formato padrão do gunicorn sem a query string (%(U)s em vez da linha da requisição): o ticket
+# do stream SSE, passado na URL, não vai para o log
+access_log_format = '%(h)s %(l)s %(u)s %(t)s "%(m)s %(U)s %(H)s" %(s)s %(b)s "%(f)s" "%(a)s"'
+
+
+def post_worker_init(worker):
+    # Limpeza periódica dos registros excluídos logicamente (CLEANUP_INTERVAL_SECONDS)
+    from app import iniciar_limpeza_periodica
+    iniciar_limpeza_periodica()
@@ -34,6 +34,33 @@ function parseJwt(token) {
 function App() {
   const [currentUser, setCurrentUser] = useState(null);
   const [loadingAuth, setLoadingAuth] = useState(true);
+  const [bootstrap, setBootstrap] = useState(null); // Dentistas, agenda de hoje/amanhã e pendências, de /api/bootstrap
+
+  const handleLogout = useCallback(() => {
+    localStorage.removeItem('token');
+    localStorage.removeItem('currentUser');
+    setCurrentUser(null);
+    setBootstrap(null);
+  }, []);
+
+  // Uma única requisição traz tudo que a tela inicial precisa e confirma que o token ainda é válido
+  const carregarBootstrap = useCallback(async (token) => {
+    try {
+      const response = await fetch(`${API_URL}/bootstrap`, { headers: { 'x-access-token': token } });
+      if (response.status === 401) {
+        handleLogout();
+        return;
+      }
+      const data = await response.json();
+      if (response.ok && data.success) {
+        localStorage.setItem('currentUser', JSON.stringify(data.user));
+        setCurrentUser(data.user);
+        setBootstrap(data);
+      }
+    } catch (err) {
+      console.error('Erro ao carregar dados iniciais:', err);
+    }
+  }, [handleLogout]);
 
   const fetchUserProfile = useCallback(async (token) => {
     // Em um cenário real, você poderia ter um endpoint /api/me para validar o token e pegar dados do usuário
@@ -55,9 +82,10 @@ function App() {
       } else if (decodedToken.perfil) { // Se o perfil estiver no token
          setCurrentUser({id: decodedToken.user_id, perfil: decodedToken.perfil, nome: decodedToken.nome || 'Usuário'});
       }
+      carregarBootstrap(token); // Em segundo plano: a tela já abre com o usuário salvo
     }
     setLoadingAuth(false);
-  }, []);
+  }, [carregarBootstrap]);
 
 
   useEffect(() => {
@@ -73,12 +101,7 @@ function App() {
     localStorage.setItem('token', token);
     localStorage.setItem('currentUser', JSON.stringify(user)); // Armazena dados do usuário
     setCurrentUser(user);
-  };
-
-  const handleLogout = () => {
-    localStorage.removeItem('token');
-    localStorage.removeItem('currentUser');
-    setCurrentUser(null);
+    carregarBootstrap(token);
   };
 
   if (loadingAuth) {
@@ -94,7 +117,7 @@ function App() {
       // Se um perfil específico é requerido e o usuário não o tem
       return <Navigate to="/dashboard" replace />; // Ou para uma página de "acesso negado"
     }
-    return children ? children : <Outlet context={{ currentUser, handleLogout }} />; // Passa currentUser e handleLogout para rotas aninhadas
+    return children ? children : <Outlet context={{ currentUser, handleLogout, bootstrap }} />; // Passa currentUser e handleLogout para rotas aninhadas
   };
 
   // Componente de Rota Específica para Admin
@@ -116,7 +139,7 @@ function App() {
           <Route element={<ProtectedRoute />}>
             <Route
               path="/dashboard"
-              element={<Dashboard currentUser={currentUser} onLogout={handleLogout} />}
+              element={<Dashboard currentUser={currentUser} onLogout={handleLogout} bootstrap={bootstrap} />}
             />
             {/* As demais rotas que usam Outlet context para currentUser e handleLogout permanecem como estão se essa for a intenção */}
             {/* Se elas não usam useOutletContext, podem ser rotas simples dentro de ProtectedRoute */}
@@ -1,5 +1,5 @@
 import { useOutletContext } from "react-router-dom";
-import React, { useState, useEffect, useMemo } from 'react';
+import React, { useState, useEffect, useMemo, useRef } from 'react';
 import { Link, useNavigate } from 'react-router-dom';
 import { Card, CardContent, CardHeader, CardTitle } from './ui/card';
 import {
@@ -22,8 +22,8 @@ import { Label } from './ui/label';
 import { Textarea } from './ui/textarea';
 import { Select, SelectContent, SelectItem, SelectTrigger, SelectValue } from './ui/select';
 import { Dialog, DialogContent, DialogHeader, DialogTitle, DialogFooter, DialogClose } from './ui/dialog';
-import { Stethoscope, ArrowLeft, Calendar, Search, Home, Trash2, Edit } from 'lucide-react';
-import API_URL from '../lib/api';
+import { Stethoscope, ArrowLeft, Calendar, Search, Home, Trash2, Edit, Smartphone } from 'lucide-react';
+import API_URL, { chaveIdempotencia } from '../lib/api';
 
 export default function Agendamento() {
   const isPastDate = (dateString) => {
@@ -50,6 +50,7 @@ export default function Agendamento() {
   const [duracao, setDuracao] = useState('30');
   const [observacao, setObservacao] = useState('');
   const [loading, setLoading] = useState(false);
+  const idempotenciaRef = useRef(null); // Mantém a Idempotency-Key entre reenvios após falha de conexão
   const [showBuscaResultados, setShowBuscaResultados] = useState(false);
   const [isModalOpen, setIsModalOpen] = useState(false);
   const [dentistas, setDentistas] = useState([]);
@@ -57,13 +58,15 @@ export default function Agendamento() {
   const [adminVisualizandoDentistaId, setAdminVisualizandoDentistaId] = useState('');
   // Para o formulário de agendamento (usado por admin para definir quem realiza, ou por dentista para si mesmo)
   const [dentistaAgendamentoFormId, setDentistaAgendamentoFormId] = useState('');
-  const { currentUser, token } = useOutletContext();
+  const { currentUser, token, bootstrap } = useOutletContext();
 
   // console.log("[Debug] Agendamento Component Render: currentUser id:", currentUser?.id, "token exists:", !!token);
 
   useEffect(() => {
     // console.log("[Debug] useEffect Dentistas - Triggered. currentUser?.perfil:", currentUser?.perfil, "Token exists:", !!token);
-    if (currentUser?.perfil === "admin" && token) {
+    if (currentUser?.perfil === "admin" && bootstrap) {
+      setDentistas(bootstrap.dentistas); // Já carregados por /api/bootstrap
+    } else if (currentUser?.perfil === "admin" && token) {
       fetch(`${API_URL}/dentistas`, {
         headers: { "x-access-token": token }
       })
@@ -97,7 +100,7 @@ export default function Agendamento() {
         setDentistas([]);
       }
     }
-  }, [currentUser, token]);
+  }, [currentUser, token, bootstrap]);
 
   useEffect(() => {
   const carregarPacientes = async () => {
@@ -229,14 +232,17 @@ export default function Agendamento() {
 
     try {
       // Removido /api/ assumindo que API_URL já contém /api
+      const corpo = JSON.stringify(agendamentoPayload);
       const response = await fetch(`${API_URL}/appointments`, {
         method: 'POST',
         headers: {
           'Content-Type': 'application/json',
           'x-access-token': token,
+          'Idempotency-Key': chaveIdempotencia(idempotenciaRef, corpo),
         },
-        body: JSON.stringify(agendamentoPayload),
+        body: corpo,
       });
+      idempotenciaRef.current = null;
       const result = await response.json();
       if (result.success) {
         toast.success('Agendamento realizado com sucesso!');
@@ -372,6 +378,25 @@ export default function Agendamento() {
     </form>
   );
 
+  // Link para assinar a própria agenda no calendário do celular (feed .ics); gerado no primeiro uso
+  const copiarLinkAgendaCelular = async () => {
+    try {
+      let response = await fetch(`${API_URL}/agenda/feed`, { headers: { "x-access-token": token } });
+      if (response.status === 404) {
+        response = await fetch(`${API_URL}/agenda/feed`, { method: 'POST', headers: { "x-access-token": token } });
+      }
+      const data = await response.json();
+      if (!response.ok || !data.success) {
+        toast.error(data.message || "Falha ao obter o link da agenda.");
+        return;
+      }
+      await navigator.clipboard?.writeText(data.webcal).catch(() => {});
+      toast.success("Abra este link no celular para assinar a agenda:", { description: data.webcal, duration: 15000 });
+    } catch (error) {
+      toast.error("Erro de conexão ao obter o link da agenda.");
+    }
+  };
+
   return (
     <div className="min-h-screen bg-gradient-to-br from-blue-50 to-indigo-100">
       <header className="bg-white shadow-sm border-b">
@@ -385,6 +410,9 @@ export default function Agendamento() {
               </div>
             </div>
             <nav className="flex items-center space-x-4">
+              {currentUser?.perfil === 'comum' && (
+                <Button variant="ghost" size="sm" className="flex items-center space-x-2" onClick={copiarLinkAgendaCelular}><Smartphone className="h-4 w-4" /><span>Agenda no celular</span></Button>
+              )}
               <Link to="/dashboard"><Button variant="ghost" size="sm" className="flex items-center space-x-2"><Home className="h-4 w-4" /><span>Inicio</span></Button></Link>
               <Link to="/dashboard"><Button variant="ghost" size="sm" className="flex items-center space-x-2"><ArrowLeft className="h-4 w-4" /><span>Voltar</span></Button></Link>
             </nav>
@@ -620,6 +648,15 @@ const CalendarioAgendamentos = ({ onSlotClick, dentistaIdParaVisualizacao }) =>
         // Não é mais necessário /api/appointments/dentista/${currentUser.id}
       }
 
+      // Apenas a semana exibida (com um dia de folga por causa do fuso); semanas antigas incluem os agendamentos arquivados
+      const semana = getDiasDaSemana(getInicioDaSemana(diaReferencia));
+      const inicio = new Date(semana[0]);
+      inicio.setDate(inicio.getDate() - 1);
+      const fim = new Date(semana[6]);
+      fim.setDate(fim.getDate() + 1);
+      params.append('data_inicio', inicio.toISOString().split('T')[0]);
+      params.append('data_fim', fim.toISOString().split('T')[0]);
+
       if (params.toString()) {
         url += `?${params.toString()}`;
       }
@@ -645,6 +682,60 @@ const CalendarioAgendamentos = ({ onSlotClick, dentistaIdParaVisualizacao }) =>
     fetchCalendarAppointments();
   }, [diaReferencia, currentUser, token, dentistaIdParaVisualizacao]);
 
+  // Recebe criações/alterações/exclusões feitas em outras estações e atualiza o calendário localmente, sem recarregar a lista.
+  useEffect(() => {
+    if (!token || !currentUser) return;
+    const filtroDentista = currentUser.perfil === 'comum' ? currentUser.id : dentistaIdParaVisualizacao;
+    let source = null;
+    let reconexao = null;
+    let encerrado = false;
+    const upsertAppointment = (event) => {
+      const appointment = JSON.parse(event.data);
+      setCalendarAppointments(prev => {
+        const semAppointment = prev.filter(app => app.id !== appointment.id);
+        // Agendamento transferido para outro dentista sai da agenda filtrada
+        if (filtroDentista && String(appointment.dentista_id) !== String(filtroDentista)) return semAppointment;
+        return [...semAppointment, appointment];
+      });
+    };
+    const removeAppointment = (event) => {
+      const { id } = JSON.parse(event.data);
+      setCalendarAppointments(prev => prev.filter(app => app.id !== id));
+    };
+    // O token de sessão não vai na URL (ficaria nos logs de acesso): cada conexão usa um ticket de
+    // curta duração. Quando a conexão cai, o ticket pode já ter expirado, então pede outro.
+    const conectar = async () => {
+      try {
+        const response = await fetch(`${API_URL}/appointments/stream/ticket`, {
+          method: 'POST',
+          headers: { 'x-access-token': token }
+        });
+        if (!response.ok || encerrado) throw new Error(response.statusText);
+        const { ticket } = await response.json();
+        const params = new URLSearchParams({ ticket });
+        if (currentUser.perfil === 'admin' && dentistaIdParaVisualizacao) {
+          params.append('dentista_id', dentistaIdParaVisualizacao);
+        }
+        source = new EventSource(`${API_URL}/appointments/stream?${params.toString()}`);
+        source.addEventListener('created', upsertAppointment);
+        source.addEventListener('updated', upsertAppointment);
+        source.addEventListener('deleted', removeAppointment);
+        source.onerror = () => {
+          source.close();
+          if (!encerrado) reconexao = setTimeout(conectar, 5000);
+        };
+      } catch (error) {
+        if (!encerrado) reconexao = setTimeout(conectar, 5000);
+      }
+    };
+    conectar();
+    return () => {
+      encerrado = true;
+      clearTimeout(reconexao);
+      if (source) source.close();
+    };
+  }, [currentUser, token, dentistaIdParaVisualizacao]);
+
   const handleDragStart = (event) => { setActiveId(event.active.id); if(event.active.data.current?.appointmentData) setDraggedAppointmentData(event.active.data.current.appointmentData); };
   const handleDragEnd = async (event) => {
     setActiveId(null); setDraggedAppointmentData(null);
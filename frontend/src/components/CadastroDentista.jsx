@@ -12,6 +12,9 @@ import { Alert, AlertDescription } from '@/components/ui/alert'
 import { Stethoscope, ArrowLeft, Save, User, Phone, MapPin, FileText, Home } from 'lucide-react'
 import API_URL from '../lib/api';
 
+// Campos mantidos pelo servidor, nunca enviados no PATCH
+const CAMPOS_SOMENTE_LEITURA = ['id', 'cadastrado_em', 'nome_completo', 'versao', 'deleted_at', 'is_fully_registered']
+
 const CadastroDentista = () => {
   const navigate = useNavigate()
   const { id } = useParams()
@@ -19,6 +22,7 @@ const CadastroDentista = () => {
   const [loading, setLoading] = useState(false)
   const [message, setMessage] = useState('')
   const [messageType, setMessageType] = useState('')
+  const [originalData, setOriginalData] = useState(null) // Dados carregados, base para o PATCH
 
   const [formData, setFormData] = useState({
     // Dados Cadastrais
@@ -92,6 +96,7 @@ const CadastroDentista = () => {
       
       if (response.ok && data.success) { // Checar response.ok também
         setFormData(data.data)
+        setOriginalData(data.data)
       } else {
         setMessage('Erro ao carregar dados do paciente')
         setMessageType('error')
@@ -122,15 +127,26 @@ const CadastroDentista = () => {
 
     try {
       const url = isEditing ? `${API_URL}/pacientes/${id}` : `${API_URL}/pacientes` // Alterado para /pacientes
-      const method = isEditing ? 'PUT' : 'POST'
-      
+      // Na edição, envia apenas os campos alterados, condicionado à versão carregada
+      const method = isEditing ? 'PATCH' : 'POST'
+      const headers = {
+        'Content-Type': 'application/json',
+        'x-access-token': token, // Adicionar token
+      }
+      let body = formData
+      if (isEditing) {
+        body = Object.fromEntries(Object.entries(formData).filter(
+          ([campo, valor]) => !CAMPOS_SOMENTE_LEITURA.includes(campo) && (valor ?? '') !== (originalData?.[campo] ?? '')
+        ))
+        if (originalData?.versao) {
+          headers['If-Match'] = `"${originalData.versao}"`
+        }
+      }
+
       const response = await fetch(url, {    
         method: method,
-        headers: {
-          'Content-Type': 'application/json',
-          'x-access-token': token, // Adicionar token
-        },
-        body: JSON.stringify(formData),
+        headers: headers,
+        body: JSON.stringify(body),
       })
 
       const data = await response.json()
@@ -138,6 +154,11 @@ const CadastroDentista = () => {
       if (response.ok && data.success) { // Checar response.ok
         setMessage(isEditing ? 'Paciente atualizado com sucesso!' : 'Paciente cadastrado com sucesso!')
         setMessageType('success')
+        if (isEditing) {
+          const atualizado = { ...formData, versao: data.versao }
+          setFormData(atualizado)
+          setOriginalData(atualizado)
+        }
         
         if (!isEditing) { // Resetar formulário apenas se não estiver editando
           setFormData({
@@ -151,6 +172,9 @@ const CadastroDentista = () => {
             cpf_representante: '', rg_representante: '', telefone_representante: '', nascimento_representante: ''
           })
         }
+      } else if (response.status === 412) {
+        setMessage('Este paciente foi alterado por outro usuário. Recarregue a página para ver os dados atuais antes de salvar.')
+        setMessageType('error')
       } else {
         // Modificar para lidar com um objeto de 'errors'
         if (data.errors) {
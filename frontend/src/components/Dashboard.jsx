@@ -8,7 +8,7 @@ import {
 import AdminButton from './AdminButton';
 
 // O Dashboard agora recebe currentUser e onLogout como props
-const Dashboard = ({ currentUser, onLogout }) => {
+const Dashboard = ({ currentUser, onLogout, bootstrap }) => {
 
   const nomeUsuario = currentUser?.nome || 'Usuário';
   const perfilUsuario = currentUser?.perfil || 'desconhecido';
@@ -170,6 +170,11 @@ const Dashboard = ({ currentUser, onLogout }) => {
                 <p className="text-sm text-gray-600">
                   Visualize e gerencie sua agenda de consultas.
                 </p>
+                {bootstrap && (
+                  <p className="text-sm font-medium text-purple-700 mt-2">
+                    {bootstrap.agenda.hoje.length} consulta(s) hoje · {bootstrap.agenda.amanha.length} amanhã
+                  </p>
+                )}
               </CardContent>
             </Card>
           </Link>
@@ -217,6 +222,11 @@ const Dashboard = ({ currentUser, onLogout }) => {
                     <p className="text-sm text-gray-600">
                       Aprove ou rejeite pagamentos registrados pelos dentistas.
                     </p>
+                    {bootstrap?.pagamentos_pendentes && (
+                      <p className="text-sm font-medium text-red-700 mt-2">
+                        {bootstrap.pagamentos_pendentes.quantidade} pendente(s) · {bootstrap.pagamentos_pendentes.valor_total.toLocaleString('pt-BR', { style: 'currency', currency: 'BRL' })}
+                      </p>
+                    )}
                   </CardContent>
                 </Card>
               </Link>
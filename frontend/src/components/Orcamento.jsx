@@ -1,4 +1,4 @@
-import { useState, useEffect } from 'react'
+import { useState, useEffect, useRef } from 'react'
 import { Link } from 'react-router-dom'
 import { Button } from '@/components/ui/button'
 import { Input } from '@/components/ui/input'
@@ -10,11 +10,12 @@ import { Alert, AlertDescription } from '@/components/ui/alert'
 import { Dialog, DialogContent, DialogDescription, DialogHeader, DialogTitle, DialogTrigger } from '@/components/ui/dialog'
 import { RadioGroup, RadioGroupItem } from '@/components/ui/radio-group'
 import { Stethoscope, ArrowLeft, Save, Calculator, Plus, Trash2, Edit, Eye, Home } from 'lucide-react'
-import API_URL from '../lib/api';
+import API_URL, { chaveIdempotencia } from '../lib/api';
 
 const Orcamento = () => {
   const [patients, setPatients] = useState([])
   const [loading, setLoading] = useState(false)
+  const idempotenciaRef = useRef(null) // Mantém a Idempotency-Key entre reenvios após falha de conexão
   const [message, setMessage] = useState('')
   const [messageType, setMessageType] = useState('')
   const [showPaymentForm, setShowPaymentForm] = useState(false)
@@ -217,14 +218,17 @@ const Orcamento = () => {
       }
 
       // Removido /api/
+      const corpo = JSON.stringify(budgetData);
       const response = await fetch(`${API_URL}/budgets`, {
         method: 'POST',
         headers: {
           'Content-Type': 'application/json',
           'x-access-token': token,
+          'Idempotency-Key': chaveIdempotencia(idempotenciaRef, corpo),
         },
-        body: JSON.stringify(budgetData),
+        body: corpo,
       });
+      idempotenciaRef.current = null;
 
       const result = await response.json();
 
@@ -283,14 +287,17 @@ const Orcamento = () => {
       }
 
       // Removido /api/
+      const corpo = JSON.stringify(budgetData);
       const response = await fetch(`${API_URL}/budgets`, {
         method: 'POST',
         headers: {
           'Content-Type': 'application/json',
           'x-access-token': token,
+          'Idempotency-Key': chaveIdempotencia(idempotenciaRef, corpo),
         },
-        body: JSON.stringify(budgetData),
+        body: corpo,
       });
+      idempotenciaRef.current = null;
 
       const result = await response.json();
 
@@ -1,4 +1,4 @@
-import { useState, useEffect } from 'react'
+import { useState, useEffect, useRef } from 'react'
 import { Link, useParams } from 'react-router-dom'
 import { Button } from '@/components/ui/button'
 import { Input } from '@/components/ui/input'
@@ -8,7 +8,7 @@ import { Tabs, TabsContent, TabsList, TabsTrigger } from '@/components/ui/tabs'
 import { Badge } from '@/components/ui/badge'
 import { Alert, AlertDescription } from '@/components/ui/alert'
 import { Stethoscope, ArrowLeft, User, Phone, MapPin, FileText, Edit, Calculator, Save, Upload, Image, File, Trash2, X, Eye } from 'lucide-react'
-import API_URL from '../lib/api';
+import API_URL, { chaveIdempotencia } from '../lib/api';
 
 const VisualizarPaciente = () => {
   const { id } = useParams()
@@ -16,6 +16,7 @@ const VisualizarPaciente = () => {
   const [budgets, setBudgets] = useState([])
   const [historicos, setHistoricos] = useState([])
   const [loading, setLoading] = useState(true)
+  const pagamentoIdempotenciaRef = useRef(null) // Mantém a Idempotency-Key entre reenvios após falha de conexão
   const [error, setError] = useState('')
   const [editingHistorico, setEditingHistorico] = useState(false)
   const [historicoText, setHistoricoText] = useState('')
@@ -208,17 +209,20 @@ const VisualizarPaciente = () => {
     const token = localStorage.getItem('token');
 
     try {
+      const corpo = JSON.stringify({
+        paciente_id: parseInt(id, 10),
+        valor: parseFloat(paymentValue),
+      });
       const response = await fetch(`${API_URL}/pagamentos`, {
         method: 'POST',
         headers: {
           'Content-Type': 'application/json',
           'x-access-token': token,
+          'Idempotency-Key': chaveIdempotencia(pagamentoIdempotenciaRef, corpo),
         },
-        body: JSON.stringify({
-          paciente_id: parseInt(id, 10),
-          valor: parseFloat(paymentValue),
-        }),
+        body: corpo,
       });
+      pagamentoIdempotenciaRef.current = null;
       const data = await response.json();
       if (response.ok && data.success) {
         // toast.success('Pagamento registrado com sucesso!'); // Se estiver usando sonner
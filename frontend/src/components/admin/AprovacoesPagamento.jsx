@@ -4,6 +4,7 @@ import { Button } from "@/components/ui/button";
 import { Card, CardContent, CardHeader, CardTitle, CardDescription } from "@/components/ui/card";
 import { Alert, AlertDescription } from "@/components/ui/alert";
 import { Badge } from "@/components/ui/badge";
+import { Checkbox } from "@/components/ui/checkbox";
 import { toast } from 'sonner';
 import API_URL from '../../lib/api';
 
@@ -11,13 +12,16 @@ const AprovacoesPagamento = () => {
   const [pagamentos, setPagamentos] = useState([]);
   const [loading, setLoading] = useState(true);
   const [error, setError] = useState('');
+  const [page, setPage] = useState(1);
+  const [resumo, setResumo] = useState({ total: 0, valor_total: 0, pages: 0 });
+  const [selecionados, setSelecionados] = useState([]);
 
   const fetchPagamentosPendentes = useCallback(async () => {
     setLoading(true);
     setError('');
     const token = localStorage.getItem('token');
     try {
-      const response = await fetch(`${API_URL}/pagamentos/pendentes`, {
+      const response = await fetch(`${API_URL}/pagamentos/pendentes?page=${page}&per_page=50`, {
         headers: {
           'x-access-token': token,
         },
@@ -27,7 +31,9 @@ const AprovacoesPagamento = () => {
         throw new Error(errData.message || `Erro ao buscar pagamentos: ${response.status}`);
       }
       const data = await response.json();
-      setPagamentos(data);
+      setPagamentos(data.pagamentos);
+      setResumo({ total: data.total, valor_total: data.valor_total, pages: data.pages });
+      setSelecionados([]);
     } catch (err) {
       console.error("Erro ao buscar pagamentos pendentes:", err);
       setError(err.message || 'Não foi possível carregar os pagamentos pendentes.');
@@ -35,7 +41,7 @@ const AprovacoesPagamento = () => {
     } finally {
       setLoading(false);
     }
-  }, []);
+  }, [page]);
 
   useEffect(() => {
     fetchPagamentosPendentes();
@@ -68,6 +74,41 @@ const AprovacoesPagamento = () => {
     }
   };
 
+  // Aprova/rejeita todos os selecionados em uma única requisição
+  const handleBulkAction = async (acao) => {
+    if (selecionados.length === 0) return;
+    setLoading(true);
+    const token = localStorage.getItem('token');
+    try {
+      const response = await fetch(`${API_URL}/pagamentos/bulk`, {
+        method: 'POST',
+        headers: {
+          'x-access-token': token,
+          'Content-Type': 'application/json',
+        },
+        body: JSON.stringify({ acao, ids: selecionados }),
+      });
+      const data = await response.json();
+      if (!response.ok) {
+        throw new Error(data.message || `Erro ao ${acao} pagamentos.`);
+      }
+      toast.success(data.message);
+      fetchPagamentosPendentes();
+    } catch (err) {
+      console.error(`Erro na ação em lote ${acao}:`, err);
+      setError(err.message);
+      toast.error(err.message);
+    } finally {
+      setLoading(false);
+    }
+  };
+
+  const toggleSelecionado = (id) => {
+    setSelecionados((atual) => atual.includes(id) ? atual.filter((s) => s !== id) : [...atual, id]);
+  };
+
+  const todosSelecionados = pagamentos.length > 0 && selecionados.length === pagamentos.length;
+
   if (loading && pagamentos.length === 0) {
     return <div className="p-4">Carregando aprovações de pagamento...</div>;
   }
@@ -77,7 +118,9 @@ const AprovacoesPagamento = () => {
       <Card>
         <CardHeader>
           <CardTitle>Aprovações de Pagamento</CardTitle>
-          <CardDescription>Gerencie os pagamentos pendentes de aprovação.</CardDescription>
+          <CardDescription>
+            Gerencie os pagamentos pendentes de aprovação. {resumo.total} pendente(s), totalizando R$ {parseFloat(resumo.valor_total).toFixed(2)}.
+          </CardDescription>
         </CardHeader>
         <CardContent>
           {error && (
@@ -88,10 +131,27 @@ const AprovacoesPagamento = () => {
           {pagamentos.length === 0 && !loading && !error && (
             <p className="text-center text-gray-500">Não há pagamentos pendentes no momento.</p>
           )}
+          {pagamentos.length > 0 && (
+            <div className="flex items-center justify-end space-x-2 mb-4">
+              <span className="text-sm text-gray-500">{selecionados.length} selecionado(s)</span>
+              <Button size="sm" onClick={() => handleBulkAction('aprovar')} disabled={loading || selecionados.length === 0}>
+                Aprovar selecionados
+              </Button>
+              <Button size="sm" variant="destructive" onClick={() => handleBulkAction('rejeitar')} disabled={loading || selecionados.length === 0}>
+                Rejeitar selecionados
+              </Button>
+            </div>
+          )}
           {pagamentos.length > 0 && (
             <Table>
               <TableHeader>
                 <TableRow>
+                  <TableHead>
+                    <Checkbox
+                      checked={todosSelecionados}
+                      onCheckedChange={(checked) => setSelecionados(checked ? pagamentos.map((p) => p.id) : [])}
+                    />
+                  </TableHead>
                   <TableHead>Paciente</TableHead>
                   <TableHead>Valor (R$)</TableHead>
                   <TableHead>Dentista Responsável</TableHead>
@@ -103,6 +163,12 @@ const AprovacoesPagamento = () => {
               <TableBody>
                 {pagamentos.map((pagamento) => (
                   <TableRow key={pagamento.id}>
+                    <TableCell>
+                      <Checkbox
+                        checked={selecionados.includes(pagamento.id)}
+                        onCheckedChange={() => toggleSelecionado(pagamento.id)}
+                      />
+                    </TableCell>
                     <TableCell>{pagamento.paciente_nome}</TableCell>
                     <TableCell>{parseFloat(pagamento.valor).toFixed(2)}</TableCell>
                     <TableCell>{pagamento.dentista_nome}</TableCell>
@@ -139,6 +205,17 @@ const AprovacoesPagamento = () => {
               </TableBody>
             </Table>
           )}
+          {resumo.pages > 1 && (
+            <div className="flex items-center justify-center space-x-2 mt-4">
+              <Button size="sm" variant="outline" onClick={() => setPage(page - 1)} disabled={loading || page <= 1}>
+                Anterior
+              </Button>
+              <span className="text-sm">Página {page} de {resumo.pages}</span>
+              <Button size="sm" variant="outline" onClick={() => setPage(page + 1)} disabled={loading || page >= resumo.pages}>
+                Próxima
+              </Button>
+            </div>
+          )}
         </CardContent>
       </Card>
     </div>
@@ -1,2 +1,14 @@
 const API_URL = import.meta.env.VITE_API_URL;
 export default API_URL;
+
+// Idempotency-Key para POSTs de criação: se a conexão cair antes da resposta, o reenvio
+// do mesmo conteúdo usa a mesma chave e o backend devolve o resultado já gravado em vez
+// de criar um registro duplicado. `ref` é um useRef do componente; zere-o (ref.current = null)
+// quando uma resposta chegar.
+export function chaveIdempotencia(ref, corpo) {
+  if (!ref.current || ref.current.corpo !== corpo) {
+    const chave = globalThis.crypto?.randomUUID?.() ?? `${Date.now().toString(36)}-${Math.random().toString(36).slice(2)}`;
+    ref.current = { corpo, chave };
+  }
+  return ref.current.chave;
+}